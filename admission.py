@@ -0,0 +1,154 @@
+"""Admission control and fair scheduling of model calls across browser sessions.
+
+Requests are keyed by the signed session ID (`current_session`, set once the session
+cookie has been verified):
+- Each session has a token bucket; a session that outruns it gets 429 with
+  Retry-After instead of using up the shared model quota.
+- Model calls share a global concurrency budget. When it is used up, calls wait in a
+  queue that grants freed slots round-robin across sessions, so one session's
+  50-page document or batch job interleaves with everyone else's single pages
+  instead of running ahead of them.
+- When that queue is already `max_queue` deep, new requests are refused with 429 and
+  a Retry-After estimated from the queue depth and recent call durations, rather
+  than queueing towards the request timeout.
+"""
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+import asyncio
+import math
+import time
+from typing import Callable
+
+from starlette.exceptions import HTTPException
+
+from batch import TokenBucket
+
+current_session: ContextVar[str] = ContextVar("current_session", default="")
+
+
+class AdmissionRejected(HTTPException):
+    """429 with a Retry-After header; `reason` is "rate_limited" or "overloaded"."""
+
+    def __init__(self, reason: str, retry_after_s: float, detail: str):
+        super().__init__(429, detail, headers={"Retry-After": str(max(1, math.ceil(retry_after_s)))})
+        self.reason = reason
+
+
+class FairScheduler:
+    """At most `capacity` holders at a time; waiters are served round-robin by session."""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.in_flight = 0
+        self.queued = 0
+        # Sessions with waiters, in the order they get the next free slot
+        self._waiters: "OrderedDict[str, deque]" = OrderedDict()
+        # Moving average of how long a slot is held, for Retry-After estimates
+        self.hold_s = 1.0
+
+    async def acquire(self, session: str) -> None:
+        if self.in_flight < self.capacity and not self._waiters:
+            self.in_flight += 1
+            return
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(session, deque()).append(fut)
+        self.queued += 1
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # Granted just as we were cancelled: pass the slot on
+                self.release()
+            else:
+                self._discard(session, fut)
+            raise
+
+    def _discard(self, session: str, fut) -> None:
+        waiters = self._waiters.get(session)
+        if waiters is not None and fut in waiters:
+            waiters.remove(fut)
+            self.queued -= 1
+            if not waiters:
+                del self._waiters[session]
+
+    def release(self) -> None:
+        """Hand the slot to the next session in turn, or free it."""
+        while self._waiters:
+            session, waiters = next(iter(self._waiters.items()))
+            fut = waiters.popleft()
+            self.queued -= 1
+            if waiters:
+                self._waiters.move_to_end(session)
+            else:
+                del self._waiters[session]
+            if not fut.done():
+                fut.set_result(None)
+                return
+        self.in_flight -= 1
+
+    async def hold(self, session: str) -> Callable[[], None]:
+        """Acquire a slot; returns the function (call it once) that releases it."""
+        await self.acquire(session)
+        t0 = time.perf_counter()
+
+        def done() -> None:
+            self.hold_s = 0.8 * self.hold_s + 0.2 * (time.perf_counter() - t0)
+            self.release()
+
+        return done
+
+    @asynccontextmanager
+    async def slot(self, session: str):
+        done = await self.hold(session)
+        try:
+            yield
+        finally:
+            done()
+
+    def expected_wait_s(self) -> float:
+        """Rough time until a newly queued call would start."""
+        return (self.queued // max(self.capacity, 1) + 1) * self.hold_s
+
+
+class AdmissionController:
+    """Per-session token buckets in front of a FairScheduler.
+
+    `rate_per_s` <= 0 disables the per-session limit; `max_queue` <= 0 never refuses
+    for load. Buckets of the `max_sessions` least recently seen sessions are kept.
+    """
+
+    def __init__(self, capacity: int, max_queue: int, rate_per_s: float, burst: float, max_sessions: int = 10000):
+        self.scheduler = FairScheduler(capacity)
+        self.max_queue = max_queue
+        self.rate_per_s = rate_per_s
+        self.burst = burst
+        self.max_sessions = max_sessions
+        self._buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+
+    def _bucket(self, session: str) -> TokenBucket:
+        bucket = self._buckets.get(session)
+        if bucket is None:
+            bucket = self._buckets[session] = TokenBucket(self.rate_per_s, self.burst)
+            if len(self._buckets) > self.max_sessions:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(session)
+        return bucket
+
+    def admit(self, session: str) -> None:
+        """Let a request in or raise AdmissionRejected. Cheap: no waiting happens here."""
+        if self.max_queue > 0 and self.scheduler.queued >= self.max_queue:
+            raise AdmissionRejected("overloaded", self.scheduler.expected_wait_s(), "server busy, retry later")
+        if self.rate_per_s > 0:
+            wait_s = self._bucket(session).try_acquire()
+            if wait_s > 0:
+                raise AdmissionRejected("rate_limited", wait_s, "too many requests for this session, retry later")
+
+    def slot(self, session: str = ""):
+        """Context manager holding one model-call slot (for the current session by default)."""
+        return self.scheduler.slot(session or current_session.get())
+
+    async def hold(self, session: str = "") -> Callable[[], None]:
+        """One model-call slot that outlives the awaiting task; call the returned function to release it."""
+        return await self.scheduler.hold(session or current_session.get())
@@ -0,0 +1,332 @@
+"""Bulk form processing: a worker pool with rate limiting, retries and checkpoints.
+
+`BatchRunner` schedules detection over many documents with bounded concurrency and a
+requests-per-second budget. Transient model errors (429/5xx, connection drops) are
+retried with exponential backoff. Finished documents are appended to a JSONL
+checkpoint, so an interrupted run resumes without reprocessing them.
+
+CLI (runs the server pipeline in-process, needs the same GCP credentials):
+    python batch.py test_documents/ --out results.jsonl --concurrency 8 --rps 2
+    python batch.py scans.zip --out results.jsonl   # re-run the same command to resume
+    python batch.py scans/ --out results.jsonl --render-dir filled/   # also write filled PNGs
+"""
+from typing import Awaitable, Callable, Iterable, Iterator, Optional
+import argparse
+import asyncio
+import functools
+import json
+import os
+import random
+import sys
+import time
+import zipfile
+
+from uploads import IMAGE_MIME_TYPES, UploadRejected, sniff_mime
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp")
+PDF_EXTENSIONS = (".pdf",)
+TRANSIENT_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+
+def is_transient(exc: BaseException) -> bool:
+    """True for errors worth retrying: rate limits, server errors, timeouts and dropped connections."""
+    code = getattr(exc, "code", None) or getattr(exc, "status_code", None)
+    if isinstance(code, int):
+        return code in TRANSIENT_STATUS_CODES
+    # requests' connection errors are OSError subclasses too
+    return isinstance(exc, (TimeoutError, asyncio.TimeoutError, OSError))
+
+
+class TokenBucket:
+    """Async token bucket: `rate` tokens per second, up to `burst` saved up."""
+
+    def __init__(self, rate: float, burst: float = 1.0):
+        self.rate = rate
+        self.burst = max(burst, 1.0)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self) -> float:
+        """Take a token if one is available. Returns 0, or the seconds until one will be."""
+        self._refill()
+        if self._tokens >= 1.0:
+            self._tokens -= 1.0
+            return 0.0
+        return (1.0 - self._tokens) / self.rate
+
+    async def acquire(self) -> None:
+        if self.rate <= 0:
+            return
+        async with self._lock:
+            while True:
+                wait_s = self.try_acquire()
+                if wait_s == 0:
+                    return
+                await asyncio.sleep(wait_s)
+
+
+def load_checkpoint(path: Optional[str]) -> dict:
+    """Results already recorded in a JSONL checkpoint, by document name (last record wins)."""
+    done = {}
+    if not path or not os.path.exists(path):
+        return done
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Truncated last line from an interrupted run
+                continue
+            if isinstance(record, dict) and "name" in record:
+                done[record["name"]] = record
+    return done
+
+
+class BatchRunner:
+    """Run `detect(name, content) -> dict` over many documents.
+
+    Results are kept in `results` (by name) and, when `checkpoint_path` is set, appended
+    to it as JSONL. Documents whose checkpoint record has status "ok" are skipped.
+    """
+
+    def __init__(
+        self,
+        detect: Callable[[str, bytes], Awaitable[dict]],
+        concurrency: int = 4,
+        rate_per_s: float = 0.0,
+        max_attempts: int = 5,
+        backoff_base_s: float = 1.0,
+        backoff_max_s: float = 60.0,
+        checkpoint_path: Optional[str] = None,
+    ):
+        self.detect = detect
+        self.concurrency = max(1, concurrency)
+        self.limiter = TokenBucket(rate_per_s, burst=self.concurrency) if rate_per_s > 0 else None
+        self.max_attempts = max(1, max_attempts)
+        self.backoff_base_s = backoff_base_s
+        self.backoff_max_s = backoff_max_s
+        self.checkpoint_path = checkpoint_path
+        self.results = {name: r for name, r in load_checkpoint(checkpoint_path).items() if r.get("status") == "ok"}
+        self.total = 0
+        self.skipped = len(self.results)
+        self.failed = 0
+        self.errors: list = []
+        self.status = "pending"
+
+    @property
+    def done(self) -> int:
+        return len(self.results)
+
+    def summary(self) -> dict:
+        return {
+            "status": self.status,
+            "total": self.total,
+            "done": self.done,
+            "failed": self.failed,
+            "skipped": self.skipped,
+        }
+
+    async def _run_one(self, name: str, load: Callable[[], bytes]) -> dict:
+        t0 = time.perf_counter()
+        try:
+            # Loaders may read and decompress from disk
+            content = await asyncio.get_running_loop().run_in_executor(None, load)
+        except Exception as e:
+            return {"name": name, "status": "error", "attempts": 0, "error": str(e), "timings_ms": {"total_ms": 0}}
+        attempt = 0
+        while True:
+            attempt += 1
+            if self.limiter is not None:
+                await self.limiter.acquire()
+            try:
+                result = await self.detect(name, content)
+                return {"name": name, "status": "ok", "attempts": attempt, **result}
+            except Exception as e:
+                if attempt >= self.max_attempts or not is_transient(e):
+                    total_ms = int((time.perf_counter() - t0) * 1000)
+                    return {"name": name, "status": "error", "attempts": attempt, "error": str(e), "timings_ms": {"total_ms": total_ms}}
+                # Exponential backoff with full jitter
+                delay = min(self.backoff_max_s, self.backoff_base_s * (2 ** (attempt - 1)))
+                await asyncio.sleep(random.uniform(0, delay))
+
+    def _record(self, record: dict) -> None:
+        if record["status"] == "ok":
+            self.results[record["name"]] = record
+        else:
+            self.failed += 1
+            self.results.pop(record["name"], None)
+            self.errors.append(record)
+        if self.checkpoint_path:
+            with open(self.checkpoint_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+    async def run(self, items: Iterable[tuple[str, Callable[[], bytes]]]) -> None:
+        """Process (name, load_bytes) items. Loading is deferred so large batches stay out of memory."""
+        self.status = "running"
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency * 2)
+
+        async def worker():
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                record = await self._run_one(*item)
+                self._record(record)
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+        try:
+            for name, load in items:
+                self.total += 1
+                if name in self.results:
+                    continue
+                await queue.put((name, load))
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        except BaseException:
+            for w in workers:
+                w.cancel()
+            self.status = "cancelled"
+            raise
+        self.status = "completed"
+
+
+def read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def iter_inputs(path: str, pdf_pages: Optional[Callable[[bytes], list[bytes]]] = None) -> Iterator[tuple[str, Callable[[], bytes]]]:
+    """Yield (name, load_bytes) for images (and PDF pages when pdf_pages is given) in a directory or zip.
+
+    PDF pages are named "<file>#p<n>" (1-based).
+    """
+    def pages_of(name: str, data: bytes):
+        for i, page in enumerate(pdf_pages(data), start=1):
+            yield f"{name}#p{i}", (lambda page=page: page)
+
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as zf:
+            for name in sorted(zf.namelist()):
+                lower = name.lower()
+                if lower.endswith(IMAGE_EXTENSIONS):
+                    # Read now: the archive is closed once the last item has been handed out
+                    data = zf.read(name)
+                    yield name, (lambda data=data: data)
+                elif pdf_pages is not None and lower.endswith(PDF_EXTENSIONS):
+                    yield from pages_of(name, zf.read(name))
+        return
+    for root, _, files in os.walk(path):
+        for fname in sorted(files):
+            full = os.path.join(root, fname)
+            name = os.path.relpath(full, path)
+            lower = fname.lower()
+            if lower.endswith(IMAGE_EXTENSIONS):
+                yield name, functools.partial(read_file, full)
+            elif pdf_pages is not None and lower.endswith(PDF_EXTENSIONS):
+                with open(full, "rb") as f:
+                    yield from pages_of(name, f.read())
+
+
+def write_rendered(render_dir: str, name: str, content: bytes, result: dict) -> str:
+    """Render a detected page filled in (see render.py) to <render_dir>/<name>.png."""
+    from render import render_document
+
+    # "dir/form.pdf#p2" -> "dir_form_p2.png"
+    doc, _, page = name.partition("#")
+    stem = os.path.splitext(doc)[0].replace("/", "_").replace("\\", "_")
+    path = os.path.join(render_dir, f"{stem}_{page}.png" if page else f"{stem}.png")
+    with open(path, "wb") as f:
+        for chunk in render_document(content, False, [result], "png"):
+            f.write(chunk)
+    return path
+
+
+def zip_image_members(path: str, max_member_bytes: int = 0, max_total_bytes: int = 0) -> list[tuple[str, int]]:
+    """(name, uncompressed size) of every image in a zip archive on disk, nothing extracted.
+
+    Members are typed from their magic bytes, not their names. Raises UploadRejected (413)
+    when one image is over `max_member_bytes` or all of them add up to more than
+    `max_total_bytes` uncompressed (0 disables either).
+    """
+    with zipfile.ZipFile(path) as zf:
+        images = []
+        for info in sorted(zf.infolist(), key=lambda info: info.filename):
+            if info.is_dir():
+                continue
+            with zf.open(info) as f:
+                if sniff_mime(f.read(16)) in IMAGE_MIME_TYPES:
+                    images.append((info.filename, info.file_size))
+    largest = max((size for _, size in images), default=0)
+    if max_member_bytes and largest > max_member_bytes:
+        raise UploadRejected(status_code=413, detail=f"zip member expands to {largest} bytes, limit is {max_member_bytes}")
+    total = sum(size for _, size in images)
+    if max_total_bytes and total > max_total_bytes:
+        raise UploadRejected(status_code=413, detail=f"zip archive expands to {total} bytes, limit is {max_total_bytes}")
+    return images
+
+
+def read_zip_member(path: str, name: str) -> bytes:
+    """One member of a zip archive on disk; reads never go past the member's declared size."""
+    with zipfile.ZipFile(path) as zf:
+        return zf.read(name)
+
+
+def main(argv: Optional[list] = None) -> int:
+    parser = argparse.ArgumentParser(description="Detect form fields for a directory or zip of documents.")
+    parser.add_argument("input", help="directory or .zip of images/PDFs")
+    parser.add_argument("--out", required=True, help="JSONL results file; also the resume checkpoint")
+    parser.add_argument("--model", default=None, help="detector model or cascade (default: DEFAULT_DETECTOR)")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--rps", type=float, default=2.0, help="max model requests per second (0 = unlimited)")
+    parser.add_argument("--max-attempts", type=int, default=5)
+    parser.add_argument("--render-dir", default=None, help="also write each filled page as a PNG here")
+    args = parser.parse_args(argv)
+
+    import fastapi_server
+    from image_prep import render_pdf_pages
+
+    model = args.model or fastapi_server.DEFAULT_DETECTOR
+
+    if args.render_dir:
+        os.makedirs(args.render_dir, exist_ok=True)
+
+    async def detect(name: str, content: bytes) -> dict:
+        # Failed documents are retried and resumed, never answered without the model
+        fastapi_server._geometry_fallback.set(False)
+        result = await fastapi_server._detect_page(content, model)
+        if args.render_dir:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, write_rendered, args.render_dir, name, content, result)
+        return result
+
+    runner = BatchRunner(
+        detect,
+        concurrency=args.concurrency,
+        rate_per_s=args.rps,
+        max_attempts=args.max_attempts,
+        checkpoint_path=args.out,
+    )
+    pdf_pages = lambda data: render_pdf_pages(data, fastapi_server.PDF_RENDER_SCALE, max_pixels=fastapi_server.MAX_IMAGE_PIXELS)
+    t0 = time.perf_counter()
+    try:
+        asyncio.run(runner.run(iter_inputs(args.input, pdf_pages=pdf_pages)))
+    except KeyboardInterrupt:
+        print(f"Interrupted; {runner.done} documents checkpointed in {args.out}", file=sys.stderr)
+        return 130
+    elapsed = time.perf_counter() - t0
+    print(json.dumps({**runner.summary(), "elapsed_s": round(elapsed, 2)}))
+    return 1 if runner.failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,516 @@
+"""Offline benchmark for the request pipeline, using the local model stand-in.
+
+Drives the FastAPI app in-process (no network, no GCP credentials) with the stub
+backend from stub_backend.py, at several concurrency levels, and reports per route:
+throughput, p50/p95/p99 latency and peak RSS growth per in-flight request. The result
+cache and layout template index are disabled so every request exercises the full
+path, and admission control keeps only the in-flight budget. Output is JSON, and
+--baseline fails the run on regressions so CI can track our own code path.
+
+    python bench.py --out bench.json
+    python bench.py --latency-ms 0 --concurrency 1,8,32 --baseline bench.json
+    python bench.py --micro     # box post-processing only, 1,000-field pages
+    python bench.py --startup --out startup.json   # cold start: fresh processes
+    python bench.py --geometry --fixtures stub_fixtures   # geometric detector vs the model
+
+--startup measures what a scale-from-zero instance pays, in fresh processes: the
+import time of fastapi_server, and the time from launching uvicorn to the first `/`
+response and to the first /api/form/detect answer (stub backend, so credentials and
+the network are not part of it). Each value is the median over --runs launches.
+
+--geometry measures the geometric detector (geometry.py) on the pages: latency, and
+recall/precision of its boxes against reference fields (IoU >= 0.5). References are
+the recorded model answers in --fixtures; without any, synthetic pages are used with
+the fields they are drawn with.
+
+Pages come from test_documents/ when present (synthetic pages otherwise). To replay
+real model answers instead of synthetic fields, record them once with credentials:
+    DETECTOR_BACKEND=record STUB_FIXTURES_DIR=stub_fixtures python batch.py test_documents/ --out /tmp/rec.jsonl
+and pass --fixtures stub_fixtures.
+"""
+from typing import Optional
+import argparse
+import asyncio
+import io
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+from observability import process_rss_bytes
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ROUTES = {
+    "detect": "/api/form/detect",
+    "draw_boxes": "/api/form/draw_boxes",
+    "detect_stream": "/api/form/detect_stream",
+}
+
+
+def _synthetic_rows(size) -> list:
+    return list(enumerate(range(120, size[1] - 80, 60)))
+
+
+def synthetic_page(index: int, size=(1224, 1584)) -> bytes:
+    """A blank form-like page (labels and underlines), PNG encoded."""
+    from PIL import Image, ImageDraw
+
+    img = Image.new("RGB", size, "white")
+    draw = ImageDraw.Draw(img)
+    for row, y in _synthetic_rows(size):
+        draw.text((80, y - 18), f"Field {index}.{row}", fill="black")
+        draw.line([(260, y), (size[0] - 120, y)], fill="black", width=2)
+        if row % 4 == 0:
+            draw.rectangle([(size[0] - 100, y - 20), (size[0] - 80, y)], outline="black", width=2)
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def synthetic_page_fields(size=(1224, 1584)):
+    """The writable areas synthetic_page draws, as Fields: the band above each underline, and the checkboxes."""
+    import numpy as np
+    from fields import Fields
+
+    boxes = []
+    for row, y in _synthetic_rows(size):
+        boxes.append([y - 30, 260, y, size[0] - 120])
+        if row % 4 == 0:
+            boxes.append([y - 20, size[0] - 100, y, size[0] - 80])
+    scale = 1000 / np.array([size[1], size[0], size[1], size[0]], dtype=np.float64)
+    return Fields(np.array(boxes, dtype=np.float64) * scale, [""] * len(boxes))
+
+
+def load_documents(docs_dir: str, limit: int = 8) -> list:
+    docs = []
+    if os.path.isdir(docs_dir):
+        for name in sorted(os.listdir(docs_dir)):
+            if name.lower().endswith((".png", ".jpg", ".jpeg")):
+                with open(os.path.join(docs_dir, name), "rb") as f:
+                    docs.append((name, f.read()))
+            if len(docs) >= limit:
+                break
+    if not docs:
+        docs = [(f"synthetic{i}.png", synthetic_page(i)) for i in range(3)]
+    return docs
+
+
+def percentile(sorted_values: list, pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(pct / 100 * len(sorted_values))))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+class RssSampler:
+    """Track peak RSS on a background thread while a benchmark level runs."""
+
+    def __init__(self, interval_s: float = 0.002):
+        self.interval_s = interval_s
+        self.baseline = 0
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def __enter__(self):
+        self.baseline = self.peak = process_rss_bytes()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval_s):
+            self.peak = max(self.peak, process_rss_bytes())
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, process_rss_bytes())
+
+
+async def _request(client, route: str, name: str, data: bytes, csrf: str) -> None:
+    files = {"file": (name, data, "image/png")}
+    headers = {"x-csrf-token": csrf}
+    if route == ROUTES["detect_stream"]:
+        async with client.stream("POST", route, files=files, headers=headers) as r:
+            async for line in r.aiter_lines():
+                if '"type":"error"' in line:
+                    raise RuntimeError(line)
+        return
+    r = await client.post(route, files=files, headers=headers)
+    if r.status_code != 200 or "error" in r.json():
+        raise RuntimeError(f"{route} failed: {r.status_code} {r.text[:200]}")
+
+
+async def run_level(client, route: str, docs: list, concurrency: int, requests: int, csrf: str) -> dict:
+    latencies = []
+    slots = asyncio.Semaphore(concurrency)
+
+    async def one(i: int):
+        name, data = docs[i % len(docs)]
+        async with slots:
+            t0 = time.perf_counter()
+            await _request(client, route, name, data, csrf)
+            latencies.append((time.perf_counter() - t0) * 1000)
+
+    with RssSampler() as rss:
+        t0 = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(requests)))
+        wall_s = time.perf_counter() - t0
+    latencies.sort()
+    rss_delta = max(0, rss.peak - rss.baseline)
+    return {
+        "concurrency": concurrency,
+        "requests": requests,
+        "throughput_rps": round(requests / wall_s, 2),
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50), 2),
+            "p95": round(percentile(latencies, 95), 2),
+            "p99": round(percentile(latencies, 99), 2),
+            "max": round(latencies[-1], 2),
+        },
+        "rss_peak_delta_bytes": rss_delta,
+        "rss_per_inflight_bytes": rss_delta // concurrency,
+    }
+
+
+async def run_benchmark(routes: list, levels: list, requests: int, latency_ms: float, fields: int,
+                        fixtures_dir: Optional[str], docs_dir: str) -> dict:
+    try:
+        import httpx
+    except Exception as exc:  # pragma: no cover
+        raise RuntimeError("httpx is required for the benchmark. pip install httpx") from exc
+    import fastapi_server
+    from layout_index import TemplateIndex
+    from result_cache import ResultCache
+    from stub_backend import StubClient
+
+    from admission import AdmissionController
+
+    saved = (fastapi_server.DETECTOR_BACKEND, fastapi_server._client, fastapi_server._result_cache, fastapi_server._template_index,
+             fastapi_server._admission)
+    fastapi_server.DETECTOR_BACKEND = "stub"
+    fastapi_server._client = StubClient(fixtures_dir=fixtures_dir, latency_ms=latency_ms, fields=fields)
+    # Measure the full path on every request
+    fastapi_server._result_cache = ResultCache(max_bytes=0, ttl_s=0)
+    fastapi_server._template_index = TemplateIndex(0, 0.0, 0.0)
+    # One client session drives every level: keep the in-flight budget, drop the per-session and queue limits
+    fastapi_server._admission = AdmissionController(fastapi_server.MAX_INFLIGHT_INFERENCES, 0, 0.0, 1.0)
+
+    docs = load_documents(docs_dir)
+    results = {}
+    transport = httpx.ASGITransport(app=fastapi_server.app)
+    try:
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            await client.get("/")
+            csrf = client.cookies["_csrf"]
+            # Warm-up: imports, thread pools, first PIL decode
+            await _request(client, ROUTES[routes[0]], *docs[0], csrf)
+            for route in routes:
+                results[route] = [
+                    await run_level(client, ROUTES[route], docs, level, max(requests, level), csrf)
+                    for level in levels
+                ]
+    finally:
+        (fastapi_server.DETECTOR_BACKEND, fastapi_server._client, fastapi_server._result_cache,
+         fastapi_server._template_index, fastapi_server._admission) = saved
+    return {
+        "config": {
+            "stub_latency_ms": latency_ms,
+            "stub_fields": fields,
+            "fixtures_dir": fixtures_dir,
+            "documents": [name for name, _ in docs],
+            "python": platform.python_version(),
+            "cpu_count": os.cpu_count(),
+        },
+        "routes": results,
+    }
+
+
+def _stub_env(latency_ms: float) -> dict:
+    env = dict(os.environ, DETECTOR_BACKEND="stub", STUB_LATENCY_MS=str(latency_ms), PYTHONDONTWRITEBYTECODE="1")
+    env.pop("RESULT_CACHE_DB", None)
+    env.pop("TEMPLATE_INDEX_DB", None)
+    return env
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _import_ms(env: dict) -> float:
+    code = "import time; t0 = time.perf_counter(); import fastapi_server; print((time.perf_counter() - t0) * 1000)"
+    out = subprocess.run([sys.executable, "-c", code], cwd=BASE_DIR, env=env, capture_output=True, text=True, check=True)
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+def _launch_ms(env: dict, page: bytes, timeout_s: float = 60.0) -> tuple:
+    """Start uvicorn and return ms from launch to the first `/` response and to the first detect answer."""
+    import httpx
+
+    port = _free_port()
+    t0 = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "fastapi_server:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=BASE_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        with httpx.Client(base_url=f"http://127.0.0.1:{port}", timeout=timeout_s) as client:
+            while True:
+                if proc.poll() is not None:
+                    raise RuntimeError(f"server exited with code {proc.returncode}")
+                if time.perf_counter() - t0 > timeout_s:
+                    raise RuntimeError("server did not start")
+                try:
+                    r = client.get("/")
+                    break
+                except httpx.TransportError:
+                    time.sleep(0.005)
+            root_ms = (time.perf_counter() - t0) * 1000
+            if r.status_code != 200:
+                raise RuntimeError(f"/ failed: {r.status_code}")
+            r = client.post(
+                ROUTES["detect"], files={"file": ("page.png", page, "image/png")}, headers={"x-csrf-token": client.cookies["_csrf"]}
+            )
+            detect_ms = (time.perf_counter() - t0) * 1000
+            if r.status_code != 200 or "error" in r.json():
+                raise RuntimeError(f"detect failed: {r.status_code} {r.text[:200]}")
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+    return root_ms, detect_ms
+
+
+def run_startup(runs: int = 5, latency_ms: float = 0.0) -> dict:
+    """Median cold-start timings over `runs` fresh processes (see the module docstring)."""
+    env = _stub_env(latency_ms)
+    page = synthetic_page(0)
+    samples = {"import_ms": [], "first_root_ms": [], "first_detect_ms": []}
+    for _ in range(runs):
+        samples["import_ms"].append(_import_ms(env))
+        root_ms, detect_ms = _launch_ms(env, page)
+        samples["first_root_ms"].append(root_ms)
+        samples["first_detect_ms"].append(detect_ms)
+    return {
+        "config": {"runs": runs, "stub_latency_ms": latency_ms, "python": platform.python_version(), "cpu_count": os.cpu_count()},
+        "startup": {name: round(statistics.median(values), 1) for name, values in samples.items()},
+    }
+
+
+def match_boxes(found, reference, min_iou: float = 0.5) -> tuple:
+    """(reference boxes matched, found boxes matched): pairs with IoU >= min_iou, in 0-1000 space."""
+    import numpy as np
+
+    a, b = found.boxes.astype(np.float64), reference.boxes.astype(np.float64)
+    if not len(a) or not len(b):
+        return 0, 0
+    inter_h = np.clip(np.minimum(a[:, None, 2], b[None, :, 2]) - np.maximum(a[:, None, 0], b[None, :, 0]), 0, None)
+    inter_w = np.clip(np.minimum(a[:, None, 3], b[None, :, 3]) - np.maximum(a[:, None, 1], b[None, :, 1]), 0, None)
+    inter = inter_h * inter_w
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    iou = inter / np.maximum(area_a[:, None] + area_b[None, :] - inter, 1e-9)
+    hits = iou >= min_iou
+    return int(hits.any(axis=0).sum()), int(hits.any(axis=1).sum())
+
+
+def _fixture_fields(fixtures_dir: str, model_input: bytes):
+    """The recorded model answer for a page (keyed like the stub backend), or None."""
+    import hashlib
+    from fields import Fields
+
+    path = os.path.join(fixtures_dir, f"{hashlib.sha256(model_input).hexdigest()}.json")
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return Fields.from_model_output(json.load(f)).postprocess()
+
+
+def run_geometry(docs_dir: str, fixtures_dir: Optional[str], runs: int = 5) -> dict:
+    """Latency and recall/precision of the geometric detector (see the module docstring)."""
+    import fastapi_server
+    from geometry import detect_fields
+    from image_prep import prepare_image
+
+    pages = []  # (name, model input bytes, reference Fields)
+    for name, content in load_documents(docs_dir, limit=1000):
+        if not fixtures_dir:
+            break
+        # The detector runs on what the model sees, as in the server
+        data = prepare_image(content, fastapi_server.IMAGE_MAX_LONG_EDGE, fastapi_server.IMAGE_PREP_FORMAT,
+                             fastapi_server.IMAGE_PREP_QUALITY).data
+        reference = _fixture_fields(fixtures_dir, data)
+        if reference is not None:
+            pages.append((name, data, reference))
+    source = "fixtures"
+    if not pages:
+        source = "synthetic"
+        pages = [(f"synthetic{i}.png", synthetic_page(i), synthetic_page_fields()) for i in range(3)]
+
+    latencies, found_total, reference_total, reference_hits, found_hits = [], 0, 0, 0, 0
+    for name, data, reference in pages:
+        detect_fields(data)  # warm-up
+        samples = []
+        for _ in range(runs):
+            t0 = time.perf_counter()
+            found = detect_fields(data)
+            samples.append((time.perf_counter() - t0) * 1000)
+        latencies.append(statistics.median(samples))
+        found = found.postprocess()
+        ref_hit, found_hit = match_boxes(found, reference)
+        reference_total += len(reference)
+        found_total += len(found)
+        reference_hits += ref_hit
+        found_hits += found_hit
+    latencies.sort()
+    return {
+        "config": {"reference": source, "documents": [name for name, _, _ in pages], "runs": runs,
+                   "python": platform.python_version(), "cpu_count": os.cpu_count()},
+        "geometry": {
+            "recall": round(reference_hits / max(reference_total, 1), 3),
+            "precision": round(found_hits / max(found_total, 1), 3),
+            "latency_ms": {"p50": round(percentile(latencies, 50), 2), "p95": round(percentile(latencies, 95), 2)},
+        },
+    }
+
+
+def _legacy_postprocess(entries: list, width: int, small_box_px: int) -> tuple:
+    """The per-field loop the routes used before fields.Fields, kept as the micro-benchmark reference."""
+    boxes, texts = [], []
+    for item in entries:
+        box = item.get("box_2d")
+        if not (isinstance(box, list) and len(box) == 4):
+            continue
+        y0, x0, y1, x1 = (min(1000, max(0, int(round(v)))) for v in box)
+        y0, y1 = min(y0, y1), max(y0, y1)
+        x0, x1 = min(x0, x1), max(x0, x1)
+        if y1 <= y0 or x1 <= x0:
+            continue
+        width_px = int((x1 - x0) / 1000 * width)
+        boxes.append({"box_2d": [y0, x0, y1, x1]})
+        texts.append("x" if width_px <= small_box_px else item.get("text") or "")
+    return boxes, texts
+
+
+def run_micro(fields: int = 1000, pages: int = 50, width: int = 1224) -> dict:
+    """Time box post-processing alone: the legacy per-field loop versus the vectorized Fields pass."""
+    from fields import Fields
+    from stub_backend import synthetic_fields
+    import fastapi_server
+
+    threshold = fastapi_server.SMALL_BOX_PX_THRESHOLD
+    raw = [synthetic_fields(f"micro{i}", fields) for i in range(pages)]
+
+    def legacy():
+        for data in raw:
+            entries = [e for e in (fastapi_server.normalize_entry(d) for d in data) if e is not None]
+            _legacy_postprocess(entries, width, threshold)
+
+    def vectorized():
+        for data in raw:
+            fastapi_server._filter_fields(Fields.from_model_output(data), width)
+
+    report = {"fields_per_page": fields, "pages": pages}
+    for name, fn in (("legacy_loop", legacy), ("vectorized", vectorized)):
+        fn()  # warm-up
+        samples = []
+        for _ in range(5):
+            t0 = time.perf_counter()
+            fn()
+            samples.append((time.perf_counter() - t0) * 1000 / pages)
+        report[name] = {"ms_per_page": round(min(samples), 3)}
+    report["speedup"] = round(report["legacy_loop"]["ms_per_page"] / max(report["vectorized"]["ms_per_page"], 1e-9), 2)
+    return report
+
+
+def compare(current: dict, baseline: dict, tolerance: float) -> list:
+    """Regressions of p95 latency or throughput beyond `tolerance` (fraction) versus a baseline run."""
+    regressions = []
+    for route, levels in current.get("routes", {}).items():
+        base_levels = {lvl["concurrency"]: lvl for lvl in baseline.get("routes", {}).get(route, [])}
+        for lvl in levels:
+            base = base_levels.get(lvl["concurrency"])
+            if base is None:
+                continue
+            p95, base_p95 = lvl["latency_ms"]["p95"], base["latency_ms"]["p95"]
+            if base_p95 > 0 and p95 > base_p95 * (1 + tolerance):
+                regressions.append(f"{route} c={lvl['concurrency']}: p95 {p95}ms vs {base_p95}ms")
+            rps, base_rps = lvl["throughput_rps"], base["throughput_rps"]
+            if rps < base_rps * (1 - tolerance):
+                regressions.append(f"{route} c={lvl['concurrency']}: throughput {rps}/s vs {base_rps}/s")
+    for name, value in current.get("startup", {}).items():
+        base = baseline.get("startup", {}).get(name)
+        if base and value > base * (1 + tolerance):
+            regressions.append(f"startup {name}: {value}ms vs {base}ms")
+    geometry, base_geometry = current.get("geometry"), baseline.get("geometry")
+    if geometry and base_geometry:
+        p95, base_p95 = geometry["latency_ms"]["p95"], base_geometry["latency_ms"]["p95"]
+        if base_p95 > 0 and p95 > base_p95 * (1 + tolerance):
+            regressions.append(f"geometry: p95 {p95}ms vs {base_p95}ms")
+        # Recall is compared in points, not relative to the baseline
+        if geometry["recall"] < base_geometry["recall"] - 0.02:
+            regressions.append(f"geometry: recall {geometry['recall']} vs {base_geometry['recall']}")
+    return regressions
+
+
+def main(argv: Optional[list] = None) -> int:
+    parser = argparse.ArgumentParser(description="Offline throughput/latency/memory benchmark with a stub model.")
+    parser.add_argument("--routes", default="detect,draw_boxes", help=f"comma-separated, from {','.join(ROUTES)}")
+    parser.add_argument("--concurrency", default="1,4,16", help="comma-separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=64, help="requests per level")
+    parser.add_argument("--latency-ms", type=float, default=200.0, help="simulated model latency")
+    parser.add_argument("--fields", type=int, default=None, help="synthetic fields per page (default 40, 1000 with --micro)")
+    parser.add_argument("--fixtures", default=None, help="directory of recorded model answers")
+    parser.add_argument("--docs", default=os.path.join(BASE_DIR, "test_documents"))
+    parser.add_argument("--out", default=None, help="write JSON here instead of stdout")
+    parser.add_argument("--baseline", default=None, help="previous JSON result to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.25, help="allowed fractional regression")
+    parser.add_argument("--micro", action="store_true", help="only benchmark box post-processing")
+    parser.add_argument("--startup", action="store_true", help="only benchmark cold start (import, first /, first detect)")
+    parser.add_argument("--runs", type=int, default=5, help="fresh processes per --startup measurement, timed runs per page with --geometry")
+    parser.add_argument("--geometry", action="store_true", help="only benchmark the geometric detector (latency, recall vs --fixtures)")
+    args = parser.parse_args(argv)
+
+    if args.micro:
+        print(json.dumps(run_micro(args.fields or 1000), indent=2))
+        return 0
+
+    if args.startup:
+        # Model latency would only add a constant to first_detect_ms
+        report = run_startup(args.runs, 0.0)
+    elif args.geometry:
+        report = run_geometry(args.docs, args.fixtures, args.runs)
+    else:
+        routes = [r.strip() for r in args.routes.split(",") if r.strip()]
+        unknown = [r for r in routes if r not in ROUTES]
+        if unknown:
+            parser.error(f"unknown routes: {', '.join(unknown)}")
+        levels = [int(c) for c in args.concurrency.split(",") if c.strip()]
+        report = asyncio.run(run_benchmark(routes, levels, args.requests, args.latency_ms, args.fields or 40, args.fixtures, args.docs))
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = compare(report, json.load(f), args.max_regression)
+        for line in regressions:
+            print(f"REGRESSION: {line}", file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,62 @@
+"""Quality check for the fast-model-first detection cascade.
+
+In cascade mode a page is detected with the fast model first, and its raw output
+(before post-filtering) is scored here. Pages that fail go on to the stronger model:
+- no_boxes: fewer than `min_boxes` fields
+- out_of_range: too many boxes outside 0-1000, non-finite or with zero area
+- overlap: too many boxes that mostly cover another box (duplicated or merged fields)
+- empty_text: too many fields without a fake value
+"""
+from dataclasses import dataclass
+
+import numpy as np
+
+from fields import NORMALIZED_SCALE, Fields
+
+# Above this intersection-over-smaller-box ratio two boxes count as overlapping
+_OVERLAP_RATIO = 0.6
+
+
+@dataclass
+class CascadePolicy:
+    min_boxes: int = 1
+    max_out_of_range: float = 0.02
+    max_overlap: float = 0.1
+    max_empty_text: float = 0.5
+
+
+def _overlapping(boxes: np.ndarray) -> np.ndarray:
+    """Per box: whether it overlaps another box by more than _OVERLAP_RATIO of the smaller one."""
+    y0 = np.maximum(boxes[:, None, 0], boxes[None, :, 0])
+    x0 = np.maximum(boxes[:, None, 1], boxes[None, :, 1])
+    y1 = np.minimum(boxes[:, None, 2], boxes[None, :, 2])
+    x1 = np.minimum(boxes[:, None, 3], boxes[None, :, 3])
+    inter = np.clip(y1 - y0, 0, None) * np.clip(x1 - x0, 0, None)
+    area = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    smaller = np.minimum(area[:, None], area[None, :])
+    ratio = np.divide(inter, smaller, out=np.zeros_like(inter), where=smaller > 0)
+    np.fill_diagonal(ratio, 0)
+    return (ratio > _OVERLAP_RATIO).any(axis=1)
+
+
+def escalation_reasons(fields: Fields, policy: CascadePolicy) -> list:
+    """Why this fast-model result should be re-detected with the stronger model; empty when it passes."""
+    n = len(fields)
+    if n < policy.min_boxes:
+        return ["no_boxes"]
+    if n == 0:
+        return []
+    reasons = []
+    b = fields.boxes
+    finite = np.isfinite(b).all(axis=1)
+    bf = np.where(np.isfinite(b), b, -1.0)
+    in_range = finite & ((bf >= 0) & (bf <= NORMALIZED_SCALE)).all(axis=1)
+    valid = in_range & (bf[:, 2] > bf[:, 0]) & (bf[:, 3] > bf[:, 1])
+    if 1 - valid.mean() > policy.max_out_of_range:
+        reasons.append("out_of_range")
+    if valid.sum() > 1 and _overlapping(bf[valid]).mean() > policy.max_overlap:
+        reasons.append("overlap")
+    empty = np.fromiter((not str(t).strip() for t in fields.texts), dtype=bool, count=n)
+    if empty.mean() > policy.max_empty_text:
+        reasons.append("empty_text")
+    return reasons
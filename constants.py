@@ -1,3 +1,7 @@
 # Shared constants for server and tests
 MODEL_NAME = "gemini-2.5-pro"
 # MODEL_NAME = "gemini-2.5-flash-lite"
+# Detector pseudo-model: the fast model first, the strong model only for pages that fail the quality check
+CASCADE_MODEL = "cascade"
+# Detector pseudo-model: printed lines and boxes found geometrically, no model call (geometry.py)
+GEOMETRY_MODEL = "geometry"
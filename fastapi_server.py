@@ -1,112 +1,882 @@
-from fastapi import FastAPI, UploadFile, File, Query, Request, Depends, HTTPException
-from fastapi.responses import JSONResponse, FileResponse, Response
-from fastapi.staticfiles import StaticFiles
-from PIL import Image, ImageDraw
+from fastapi import FastAPI, UploadFile, File, Form, Query, Request, Depends, HTTPException
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from PIL import Image
+import asyncio
+import functools
 import io
 import json
 import os
+import re
 import time
 import secrets
+import tempfile
 import hmac
 import hashlib
+import threading
 import urllib.parse
+from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
 load_dotenv()
 
-try:
-    from google import genai
-    from google.genai.types import GenerateContentConfig, Part
-except Exception:
-    genai = None
-    GenerateContentConfig = None
-    Part = None
+from constants import CASCADE_MODEL, GEOMETRY_MODEL, MODEL_NAME
+from admission import AdmissionController, AdmissionRejected, current_session
+from cascade import CascadePolicy, escalation_reasons
+from geometry import detect_fields
+from result_cache import ResultCache, cache_key
+from image_prep import check_pdf_pages, oriented_size, prepare_image, render_pdf_pages
+from json_stream import JsonArrayStream
+from fields import Fields, normalize_entry
+from layout_index import TemplateIndex, layout_fingerprint
+from render import FONT_FILES, FONTS_DIR, render_document
+from tiling import cut_region, cut_tiles, merge_tiles, new_in_region, plan_tiles, tile_to_page
+from static_assets import (
+    ENTRY_CACHE_CONTROL,
+    ENTRY_PAGE,
+    IMMUTABLE_CACHE_CONTROL,
+    REVALIDATE_CACHE_CONTROL,
+    AssetStore,
+    negotiate,
+    not_modified,
+)
+from uploads import (
+    IMAGE_MIME_TYPES,
+    PDF_MIME_TYPE,
+    ZIP_MIME_TYPE,
+    Upload,
+    UploadLimitMiddleware,
+    UploadRejected,
+    read_upload,
+    set_spool_threshold,
+)
+from batch import TRANSIENT_STATUS_CODES, BatchRunner, read_file, read_zip_member, zip_image_members
+from stub_backend import RecordingClient, stub_client_from_env
+from observability import (
+    ADMISSION_REJECTIONS,
+    ERRORS,
+    INFERENCES_IN_FLIGHT,
+    MODEL_CALLS_QUEUED,
+    RequestContextMiddleware,
+    log_event,
+    observe_timings,
+    render_metrics,
+)
 
-from constants import MODEL_NAME
 
-app = FastAPI()
+def _warm_up() -> None:
+    """Import the model SDK and create the shared client ahead of the first upload.
+
+    Failures are not fatal: the client is created lazily on first use as well.
+    """
+    t0 = time.perf_counter()
+    _static_assets.load()
+    try:
+        _import_sdk()
+        _get_client()
+    except Exception as e:
+        log_event("model client warm-up failed", severity="WARNING", error=str(e))
+        return
+    log_event("model client warm-up done", warm_up_ms=int((time.perf_counter() - t0) * 1000))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Warm up in the background rather than before serving: with min-instances=0 the
+    # first request is often the UI itself, which needs neither the SDK nor credentials.
+    # A detect request arriving meanwhile waits on _sdk_lock/_client_lock instead of racing it.
+    asyncio.get_running_loop().run_in_executor(_inference_executor, _warm_up)
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
 
 # NOTE: Do NOT enable permissive CORS. Since frontend and backend
 # are served from the same origin, same-origin requests do not need CORS.
 
-# Serve local fonts (e.g., Satisfy.ttf) under /fonts
-if os.path.isdir("fonts"):
-    app.mount("/fonts", StaticFiles(directory="fonts"), name="fonts")
+# Upload limits: bodies over MAX_UPLOAD_BYTES (MAX_BATCH_UPLOAD_BYTES for batch jobs) get a 413
+# before they are parsed; file parts over UPLOAD_SPOOL_BYTES are spooled to a temp file, and
+# images over MAX_IMAGE_PIXELS are refused from their header, before any decode (PDF pages
+# from their size at PDF_RENDER_SCALE, before any is rasterized).
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", str(25 * 1024 * 1024)))
+# A batch job keeps its uploads in a temp dir until it finishes (memory on Cloud Run, see README)
+MAX_BATCH_UPLOAD_BYTES = int(os.environ.get("MAX_BATCH_UPLOAD_BYTES", str(100 * 1024 * 1024)))
+UPLOAD_SPOOL_BYTES = int(os.environ.get("UPLOAD_SPOOL_BYTES", str(1024 * 1024)))
+MAX_IMAGE_PIXELS = int(os.environ.get("MAX_IMAGE_PIXELS", str(60_000_000)))
 
+set_spool_threshold(UPLOAD_SPOOL_BYTES)
+app.add_middleware(UploadLimitMiddleware, max_bytes=MAX_UPLOAD_BYTES, limits={"/api/batch/jobs": MAX_BATCH_UPLOAD_BYTES})
 
-def _get_client():
-    if genai is None:
-        raise RuntimeError("google-genai is not installed. pip install google-genai")
-    project = os.environ.get("GCP_PROJECT", "")
-    location = os.environ.get("GCP_LOCATION", "europe-west9")
-    return genai.Client(vertexai=True, project=project, location=location)
+# Request IDs, in-flight gauges and per-route request metrics. Unlisted paths are labelled "other".
+# Added last so it is outermost and also counts requests refused by the upload limit.
+app.add_middleware(
+    RequestContextMiddleware,
+    routes=[
+        "/",
+        "/api/health",
+        "/api/form/detect",
+        "/api/form/detect_stream",
+        "/api/form/detect_document",
+        "/api/form/detect_region",
+        "/api/form/draw_boxes",
+        "/api/form/render",
+        "/api/batch/jobs",
+        "/metrics",
+    ],
+)
 
+@app.exception_handler(UploadRejected)
+async def upload_rejected(request: Request, exc: UploadRejected):
+    return JSONResponse({"error": exc.detail}, status_code=exc.status_code)
+
+
+@app.exception_handler(AdmissionRejected)
+async def admission_rejected(request: Request, exc: AdmissionRejected):
+    ADMISSION_REJECTIONS.inc(route=request.url.path, reason=exc.reason)
+    return JSONResponse({"error": exc.detail}, status_code=exc.status_code, headers=exc.headers)
+
+
+async def _read_upload(file: UploadFile, allowed) -> Upload:
+    """Validate an upload (magic bytes, image header) and read it into the one buffer the request uses."""
+    return await run_in_threadpool(read_upload, file, allowed, MAX_IMAGE_PIXELS)
 
-def _detect_and_fake(image_bytes: bytes, mime_type: str, model: str):
-    """Single Gemini call that returns both boxes and fake text per box.
 
-    The model is instructed to omit very small boxes (checkboxes etc.). We also post-filter on server.
-    Expected model JSON: [ {"box_2d": [y_min,x_min,y_max,x_max], "text": "..."}, ... ]
+# The UI page and the files it links to, served from memory with ETags and precompressed
+# variants (see static_assets.py). Local fonts (e.g., Satisfy.ttf) are served under /fonts.
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+_font_files = sorted(os.listdir(FONTS_DIR)) if os.path.isdir(FONTS_DIR) else []
+_static_assets = AssetStore(BASE_DIR, [ENTRY_PAGE, "logo.png", "dev-preload.jpg"] + [f"fonts/{name}" for name in _font_files])
+
+
+def _static_response(request: Request, path: str, cache_control: str = "") -> Response:
+    """Serve a stored asset: 304 when the client's copy is current, else the best accepted encoding.
+
+    Content-hashed URLs (?v= matching the asset) are immutable; anything else revalidates.
     """
+    asset = _static_assets.get(path)
+    if asset is None:
+        raise HTTPException(status_code=404, detail="not found")
+    if not cache_control:
+        versioned = request.query_params.get("v") == asset.version
+        cache_control = IMMUTABLE_CACHE_CONTROL if versioned else REVALIDATE_CACHE_CONTROL
+    headers = {
+        "ETag": asset.etag,
+        "Last-Modified": asset.last_modified,
+        "Cache-Control": cache_control,
+        "Vary": "Accept-Encoding",
+    }
+    if not_modified(asset, request.headers.get("if-none-match"), request.headers.get("if-modified-since")):
+        return Response(status_code=304, headers=headers)
+    encoding = negotiate(asset, request.headers.get("accept-encoding"))
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return Response(asset.bodies[encoding], media_type=asset.media_type, headers=headers)
+
+
+CLOUD_PLATFORM_SCOPE = "https://www.googleapis.com/auth/cloud-platform"
+
+# Process-wide model client, created once and shared by all requests
+_client = None
+_client_credentials = None
+_client_lock = threading.Lock()
+# Reused for token refreshes so they go over a kept-alive connection
+_auth_request = None
+# The google.genai module, once imported by _import_sdk
+_genai = None
+_sdk_lock = threading.Lock()
+
+
+# Model backend: "gemini" (Vertex AI), "stub" (offline canned answers) or "record"
+# (Vertex AI, saving responses for the stub to replay); see stub_backend.py
+DETECTOR_BACKEND = os.environ.get("DETECTOR_BACKEND", "gemini")
+
+
+def _import_sdk():
+    """Import google-genai and google-auth once and return the genai module.
+
+    Imported here, not at module level: they are about half of this module's import time,
+    which every cold start would pay. Every import goes through this lock: threads importing
+    google.genai concurrently (warm-up and a first request) can see its modules half initialized.
+    """
+    global _genai
+    with _sdk_lock:
+        if _genai is None:
+            try:
+                import google.auth  # noqa: F401
+                import google.auth.transport.requests  # noqa: F401
+                from google import genai
+                from google.genai import errors, types  # noqa: F401  (used by _detect_request, _fallback_reason)
+            except Exception as exc:
+                raise RuntimeError("google-genai is not installed. pip install google-genai") from exc
+            _genai = genai
+        return _genai
+
+
+def _get_client():
+    """Return the shared model client, creating it on first use and refreshing expired credentials."""
+    global _client, _client_credentials, _auth_request
+    with _client_lock:
+        if _client is None and DETECTOR_BACKEND == "stub":
+            _client = stub_client_from_env()
+        if _client is None:
+            genai = _import_sdk()
+            import google.auth  # already loaded by _import_sdk
+            import google.auth.transport.requests
+
+            project = os.environ.get("GCP_PROJECT", "")
+            location = os.environ.get("GCP_LOCATION", "europe-west9")
+            credentials, default_project = google.auth.default(scopes=[CLOUD_PLATFORM_SCOPE])
+            _auth_request = google.auth.transport.requests.Request()
+            _client = genai.Client(
+                vertexai=True,
+                project=project or default_project,
+                location=location,
+                credentials=credentials,
+            )
+            _client_credentials = credentials
+            if DETECTOR_BACKEND == "record":
+                _client = RecordingClient(_client, os.environ.get("STUB_FIXTURES_DIR") or "stub_fixtures")
+        if _client_credentials is not None and not _client_credentials.valid:
+            # Refresh here rather than inside the model call so it shows up in client_init_ms
+            _client_credentials.refresh(_auth_request)
+        return _client
+
+
+# Model names used as metric labels; anything else is reported as "other"
+METRIC_MODELS = {MODEL_NAME, CASCADE_MODEL, GEOMETRY_MODEL, "gemini-2.5-pro", "gemini-2.5-flash", "gemini-2.5-flash-lite"}
+
+
+def _metric_model(model: str) -> str:
+    return model if model in METRIC_MODELS else "other"
+
+
+def _observe(route: str, model: str, timings: dict, boxes=None) -> None:
+    observe_timings(route, _metric_model(model), timings, boxes)
+
+
+def _record_error(route: str, e: Exception, **fields) -> None:
+    ERRORS.inc(route=route, kind=type(e).__name__)
+    log_event(f"ERROR in {route}", severity="ERROR", exc=e, route=route, **fields)
+
+
+# Max number of model calls in flight per instance; extra calls wait in a queue that is
+# served round-robin across sessions (see admission.py)
+MAX_INFLIGHT_INFERENCES = int(os.environ.get("MAX_INFLIGHT_INFERENCES", "32"))
+# Model calls allowed to wait before new requests get 429 (0: never refuse)
+ADMISSION_MAX_QUEUE = int(os.environ.get("ADMISSION_MAX_QUEUE", str(4 * MAX_INFLIGHT_INFERENCES)))
+# Per-session token bucket for the model routes (requests per second, burst); rate 0 disables
+SESSION_RATE_PER_S = float(os.environ.get("SESSION_RATE_PER_S", "1"))
+SESSION_BURST = float(os.environ.get("SESSION_BURST", "20"))
+
+# The genai client is blocking, so calls run on a dedicated pool sized to the in-flight
+# limit (the default executor is sized from the CPU count, i.e. tiny on Cloud Run).
+_inference_executor = ThreadPoolExecutor(max_workers=MAX_INFLIGHT_INFERENCES, thread_name_prefix="inference")
+_admission = AdmissionController(MAX_INFLIGHT_INFERENCES, ADMISSION_MAX_QUEUE, SESSION_RATE_PER_S, SESSION_BURST)
+
+
+def _generate_content(model: str, request):
+    """Blocking model call; `request()` builds (contents, config) here, off the event loop."""
+    t0 = time.perf_counter()
     client = _get_client()
-    config = GenerateContentConfig(
-        system_instruction=(
-            """
+    contents, config = request()
+    client_init_ms = int((time.perf_counter() - t0) * 1000)
+    t1 = time.perf_counter()
+    resp = client.models.generate_content(
+        model=model,
+        contents=contents,
+        config=config,
+    )
+    inference_ms = int((time.perf_counter() - t1) * 1000)
+    return resp, client_init_ms, inference_ms
+
+
+# Model output format: "compact" constrains the answer with a response schema to
+# [{"box_2d": [4 ints], "text"}, ...], the only parts the routes use; "verbose" is the
+# free-form format that also asks for label boxes (more output tokens, same boxes).
+DETECT_OUTPUT_MODE = os.environ.get("DETECT_OUTPUT_MODE", "compact")
+# Geometric pre-pass: the boxes geometry.py finds on the page are listed in the prompt as
+# hints (at most GEOMETRY_MAX_HINTS); off by default, it changes what the model answers
+GEOMETRY_HINTS = os.environ.get("GEOMETRY_HINTS", "0") == "1"
+GEOMETRY_MAX_HINTS = int(os.environ.get("GEOMETRY_MAX_HINTS", "200"))
+
+_DETECT_RULES = """
+Important rules:
+- INCLUDE small tick, circle, checkbox boxes as fields too. When a field is very small (roughly room for ≤3 letters), it is likely a check box. It is acceptable to return these; setting text to "x" is fine for such small fields.
+- All coordinates must be normalized to 0–1000 and should be integers.
+- If a field should be left blank purposely, set text to an empty string "" (never the word None).
+"""
+VERBOSE_SYSTEM_PROMPT = """
 You are given an image of a paper form. Find all fields where a human is expected to WRITE text (e.g., blank lines, long empty boxes) and, for each, produce:
 
 - label_box_2d: bounding box for the nearest descriptive label or prompt text for that field
 - input_box_2d: bounding box for the empty area where the user writes their answer
 - text: a realistic, context-appropriate fake value that matches what the field expects
 
-Important rules:
-- INCLUDE small tick, circle, checkbox boxes as fields too. When a field is very small (roughly room for ≤3 letters), it is likely a check box. It is acceptable to return these; setting text to "x" is fine for such small fields.
-- Return ONLY a JSON array where each element is an object with exactly these keys:
+Return ONLY a JSON array where each element is an object with exactly these keys:
   {"label_box_2d": [y_min, x_min, y_max, x_max], "input_box_2d": [y_min, x_min, y_max, x_max], "text": "..."}
-- All coordinates must be normalized to 0–1000 and should be integers.
-- If a field should be left blank purposely, set text to an empty string "" (never the word None).
-            """
-        ),
+""" + _DETECT_RULES
+COMPACT_SYSTEM_PROMPT = """
+You are given an image of a paper form. Find all fields where a human is expected to WRITE text (e.g., blank lines, long empty boxes) and, for each, produce:
+
+- box_2d: [y_min, x_min, y_max, x_max] of the empty area where the user writes their answer
+- text: a realistic, context-appropriate fake value that matches what the field expects
+""" + _DETECT_RULES
+COMPACT_RESPONSE_SCHEMA = {
+    "type": "ARRAY",
+    "items": {
+        "type": "OBJECT",
+        "properties": {
+            "box_2d": {"type": "ARRAY", "items": {"type": "INTEGER"}, "min_items": 4, "max_items": 4},
+            "text": {"type": "STRING"},
+        },
+        "required": ["box_2d", "text"],
+        "property_ordering": ["box_2d", "text"],
+    },
+}
+DETECT_SYSTEM_PROMPT = COMPACT_SYSTEM_PROMPT if DETECT_OUTPUT_MODE == "compact" else VERBOSE_SYSTEM_PROMPT
+DETECT_RESPONSE_SCHEMA = COMPACT_RESPONSE_SCHEMA if DETECT_OUTPUT_MODE == "compact" else None
+DETECT_USER_PROMPT = "Return bounding boxes and fake text for writable fields only."
+# Part of the result cache key: any prompt or schema edit invalidates cached detections
+PROMPT_VERSION = hashlib.sha256(
+    (DETECT_SYSTEM_PROMPT + DETECT_USER_PROMPT + json.dumps(DETECT_RESPONSE_SCHEMA, sort_keys=True)
+     + (f"hints:{GEOMETRY_MAX_HINTS}" if GEOMETRY_HINTS else "")).encode("utf-8")
+).hexdigest()[:12]
+
+
+def _hint_prompt(hints: Fields) -> str:
+    boxes = [[int(v) for v in box] for box in hints.postprocess().boxes.tolist()[:GEOMETRY_MAX_HINTS]]
+    return (
+        "Printed lines and boxes on the page suggest writable areas at these [y_min, x_min, y_max, x_max] "
+        f"(0-1000): {json.dumps(boxes, separators=(',', ':'))}. Use them where they match a field; "
+        "they may be incomplete or include areas that are not fields."
+    )
+
+
+def _detect_request(image_bytes: bytes, mime_type: str, hints: Optional[Fields] = None):
+    """(contents, config) of a detect call; needs the SDK, so call it from a worker thread."""
+    types = _import_sdk().types
+    config = types.GenerateContentConfig(
+        system_instruction=DETECT_SYSTEM_PROMPT,
         response_mime_type="application/json",
+        response_schema=DETECT_RESPONSE_SCHEMA,
     )
     contents = [
-        Part.from_bytes(data=image_bytes, mime_type=mime_type),
-        "Return bounding boxes and fake text for writable fields only.",
+        types.Part.from_bytes(data=image_bytes, mime_type=mime_type),
+        DETECT_USER_PROMPT,
     ]
+    if hints is not None and len(hints):
+        contents.append(_hint_prompt(hints))
+    return contents, config
+
+
+async def _model_request(image_bytes: bytes, mime_type: str):
+    """A builder for _detect_request, with the geometric hints when GEOMETRY_HINTS is on.
+
+    The request itself is built by the model call on its worker thread.
+    """
+    hints = None
+    if GEOMETRY_HINTS:
+        loop = asyncio.get_running_loop()
+        hints = await loop.run_in_executor(None, detect_fields, image_bytes)
+    return functools.partial(_detect_request, image_bytes, mime_type, hints)
+
+
+class ModelOutputError(ValueError):
+    """The model's answer is not the JSON array the detect prompt asks for."""
+
+
+# Token counts reported in timings_ms, summed over every model call a response needed
+TOKEN_KEYS = ("prompt_tokens", "output_tokens", "total_tokens")
+
+
+def _token_usage(usage) -> dict:
+    """Token counts from a response's usage_metadata (zeros when the backend reports none)."""
+    return {
+        "prompt_tokens": getattr(usage, "prompt_token_count", None) or 0,
+        "output_tokens": getattr(usage, "candidates_token_count", None) or 0,
+        "total_tokens": getattr(usage, "total_token_count", None) or 0,
+    }
 
+
+async def _start_inference(model: str, call):
+    """Start `call` on _inference_executor once a model-call slot is free; returns (future, queue_wait_ms).
+
+    The slot and the in-flight gauge are released when the worker thread finishes, not when the
+    caller stops waiting: a call given up on (MODEL_TIMEOUT_S, a client going away) keeps its
+    thread, and later calls must queue in admission, not unseen inside the executor.
+    Await the future through asyncio.shield so cancelling the caller leaves it running.
+    """
+    t_wait = time.perf_counter()
+    release = await _admission.hold()
+    queue_wait_ms = int((time.perf_counter() - t_wait) * 1000)
+    INFERENCES_IN_FLIGHT.inc(model=_metric_model(model))
+
+    def finished(future) -> None:
+        INFERENCES_IN_FLIGHT.dec(model=_metric_model(model))
+        release()
+        if not future.cancelled():
+            # Retrieved here too, in case the caller gave up on it
+            future.exception()
+
+    try:
+        future = asyncio.get_running_loop().run_in_executor(_inference_executor, call)
+    except BaseException:
+        INFERENCES_IN_FLIGHT.dec(model=_metric_model(model))
+        release()
+        raise
+    future.add_done_callback(finished)
+    return future, queue_wait_ms
+
+
+async def _detect_and_fake(image_bytes: bytes, mime_type: str, model: str):
+    """Single Gemini call that returns both boxes and fake text per box.
+
+    Expected model JSON: [ {"box_2d": [y_min,x_min,y_max,x_max], "text": "..."}, ... ] (see DETECT_OUTPUT_MODE).
+    Returns the parsed Fields (not yet post-filtered) and timings, including the token counts.
+    The blocking call runs off the event loop; time spent waiting for an in-flight slot is queue_wait_ms.
+    """
+    request = await _model_request(image_bytes, mime_type)
+
+    call, queue_wait_ms = await _start_inference(model, functools.partial(_generate_content, model, request))
+    resp, client_init_ms, inference_ms = await asyncio.shield(call)
+
+    t1 = time.perf_counter()
+    fields = Fields.from_model_output(json.loads(resp.text))
+    parse_ms = int((time.perf_counter() - t1) * 1000)
+    return fields, {
+        "inference_ms": inference_ms,
+        "parse_ms": parse_ms,
+        "queue_wait_ms": queue_wait_ms,
+        "client_init_ms": client_init_ms,
+        "model_used": model,
+        **_token_usage(getattr(resp, "usage_metadata", None)),
+    }
+
+
+# Cascade mode (detector=cascade): pages go to CASCADE_FAST_MODEL first and only on to
+# CASCADE_STRONG_MODEL when the fast result fails the checks in cascade.py
+CASCADE_FAST_MODEL = os.environ.get("CASCADE_FAST_MODEL", "gemini-2.5-flash-lite")
+CASCADE_STRONG_MODEL = os.environ.get("CASCADE_STRONG_MODEL", MODEL_NAME)
+CASCADE_POLICY = CascadePolicy(
+    min_boxes=int(os.environ.get("CASCADE_MIN_BOXES", "1")),
+    max_out_of_range=float(os.environ.get("CASCADE_MAX_OUT_OF_RANGE", "0.02")),
+    max_overlap=float(os.environ.get("CASCADE_MAX_OVERLAP", "0.1")),
+    max_empty_text=float(os.environ.get("CASCADE_MAX_EMPTY_TEXT", "0.5")),
+)
+# Default for the detector query parameter of the combined routes; set to "cascade" to enable it
+DEFAULT_DETECTOR = os.environ.get("DEFAULT_DETECTOR", MODEL_NAME)
+
+
+async def _cascade_detect_and_fake(image_bytes: bytes, mime_type: str):
+    """Fast model first; escalate to the strong model when its result fails the quality check.
+
+    Timings are those of _detect_and_fake summed over both calls, plus model_used and
+    escalation_reason (None, or the comma-joined failed checks / "error").
+    """
+    try:
+        fields, fast = await _detect_and_fake(image_bytes, mime_type, CASCADE_FAST_MODEL)
+        reasons = escalation_reasons(fields, CASCADE_POLICY)
+    except Exception as e:
+        log_event("cascade fast model failed; escalating", severity="WARNING", exc=e, model=CASCADE_FAST_MODEL)
+        fast = {}
+        reasons = ["error"]
+    if not reasons:
+        return fields, {**fast, "escalation_reason": None}
+
+    fields, strong = await _detect_and_fake(image_bytes, mime_type, CASCADE_STRONG_MODEL)
+    timings = {key: fast.get(key, 0) + strong[key] for key in ("inference_ms", "parse_ms", "queue_wait_ms", "client_init_ms", *TOKEN_KEYS)}
+    return fields, {
+        **timings,
+        "fast_inference_ms": fast.get("inference_ms", 0),
+        "model_used": CASCADE_STRONG_MODEL,
+        "escalation_reason": ",".join(reasons),
+    }
+
+
+# Model fallback: when a model call fails (server error, rate limit, auth or connection
+# error), takes longer than MODEL_TIMEOUT_S (0: no limit) or answers something that does not
+# parse, the page is answered by the geometric detector instead (boxes without texts;
+# timings_ms.fallback_reason is "error", "timeout" or "parse"). Such results are not cached.
+# Other exceptions, other 4xx API errors included, are bugs and still fail the request.
+GEOMETRY_FALLBACK = os.environ.get("GEOMETRY_FALLBACK", "1") == "1"
+MODEL_TIMEOUT_S = float(os.environ.get("MODEL_TIMEOUT_S", "0"))
+# Cleared by batch jobs, which retry the model rather than settle for boxes without texts
+_geometry_fallback: ContextVar[bool] = ContextVar("geometry_fallback", default=True)
+
+
+async def _geometry_detect(image_bytes: bytes):
+    """detector=geometry: fields found from the printed lines, with _detect_and_fake's timing keys.
+
+    On a whole upload, this is the entire pipeline: detect_fields decodes and downscales the
+    page itself in less time than preparing it for a cache or template lookup would take.
+    """
     t0 = time.perf_counter()
-    resp = client.models.generate_content(
-        model=model,
-        contents=contents,
-        config=config,
+    loop = asyncio.get_running_loop()
+    fields = await loop.run_in_executor(None, detect_fields, image_bytes)
+    return fields, {
+        "inference_ms": int((time.perf_counter() - t0) * 1000),
+        "parse_ms": 0,
+        "queue_wait_ms": 0,
+        "client_init_ms": 0,
+        "model_used": GEOMETRY_MODEL,
+        **dict.fromkeys(TOKEN_KEYS, 0),
+    }
+
+
+def _fallback_reason(e: Exception) -> Optional[str]:
+    """The fallback_reason for a failed model call; None when the failure is not the model's (a bug)."""
+    if isinstance(e, (asyncio.TimeoutError, TimeoutError)):
+        return "timeout"
+    if isinstance(e, (json.JSONDecodeError, ModelOutputError)):
+        return "parse"
+    # requests' connection errors are OSErrors; API and auth errors come from the SDK, loaded by then
+    if isinstance(e, OSError):
+        return "error"
+    if _genai is not None:
+        import google.auth.exceptions
+
+        if isinstance(e, google.auth.exceptions.GoogleAuthError):
+            return "error"
+        # Server errors, rate limits and request timeouts; other 4xx (a schema Vertex rejects,
+        # an unknown model) mean our request is wrong, and would degrade every page
+        if isinstance(e, _genai.errors.ServerError) or (
+            isinstance(e, _genai.errors.APIError) and e.code in TRANSIENT_STATUS_CODES
+        ):
+            return "error"
+    return None
+
+
+async def _run_detector(image_bytes: bytes, mime_type: str, model: str):
+    if model == GEOMETRY_MODEL:
+        return await _geometry_detect(image_bytes)
+    if model == CASCADE_MODEL:
+        detection = _cascade_detect_and_fake(image_bytes, mime_type)
+    else:
+        detection = _detect_and_fake(image_bytes, mime_type, model)
+    try:
+        if MODEL_TIMEOUT_S > 0:
+            return await asyncio.wait_for(detection, MODEL_TIMEOUT_S)
+        return await detection
+    except Exception as e:
+        reason = _fallback_reason(e)
+        if reason is None or not (GEOMETRY_FALLBACK and _geometry_fallback.get()):
+            raise
+        fields, timings = await _geometry_detect(image_bytes)
+        if not len(fields):
+            # Nothing to offer instead: report the model failure
+            raise
+        log_event("model detection failed; answered by the geometric detector", severity="WARNING", exc=e, model=model, reason=reason)
+        return fields, {**timings, "fallback_reason": reason}
+
+
+def _pump_content_stream(model: str, request, loop, queue: asyncio.Queue, stop: threading.Event):
+    """Run generate_content_stream on a worker thread, handing text chunks to the event loop.
+
+    Puts str chunks, then an Exception on failure, then None. Returns client_init_ms and the
+    token counts (reported with the last chunk).
+    """
+    client_init_ms = 0
+    usage = None
+    try:
+        t0 = time.perf_counter()
+        client = _get_client()
+        contents, config = request()
+        client_init_ms = int((time.perf_counter() - t0) * 1000)
+        for chunk in client.models.generate_content_stream(model=model, contents=contents, config=config):
+            if stop.is_set():
+                # Client went away; stop reading the model stream
+                break
+            usage = getattr(chunk, "usage_metadata", None) or usage
+            loop.call_soon_threadsafe(queue.put_nowait, chunk.text or "")
+    except Exception as e:
+        loop.call_soon_threadsafe(queue.put_nowait, e)
+    finally:
+        loop.call_soon_threadsafe(queue.put_nowait, None)
+    return client_init_ms, _token_usage(usage)
+
+
+async def _stream_detect_and_fake(image_bytes: bytes, mime_type: str, model: str, timings: dict):
+    """Streaming variant of _detect_and_fake: yields each normalized entry as soon as it is complete.
+
+    Timings are written into `timings` (same keys as _detect_and_fake) as the stream progresses.
+    A stream that stops before the end of the array raises ModelOutputError after its last entry.
+    """
+    request = await _model_request(image_bytes, mime_type)
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    stop = threading.Event()
+
+    pump, timings["queue_wait_ms"] = await _start_inference(
+        model, functools.partial(_pump_content_stream, model, request, loop, queue, stop)
     )
-    inference_ms = int((time.perf_counter() - t0) * 1000)
+    t0 = time.perf_counter()
+    parser = JsonArrayStream()
+    parse_s = 0.0
+    try:
+        while True:
+            chunk = await queue.get()
+            if chunk is None:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            t_parse = time.perf_counter()
+            entries = parser.feed(chunk)
+            parse_s += time.perf_counter() - t_parse
+            for entry in entries:
+                item = normalize_entry(entry)
+                if item is not None:
+                    yield item
+        timings["client_init_ms"], usage = await asyncio.shield(pump)
+        timings.update(usage)
+    finally:
+        # The pump stops at its next chunk; its slot is freed once it has
+        stop.set()
+    timings["inference_ms"] = int((time.perf_counter() - t0) * 1000)
+    timings["parse_ms"] = int(parse_s * 1000)
+    if not parser.done:
+        # Cut off (e.g. max output tokens) before the closing "]": the entries sent are not the whole answer
+        raise ModelOutputError("model answer ended before the end of its JSON array")
+
+
+# Detection result cache: in-memory LRU, plus an SQLite file when RESULT_CACHE_DB is set
+RESULT_CACHE_MAX_BYTES = int(os.environ.get("RESULT_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+RESULT_CACHE_TTL_S = float(os.environ.get("RESULT_CACHE_TTL_S", str(7 * 24 * 3600)))
+RESULT_CACHE_DB = os.environ.get("RESULT_CACHE_DB") or None
+
+_result_cache = ResultCache(RESULT_CACHE_MAX_BYTES, RESULT_CACHE_TTL_S, db_path=RESULT_CACHE_DB)
+
+
+async def _in_store_thread(store, method, *args):
+    """Call a result cache / template index method, on a worker thread when `store` has an
+    SQLite file: its reads, writes and commits (an fsync) block, and so does its lock."""
+    if not store.persistent:
+        return method(*args)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(method, *args))
+
+
+# Upload preprocessing: pages are re-encoded and capped at IMAGE_MAX_LONG_EDGE px (0 disables)
+IMAGE_MAX_LONG_EDGE = int(os.environ.get("IMAGE_MAX_LONG_EDGE", "2048"))
+IMAGE_PREP_FORMAT = os.environ.get("IMAGE_PREP_FORMAT", "jpeg")
+IMAGE_PREP_QUALITY = int(os.environ.get("IMAGE_PREP_QUALITY", "85"))
+# Preprocessing changes what the model sees, so its settings are part of the cache key
+_CACHE_VERSION = f"{PROMPT_VERSION}:{IMAGE_MAX_LONG_EDGE}:{IMAGE_PREP_FORMAT}:{IMAGE_PREP_QUALITY}"
 
+
+# Tiled detection (tiled=true, or by default for pages whose long edge is at least
+# TILED_MIN_LONG_EDGE px): overlapping tiles of the page are detected concurrently and
+# merged, see tiling.py. TILE_SIZE_PX is the largest tile side sent to the model.
+TILED_MIN_LONG_EDGE = int(os.environ.get("TILED_MIN_LONG_EDGE", "0"))  # 0: only when requested
+TILE_SIZE_PX = int(os.environ.get("TILE_SIZE_PX", "1024"))
+TILE_OVERLAP = float(os.environ.get("TILE_OVERLAP", "0.15"))
+TILE_MAX_PER_SIDE = int(os.environ.get("TILE_MAX_PER_SIDE", "3"))
+
+
+def _use_tiles(tiled: Optional[bool], width: int, height: int) -> bool:
+    if tiled is None:
+        tiled = TILED_MIN_LONG_EDGE > 0 and max(width, height) >= TILED_MIN_LONG_EDGE
+    return tiled and len(plan_tiles(width, height, TILE_SIZE_PX, TILE_OVERLAP, TILE_MAX_PER_SIDE)) > 1
+
+
+def _detect_version(tiles: bool) -> str:
+    # Tiled and whole-page results differ, so they are cached and indexed apart
+    if not tiles:
+        return _CACHE_VERSION
+    return f"{_CACHE_VERSION}:tiles:{TILE_SIZE_PX}:{TILE_OVERLAP}:{TILE_MAX_PER_SIDE}"
+
+
+async def _tiled_detect_and_fake(content: bytes, model: str):
+    """Detect overlapping tiles of the original page concurrently and merge them.
+
+    inference_ms and queue_wait_ms are those of the slowest tile (tiles run in
+    parallel), parse_ms includes the merge and token counts are summed; timings add tiles
+    and tile_prep_ms, and model_used/escalation_reason list the distinct values over all tiles.
+    """
+    t0 = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    width, height, tiles = await loop.run_in_executor(
+        None,
+        functools.partial(cut_tiles, content, TILE_SIZE_PX, TILE_OVERLAP, TILE_MAX_PER_SIDE, IMAGE_PREP_FORMAT, IMAGE_PREP_QUALITY),
+    )
+    tile_prep_ms = int((time.perf_counter() - t0) * 1000)
+    results = await asyncio.gather(*(_run_detector(tile.data, tile.mime_type, model) for tile in tiles))
     t1 = time.perf_counter()
-    data = json.loads(resp.text)
-    if not isinstance(data, list):
-        data = []
-    # Normalize entries and coerce None/'None' to empty string
-    normalized = []
-    for entry in data:
-        if isinstance(entry, dict) and ("input_box_2d" in entry or "box_2d" in entry):
-            # Prefer input_box_2d when present; fall back to single box_2d
-            box = entry.get("input_box_2d") or entry.get("box_2d")
-            txt = entry.get("text", "")
-        elif isinstance(entry, list) and len(entry) >= 4:
-            # Some models might emit just arrays
-            box, txt = entry[:4], ""
-        else:
-            continue
-        if isinstance(txt, str):
-            if txt.strip().lower() == "none":
-                txt = ""
-        elif txt is None:
-            txt = ""
-        normalized.append({"box_2d": box, "text": txt})
+    fields = merge_tiles([(tile_fields, tile.box) for (tile_fields, _), tile in zip(results, tiles)], width, height)
+    merge_ms = int((time.perf_counter() - t1) * 1000)
+    timings = [t for _, t in results]
+    return fields, {
+        "inference_ms": max(t["inference_ms"] for t in timings),
+        "parse_ms": sum(t["parse_ms"] for t in timings) + merge_ms,
+        "queue_wait_ms": max(t["queue_wait_ms"] for t in timings),
+        "client_init_ms": max(t["client_init_ms"] for t in timings),
+        "model_used": ",".join(sorted({t["model_used"] for t in timings})),
+        "escalation_reason": ",".join(sorted({t["escalation_reason"] for t in timings if t.get("escalation_reason")})) or None,
+        "fallback_reason": ",".join(sorted({t["fallback_reason"] for t in timings if t.get("fallback_reason")})) or None,
+        "tiles": len(tiles),
+        "tile_prep_ms": tile_prep_ms,
+        **{key: sum(t[key] for t in timings) for key in TOKEN_KEYS},
+    }
 
-    parse_ms = int((time.perf_counter() - t1) * 1000)
-    return normalized, {"inference_ms": inference_ms, "parse_ms": parse_ms}
+
+async def _prepare_upload(content: bytes):
+    t0 = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    prepared = await loop.run_in_executor(
+        None,
+        functools.partial(prepare_image, content, IMAGE_MAX_LONG_EDGE, IMAGE_PREP_FORMAT, IMAGE_PREP_QUALITY),
+    )
+    return prepared, int((time.perf_counter() - t0) * 1000)
+
+
+# Layout template index: a page whose layout matches an already detected one (e.g. a
+# rescan of the same blank form) reuses its aligned boxes instead of calling the model
+TEMPLATE_INDEX_MAX_ENTRIES = int(os.environ.get("TEMPLATE_INDEX_MAX_ENTRIES", "1000"))  # 0 disables
+TEMPLATE_MAX_DISTANCE = float(os.environ.get("TEMPLATE_MAX_DISTANCE", "0.12"))
+TEMPLATE_MAX_INK_DELTA = float(os.environ.get("TEMPLATE_MAX_INK_DELTA", "0.02"))
+TEMPLATE_INDEX_DB = os.environ.get("TEMPLATE_INDEX_DB") or None
+
+_template_index = TemplateIndex(
+    TEMPLATE_INDEX_MAX_ENTRIES, TEMPLATE_MAX_DISTANCE, TEMPLATE_MAX_INK_DELTA, db_path=TEMPLATE_INDEX_DB
+)
+
+
+async def _match_template(prepared, scope: str, timings: dict):
+    """Fingerprint the prepared page and look it up in the template index.
+
+    Returns (match or None, fingerprint or None) and fills the template timings;
+    the fingerprint is needed to index the page once the model has detected it.
+    """
+    if _template_index.max_entries <= 0:
+        return None, None
+    t0 = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    fp = await loop.run_in_executor(None, layout_fingerprint, prepared.data)
+    match = await _in_store_thread(_template_index, _template_index.lookup, fp, scope)
+    timings["template_lookup_ms"] = int((time.perf_counter() - t0) * 1000)
+    timings["template"] = "miss" if match is None else "hit"
+    if match is not None:
+        timings["template_id"] = match.template_id
+        timings["template_distance"] = match.distance
+    return match, fp
+
+
+async def _index_template(fp, scope: str, fields: Fields) -> None:
+    if fp is not None:
+        await _in_store_thread(_template_index, _template_index.add, fp, scope, fields)
+
+
+async def _cached_detect_and_fake(content: bytes, model: str, tiles: bool = False):
+    """Preprocess the upload and run _detect_and_fake (per tile when `tiles`), behind the result cache and template index.
+
+    The cache is keyed on the raw upload so a hit skips preprocessing too. Timings carry
+    cache ("hit"/"miss"), cache_lookup_ms, template ("hit"/"miss") and the
+    upload/model-input byte counts.
+    """
+    if model == GEOMETRY_MODEL:
+        fields, timings = await _geometry_detect(content)
+        return fields, {**timings, "image_bytes_in": len(content)}
+    t0 = time.perf_counter()
+    version = _detect_version(tiles)
+    scope = f"{model}:{version}"
+    key = cache_key(content, model, version)
+    cached = await _in_store_thread(_result_cache, _result_cache.get, key)
+    cache_lookup_ms = int((time.perf_counter() - t0) * 1000)
+    if cached is not None:
+        return Fields.from_json(cached), {"cache": "hit", "cache_lookup_ms": cache_lookup_ms, "image_bytes_in": len(content)}
+
+    prepared, image_prep_ms = await _prepare_upload(content)
+    timings = {
+        "cache": "miss",
+        "cache_lookup_ms": cache_lookup_ms,
+        "image_prep_ms": image_prep_ms,
+        "image_bytes_in": prepared.bytes_in,
+        "image_bytes_out": prepared.bytes_out,
+    }
+    match, fp = await _match_template(prepared, scope, timings)
+    if match is not None:
+        await _in_store_thread(_result_cache, _result_cache.put, key, match.fields.to_json())
+        return match.fields, timings
+
+    if tiles:
+        fields, detect_timings = await _tiled_detect_and_fake(content, model)
+    else:
+        fields, detect_timings = await _run_detector(prepared.data, prepared.mime_type, model)
+    # Empty results are usually a model hiccup, and fallback results a model failure; let the next upload retry
+    if len(fields) and not detect_timings.get("fallback_reason"):
+        await _in_store_thread(_result_cache, _result_cache.put, key, fields.to_json())
+        await _index_template(fp, scope, fields)
+    return fields, {**detect_timings, **timings}
+
+
+async def _stream_cached_detect_and_fake(content: bytes, model: str, timings: dict, tiles: bool = False):
+    """Streaming counterpart of _cached_detect_and_fake; a cache hit yields every entry at once."""
+    if model == GEOMETRY_MODEL:
+        fields, detect_timings = await _geometry_detect(content)
+        timings.update(detect_timings, image_bytes_in=len(content))
+        for item in fields.entries():
+            yield item
+        return
+    t0 = time.perf_counter()
+    version = _detect_version(tiles)
+    scope = f"{model}:{version}"
+    key = cache_key(content, model, version)
+    cached = await _in_store_thread(_result_cache, _result_cache.get, key)
+    timings["cache_lookup_ms"] = int((time.perf_counter() - t0) * 1000)
+    timings["image_bytes_in"] = len(content)
+    if cached is not None:
+        timings["cache"] = "hit"
+        for item in Fields.from_json(cached).entries():
+            yield item
+        return
+
+    timings["cache"] = "miss"
+    prepared, timings["image_prep_ms"] = await _prepare_upload(content)
+    timings["image_bytes_out"] = prepared.bytes_out
+    match, fp = await _match_template(prepared, scope, timings)
+    if match is not None:
+        await _in_store_thread(_result_cache, _result_cache.put, key, match.fields.to_json())
+        for item in match.fields.entries():
+            yield item
+        return
+
+    if tiles or model == CASCADE_MODEL:
+        # Tiles are merged, and a cascade's fast result checked, as a whole before any of it can be sent
+        if tiles:
+            fields, detect_timings = await _tiled_detect_and_fake(content, model)
+        else:
+            fields, detect_timings = await _run_detector(prepared.data, prepared.mime_type, model)
+        timings.update(detect_timings)
+        entries = list(fields.entries())
+        for item in entries:
+            yield item
+    else:
+        entries = []
+        try:
+            async for item in _stream_detect_and_fake(prepared.data, prepared.mime_type, model, timings):
+                entries.append(item)
+                yield item
+            timings["model_used"] = model
+        except Exception as e:
+            # Fall back only while nothing has been sent; a half-sent answer cannot be replaced
+            fields = Fields.empty()
+            reason = _fallback_reason(e)
+            if not entries and reason is not None and GEOMETRY_FALLBACK and _geometry_fallback.get():
+                fields, detect_timings = await _geometry_detect(prepared.data)
+            if not len(fields):
+                raise
+            log_event("model detection failed; answered by the geometric detector", severity="WARNING", exc=e, model=model, reason=reason)
+            timings.update(detect_timings, fallback_reason=reason)
+            for item in fields.entries():
+                yield item
+            return
+    if entries and not timings.get("fallback_reason"):
+        fields = Fields.from_entries(entries)
+        await _in_store_thread(_result_cache, _result_cache.put, key, fields.to_json())
+        await _index_template(fp, scope, fields)
 
 
 SMALL_BOX_PX_THRESHOLD = 30  # width in pixels considered too small to contain >3 letters
@@ -213,6 +983,8 @@ def _validate_session_and_csrf(request: Request) -> None:
     session_id, signature = sess.rsplit(".", 1)
     if not hmac.compare_digest(signature, _sign_value(session_id)):
         raise HTTPException(status_code=403, detail="forbidden: invalid session")
+    # Model calls made for this request (and tasks it starts) are scheduled as this session's
+    current_session.set(session_id)
 
     # For state-changing requests, require CSRF header matching CSRF cookie
     if request.method in {"POST", "PUT", "PATCH", "DELETE"}:
@@ -227,11 +999,35 @@ async def frontend_only(request: Request):
     _validate_session_and_csrf(request)
 
 
+async def admitted(request: Request, dep: None = Depends(frontend_only)):
+    """frontend_only plus admission control, for routes that call the model: 429 when refused.
+
+    detector=geometry makes no model call and is not admission controlled.
+    """
+    if request.query_params.get("detector") == GEOMETRY_MODEL:
+        return
+    _admission.admit(current_session.get())
+
+
 @app.get("/api/health")
 async def health(dep: None = Depends(frontend_only)):
     return {"status": "ok"}
 
 
+# Optional bearer token for /metrics; when unset the endpoint is open (it exposes no user data)
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+
+
+@app.get("/metrics")
+async def metrics(request: Request):
+    if METRICS_TOKEN:
+        auth = request.headers.get("authorization", "")
+        if not hmac.compare_digest(auth, f"Bearer {METRICS_TOKEN}"):
+            raise HTTPException(status_code=403, detail="forbidden")
+    MODEL_CALLS_QUEUED.set(_admission.scheduler.queued)
+    return Response(render_metrics(), media_type="text/plain; version=0.0.4")
+
+
 @app.get("/.well-known/appspecific/com.chrome.devtools.json")
 async def chrome_devtools_probe():
     # Quiet Chrome DevTools probe with no content
@@ -240,93 +1036,574 @@ async def chrome_devtools_probe():
 @app.get("/")
 async def root_index(request: Request):
     # Serve the main UI and set session + CSRF cookies so only this frontend can call APIs
-    resp = FileResponse("index.html")
+    # A 304 still carries the fresh cookies
+    resp = _static_response(request, ENTRY_PAGE, ENTRY_CACHE_CONTROL)
     # Use proxy headers to compute the public origin for cookie flags
     public_origin = _service_origin(request)
     _issue_session_and_csrf_cookies(resp, base_url=public_origin)
     return resp
 
 @app.get("/dev-preload.jpg")
-async def preload_image():
-    return FileResponse("dev-preload.jpg")
+async def preload_image(request: Request):
+    return _static_response(request, "dev-preload.jpg")
+
+
+@app.get("/logo.png")
+async def logo(request: Request):
+    return _static_response(request, "logo.png")
+
+
+@app.get("/fonts/{name}")
+async def font_file(request: Request, name: str):
+    return _static_response(request, f"fonts/{name}")
+
+
+def _filter_field(item, width: int):
+    """Post-filter one streamed field to (box, text); None when the box is malformed or degenerate."""
+    fields = Fields.from_entries([item]).postprocess(width, SMALL_BOX_PX_THRESHOLD)
+    if not len(fields):
+        return None
+    return fields.boxes[0].tolist(), fields.texts[0]
+
+
+def _filter_fields(fields: Fields, width: int):
+    """Post-filter model fields (by pixel width) and build boxes/texts arrays; tiny boxes become checkbox 'x'."""
+    fields = fields.postprocess(width, SMALL_BOX_PX_THRESHOLD)
+    return fields.box_dicts(), fields.texts
+
+
+def _combined_timings(t_combined) -> dict:
+    return {
+        "combined_inference_ms": t_combined.get("inference_ms", 0),
+        "combined_parse_ms": t_combined.get("parse_ms", 0),
+        "inference_queue_wait_ms": t_combined.get("queue_wait_ms", 0),
+        "client_init_ms": t_combined.get("client_init_ms", 0),
+        "cache": t_combined.get("cache"),
+        "cache_lookup_ms": t_combined.get("cache_lookup_ms", 0),
+        "image_prep_ms": t_combined.get("image_prep_ms", 0),
+        "image_bytes_in": t_combined.get("image_bytes_in", 0),
+        "image_bytes_out": t_combined.get("image_bytes_out", 0),
+        "template": t_combined.get("template"),
+        "template_lookup_ms": t_combined.get("template_lookup_ms", 0),
+        "model_used": t_combined.get("model_used"),
+        "escalation_reason": t_combined.get("escalation_reason"),
+        "fallback_reason": t_combined.get("fallback_reason"),
+        "tiles": t_combined.get("tiles", 0),
+        "tile_prep_ms": t_combined.get("tile_prep_ms", 0),
+        **{key: t_combined.get(key, 0) for key in TOKEN_KEYS},
+    }
+
+
+_TILED_DESCRIPTION = "Detect as overlapping tiles; by default only pages with a long edge of TILED_MIN_LONG_EDGE px or more"
+
+
+async def _detect_page(content: bytes, model: str, tiled: Optional[bool] = None) -> dict:
+    """Detect one page image; returns the /api/form/detect response body. Errors propagate."""
+    t_start = time.perf_counter()
+    with Image.open(io.BytesIO(content)) as img:
+        width, height = oriented_size(img)
+    fields, t_combined = await _cached_detect_and_fake(content, model, _use_tiles(tiled, width, height))
+    boxes, texts = _filter_fields(fields, width)
+    total_ms = int((time.perf_counter() - t_start) * 1000)
+    return {
+        "image": {"width": width, "height": height},
+        "normalized_scale": 1000,
+        "boxes": boxes,
+        "texts": texts,
+        "timings_ms": {**_combined_timings(t_combined), "total_ms": total_ms},
+    }
 
 
 @app.post("/api/form/detect")
 async def detect(
     file: UploadFile = File(...),
-    detector: str = Query(MODEL_NAME, description="Combined model for boxes+text"),
-    dep: None = Depends(frontend_only),
+    detector: str = Query(DEFAULT_DETECTOR, description="Combined model for boxes+text, or cascade"),
+    tiled: Optional[bool] = Query(None, description=_TILED_DESCRIPTION),
+    dep: None = Depends(admitted),
 ):
     t_route_start = time.perf_counter()
-    content = await file.read()
-    mime_type = file.content_type or "image/png"
-    # Validate it's an image and get dimensions
-    t_img_open_start = time.perf_counter()
-    with Image.open(io.BytesIO(content)) as img:
-        width, height = img.size
-    image_open_ms = int((time.perf_counter() - t_img_open_start) * 1000)
+    # Validate it's an image and get dimensions (as displayed, i.e. after EXIF orientation)
+    upload = await _read_upload(file, IMAGE_MIME_TYPES)
+    content, width, height = upload.data, upload.width, upload.height
+    image_open_ms = int((time.perf_counter() - t_route_start) * 1000)
     try:
-        (combined, t_combined) = _detect_and_fake(content, mime_type, detector)
-        # Post-filter: drop tiny boxes (by pixel width) and build boxes/texts arrays
-        boxes = []
-        texts = []
-        for item in combined:
-            box = item.get("box_2d")
-            txt = item.get("text", "")
-            if not isinstance(box, list) or len(box) != 4:
-                continue
-            y_min, x_min, y_max, x_max = box
-            width_px = int((x_max - x_min) / 1000 * width)
-            if width_px <= SMALL_BOX_PX_THRESHOLD:
-                # Small checkbox-like field: mark with an 'x'
-                boxes.append({"box_2d": box})
-                texts.append("x")
-                continue
-            boxes.append({"box_2d": box})
-            texts.append(txt or "")
-
+        (fields, t_combined) = await _cached_detect_and_fake(content, detector, _use_tiles(tiled, width, height))
+        boxes, texts = _filter_fields(fields, width)
         total_ms = int((time.perf_counter() - t_route_start) * 1000)
+        timings_ms = {
+            **_combined_timings(t_combined),
+            "image_open_ms": image_open_ms,
+            "total_ms": total_ms,
+        }
+        _observe("/api/form/detect", detector, timings_ms, len(boxes))
         return JSONResponse({
             "image": {"width": width, "height": height},
             "normalized_scale": 1000,
             "boxes": boxes,
             "texts": texts,
-            "timings_ms": {
-                "combined_inference_ms": t_combined.get("inference_ms", 0),
-                "combined_parse_ms": t_combined.get("parse_ms", 0),
-                "image_open_ms": image_open_ms,
-                "total_ms": total_ms,
-            },
+            "timings_ms": timings_ms,
         })
     except Exception as e:
-        import traceback
-        print(f"ERROR in /api/form/detect: {str(e)}")
-        print(f"TRACEBACK: {traceback.format_exc()}")
+        _record_error("/api/form/detect", e, model=detector)
         total_ms = int((time.perf_counter() - t_route_start) * 1000)
         return JSONResponse({"error": str(e), "timings_ms": {"total_ms": total_ms, "image_open_ms": image_open_ms}}, status_code=500)
 
 
+def _ndjson(event: dict) -> bytes:
+    return (json.dumps(event, separators=(",", ":")) + "\n").encode("utf-8")
+
+
+@app.post("/api/form/detect_stream")
+async def detect_stream(
+    file: UploadFile = File(...),
+    detector: str = Query(DEFAULT_DETECTOR, description="Combined model for boxes+text, or cascade"),
+    tiled: Optional[bool] = Query(None, description=_TILED_DESCRIPTION),
+    dep: None = Depends(admitted),
+):
+    """Streaming /api/form/detect: NDJSON events, one per field as soon as the model has emitted it.
+
+    Events: {"type": "image", ...}, then {"type": "field", "box_2d", "text"} per field, then
+    {"type": "done", "timings_ms"} or {"type": "error", "error"}.
+    """
+    t_route_start = time.perf_counter()
+    upload = await _read_upload(file, IMAGE_MIME_TYPES)
+    content, width, height = upload.data, upload.width, upload.height
+    image_open_ms = int((time.perf_counter() - t_route_start) * 1000)
+    tiles = _use_tiles(tiled, width, height)
+
+    async def events():
+        yield _ndjson({"type": "image", "image": {"width": width, "height": height}, "normalized_scale": 1000})
+        t_combined = {}
+        first_field_ms = None
+        boxes = 0
+        try:
+            async for item in _stream_cached_detect_and_fake(content, detector, t_combined, tiles):
+                field = _filter_field(item, width)
+                if field is None:
+                    continue
+                if first_field_ms is None:
+                    first_field_ms = int((time.perf_counter() - t_route_start) * 1000)
+                boxes += 1
+                yield _ndjson({"type": "field", "box_2d": field[0], "text": field[1]})
+        except Exception as e:
+            _record_error("/api/form/detect_stream", e, model=detector)
+            yield _ndjson({"type": "error", "error": str(e)})
+            return
+        total_ms = int((time.perf_counter() - t_route_start) * 1000)
+        timings_ms = {
+            **_combined_timings(t_combined),
+            "image_open_ms": image_open_ms,
+            "first_field_ms": first_field_ms if first_field_ms is not None else total_ms,
+            "total_ms": total_ms,
+        }
+        _observe("/api/form/detect_stream", detector, timings_ms, boxes)
+        yield _ndjson({"type": "done", "timings_ms": timings_ms})
+
+    return StreamingResponse(events(), media_type="application/x-ndjson", headers={"Cache-Control": "no-store"})
+
+
+# Server-side PDF handling: pages are rendered like the browser does (pdf.js scale 2)
+PDF_RENDER_SCALE = float(os.environ.get("PDF_RENDER_SCALE", "2"))
+PDF_MAX_PAGES = int(os.environ.get("PDF_MAX_PAGES", "50"))
+# Pages of one document detected concurrently (still bounded by MAX_INFLIGHT_INFERENCES overall)
+PDF_PAGE_CONCURRENCY = int(os.environ.get("PDF_PAGE_CONCURRENCY", "8"))
+
+
+@app.post("/api/form/detect_document")
+async def detect_document(
+    file: UploadFile = File(...),
+    detector: str = Query(DEFAULT_DETECTOR, description="Combined model for boxes+text, or cascade"),
+    tiled: Optional[bool] = Query(None, description=_TILED_DESCRIPTION),
+    dep: None = Depends(admitted),
+):
+    """Detects fields on every page of a PDF, pages in parallel. Per-page results mirror /api/form/detect."""
+    t_route_start = time.perf_counter()
+    content = (await _read_upload(file, {PDF_MIME_TYPE})).data
+    t_raster_start = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    try:
+        pages = await loop.run_in_executor(
+            None,
+            functools.partial(render_pdf_pages, content, PDF_RENDER_SCALE, PDF_MAX_PAGES, MAX_IMAGE_PIXELS),
+        )
+    except Exception as e:
+        return JSONResponse({"error": f"could not read PDF: {str(e)}"}, status_code=400)
+    rasterize_ms = int((time.perf_counter() - t_raster_start) * 1000)
+
+    page_slots = asyncio.Semaphore(PDF_PAGE_CONCURRENCY)
+
+    async def detect_page(index: int, page_bytes: bytes) -> dict:
+        async with page_slots:
+            t_page_start = time.perf_counter()
+            try:
+                page = await _detect_page(page_bytes, detector, tiled)
+                _observe("/api/form/detect_document", detector, page["timings_ms"], len(page["boxes"]))
+                return {"page": index, **page}
+            except Exception as e:
+                _record_error("/api/form/detect_document", e, model=detector, page=index)
+                total_ms = int((time.perf_counter() - t_page_start) * 1000)
+                return {"page": index, "error": str(e), "timings_ms": {"total_ms": total_ms}}
+
+    results = await asyncio.gather(*(detect_page(i, page) for i, page in enumerate(pages)))
+    total_ms = int((time.perf_counter() - t_route_start) * 1000)
+    return JSONResponse({
+        "page_count": len(pages),
+        "pages": results,
+        "timings_ms": {"rasterize_ms": rasterize_ms, "total_ms": total_ms},
+    })
+
+
+# Region re-detection: the region is widened by REGION_MARGIN (a fraction of its size)
+# on each side so fields on its edges are seen whole
+REGION_MARGIN = float(os.environ.get("REGION_MARGIN", "0.1"))
+
+
+def _parse_region(region: str) -> list:
+    data = json.loads(region)
+    if (
+        not isinstance(data, list)
+        or len(data) != 4
+        or not all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in data)
+    ):
+        raise ValueError("region must be [y_min, x_min, y_max, x_max] in 0-1000")
+    y0, x0, y1, x1 = (min(max(float(v), 0.0), 1000.0) for v in data)
+    if min(y0, y1) == max(y0, y1) or min(x0, x1) == max(x0, x1):
+        raise ValueError("region is empty")
+    return [min(y0, y1), min(x0, x1), max(y0, y1), max(x0, x1)]
+
+
+def _known_fields(fields: str) -> Fields:
+    """Boxes already on the page: a detect response ({boxes, texts}) or a list of {"box_2d"}."""
+    if not fields:
+        return Fields.empty()
+    data = json.loads(fields)
+    if isinstance(data, dict):
+        data = data.get("boxes")
+    if not isinstance(data, list):
+        raise ValueError("fields must be a detect response or a list of boxes")
+    return Fields.from_entries(e for e in data if isinstance(e, dict))
+
+
+async def _cached_detect_region(content: bytes, region: list, model: str):
+    """Detect inside one region of the page, behind the result cache; fields are in page coordinates.
+
+    Timings mirror _cached_detect_and_fake; image_prep_ms is the crop.
+    """
+    t0 = time.perf_counter()
+    key = cache_key(content, model, f"{_CACHE_VERSION}:region:{REGION_MARGIN}:{json.dumps(region)}")
+    cached = await _in_store_thread(_result_cache, _result_cache.get, key)
+    cache_lookup_ms = int((time.perf_counter() - t0) * 1000)
+    if cached is not None:
+        return Fields.from_json(cached), {"cache": "hit", "cache_lookup_ms": cache_lookup_ms, "image_bytes_in": len(content)}
+
+    t1 = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    width, height, crop = await loop.run_in_executor(
+        None,
+        functools.partial(cut_region, content, region, REGION_MARGIN, IMAGE_MAX_LONG_EDGE, IMAGE_PREP_FORMAT, IMAGE_PREP_QUALITY),
+    )
+    image_prep_ms = int((time.perf_counter() - t1) * 1000)
+    crop_fields, detect_timings = await _run_detector(crop.data, crop.mime_type, model)
+    fields = tile_to_page(crop_fields, crop.box, width, height)
+    if len(fields) and not detect_timings.get("fallback_reason"):
+        await _in_store_thread(_result_cache, _result_cache.put, key, fields.to_json())
+    return fields, {
+        **detect_timings,
+        "cache": "miss",
+        "cache_lookup_ms": cache_lookup_ms,
+        "image_prep_ms": image_prep_ms,
+        "image_bytes_in": len(content),
+        "image_bytes_out": len(crop.data),
+    }
+
+
+@app.post("/api/form/detect_region")
+async def detect_region(
+    file: UploadFile = File(...),
+    region: str = Form(..., description="JSON [y_min, x_min, y_max, x_max] in 0-1000: the part of the page to re-detect"),
+    fields: str = Form("", description="JSON: the boxes already known, as a detect response ({boxes, texts}) or [{box_2d}, ...]"),
+    detector: str = Query(DEFAULT_DETECTOR, description="Combined model for boxes+text, or cascade"),
+    dep: None = Depends(admitted),
+):
+    """Re-detect one region of a page; returns only the fields in it that are not already known.
+
+    Only the crop is sent to the model. The response mirrors /api/form/detect, with the
+    new fields in page coordinates, ready to append to the known ones.
+    """
+    t_route_start = time.perf_counter()
+    upload = await _read_upload(file, IMAGE_MIME_TYPES)
+    content, width, height = upload.data, upload.width, upload.height
+    try:
+        roi = _parse_region(region)
+        known = _known_fields(fields)
+    except ValueError as e:
+        return JSONResponse({"error": f"invalid region request: {str(e)}"}, status_code=400)
+    try:
+        found, t_combined = await _cached_detect_region(content, roi, detector)
+        added = new_in_region(found.postprocess(), known.postprocess(), roi)
+        boxes, texts = _filter_fields(added, width)
+        total_ms = int((time.perf_counter() - t_route_start) * 1000)
+        timings_ms = {**_combined_timings(t_combined), "total_ms": total_ms}
+        _observe("/api/form/detect_region", detector, timings_ms, len(boxes))
+        return JSONResponse({
+            "image": {"width": width, "height": height},
+            "normalized_scale": 1000,
+            "region": roi,
+            "boxes": boxes,
+            "texts": texts,
+            "timings_ms": timings_ms,
+        })
+    except Exception as e:
+        _record_error("/api/form/detect_region", e, model=detector)
+        total_ms = int((time.perf_counter() - t_route_start) * 1000)
+        return JSONResponse({"error": str(e), "timings_ms": {"total_ms": total_ms}}, status_code=500)
+
+
+_COLOR_RE = re.compile(r"^#[0-9a-fA-F]{6}$")
+
+
+def _render_page(page) -> dict:
+    """One page's {"boxes", "texts"}, boxes clamped to 0-1000 by Fields.postprocess; ValueError when malformed."""
+    if not isinstance(page, dict):
+        raise ValueError("pages must be JSON objects")
+    boxes, texts = page.get("boxes") or [], page.get("texts") or []
+    if not isinstance(boxes, list) or not isinstance(texts, list) or not all(isinstance(t, str) for t in texts):
+        raise ValueError("boxes must be a list, and texts a list of strings")
+    entries = [
+        {"box_2d": box.get("box_2d") if isinstance(box, dict) else box, "text": texts[i] if i < len(texts) else ""}
+        for i, box in enumerate(boxes)
+    ]
+    fields = Fields.from_entries(entries)
+    if len(fields) != len(entries):
+        raise ValueError("boxes must be [y_min, x_min, y_max, x_max] numbers or {\"box_2d\": [...]} objects")
+    fields = fields.postprocess()
+    return {"boxes": fields.boxes.tolist(), "texts": fields.texts}
+
+
+def _render_pages(fields: str) -> list:
+    """Per-page {"boxes", "texts"} from the render request: a detect response or a detect_document one.
+
+    Every page is validated here, before the response starts streaming; ValueError when malformed.
+    """
+    data = json.loads(fields)
+    if isinstance(data, dict) and isinstance(data.get("pages"), list):
+        pages = data["pages"]
+        numbers = [p.get("page", 0) if isinstance(p, dict) else None for p in pages]
+        if not all(isinstance(n, int) and not isinstance(n, bool) for n in numbers):
+            raise ValueError("pages must be objects with an integer page number")
+        return [_render_page(p) for _, p in sorted(zip(numbers, pages), key=lambda item: item[0])]
+    if isinstance(data, dict):
+        return [_render_page(data)]
+    raise ValueError("fields must be a JSON object")
+
+
+@app.post("/api/form/render")
+async def render(
+    file: UploadFile = File(...),
+    fields: str = Form(..., description="JSON: a detect response ({boxes, texts}) or a detect_document one ({pages})"),
+    font: str = Query("Satisfy", description="Satisfy (handwritten) or Arial (typed)"),
+    font_size: int = Query(20, ge=6, le=96, description="Max font size in page pixels; texts shrink to fit their box"),
+    color: str = Query("#000000", description="Ink colour, #rrggbb"),
+    format: str = Query(None, description="png or pdf; defaults to the input type (PDFs stay PDFs)"),
+    dep: None = Depends(frontend_only),
+):
+    """Returns the filled document: texts drawn into their boxes, as PNG or PDF, rendered page by page."""
+    upload = await _read_upload(file, IMAGE_MIME_TYPES | {PDF_MIME_TYPE})
+    content, is_pdf = upload.data, upload.mime_type == PDF_MIME_TYPE
+    fmt = format or ("pdf" if is_pdf else "png")
+    if fmt not in ("png", "pdf"):
+        return JSONResponse({"error": "format must be png or pdf"}, status_code=400)
+    if font not in FONT_FILES or not _COLOR_RE.match(color):
+        return JSONResponse({"error": f"font must be one of {', '.join(FONT_FILES)} and color #rrggbb"}, status_code=400)
+    try:
+        pages = _render_pages(fields)
+    except ValueError as e:
+        return JSONResponse({"error": f"invalid fields: {str(e)}"}, status_code=400)
+
+    # Validate the document up front: once streaming has started errors can no longer be reported
+    try:
+        if is_pdf:
+            import pymupdf
+
+            with pymupdf.open(stream=content, filetype="pdf") as doc:
+                check_pdf_pages(doc, PDF_RENDER_SCALE, PDF_MAX_PAGES, MAX_IMAGE_PIXELS)
+                page_count = doc.page_count
+            if fmt == "png" and page_count != 1:
+                raise ValueError("png output needs a single-page document; use format=pdf")
+    except Exception as e:
+        return JSONResponse({"error": f"could not read document: {str(e)}"}, status_code=400)
+
+    name = os.path.splitext(os.path.basename(file.filename or "form"))[0] or "form"
+    # A sync generator: Starlette pulls each page on a worker thread
+    body = render_document(content, is_pdf, pages, fmt, font, font_size, color, PDF_RENDER_SCALE, MAX_IMAGE_PIXELS)
+    return StreamingResponse(
+        body,
+        media_type="application/pdf" if fmt == "pdf" else "image/png",
+        headers={
+            "Content-Disposition": f'attachment; filename="{urllib.parse.quote(name)}_filled.{fmt}"',
+            "Cache-Control": "no-store",
+        },
+    )
+
+
+# Batch jobs submitted over HTTP run in this process and are kept in memory for polling.
+# Large backfills should use the CLI (python batch.py), which checkpoints to disk and resumes.
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", "200"))
+# Total size of a job's documents once zips are expanded (checked from the zip directory before extracting)
+BATCH_MAX_UNCOMPRESSED_BYTES = int(os.environ.get("BATCH_MAX_UNCOMPRESSED_BYTES", str(512 * 1024 * 1024)))
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", "4"))
+BATCH_RATE_PER_S = float(os.environ.get("BATCH_RATE_PER_S", "2"))
+BATCH_JOB_TTL_S = float(os.environ.get("BATCH_JOB_TTL_S", "3600"))
+
+_batch_jobs: dict = {}
+
+
+def _prune_batch_jobs() -> None:
+    now = time.time()
+    for job_id, job in list(_batch_jobs.items()):
+        if job["finished_at"] and now - job["finished_at"] > BATCH_JOB_TTL_S:
+            del _batch_jobs[job_id]
+
+
+async def _run_batch_job(job: dict, items: list) -> None:
+    try:
+        await job["runner"].run(items)
+    except Exception as e:
+        _record_error("/api/batch/jobs", e, job_id=job["id"])
+        job["runner"].status = "failed"
+    finally:
+        job["finished_at"] = time.time()
+        job["spool"].cleanup()
+
+
+def _spool_upload(file: UploadFile, path: str) -> tuple:
+    """read_upload, then write the upload to `path`; returns (mime_type, filename) and keeps no bytes."""
+    upload = read_upload(file, IMAGE_MIME_TYPES | {ZIP_MIME_TYPE}, MAX_IMAGE_PIXELS)
+    with open(path, "wb") as f:
+        f.write(upload.data)
+    return upload.mime_type, upload.filename
+
+
+async def _spool_batch_items(files: list, spool_dir: str) -> list:
+    """Write a job's uploads to `spool_dir`; returns (name, load) items that read each document lazily.
+
+    Zips are listed, not extracted: a document is decompressed only when a worker loads it.
+    Raises UploadRejected (413) past BATCH_MAX_ITEMS documents, zip members over
+    MAX_UPLOAD_BYTES, or BATCH_MAX_UNCOMPRESSED_BYTES in all.
+    """
+    items = []
+    total_bytes = 0
+    for i, file in enumerate(files):
+        path = os.path.join(spool_dir, str(i))
+        mime_type, filename = await run_in_threadpool(_spool_upload, file, path)
+        # The spooled copy replaces the parsed part (a temp file of its own past UPLOAD_SPOOL_BYTES)
+        await file.close()
+        name = filename or f"upload-{i}"
+        if mime_type == ZIP_MIME_TYPE:
+            members = await run_in_threadpool(
+                zip_image_members, path, MAX_UPLOAD_BYTES, max(BATCH_MAX_UNCOMPRESSED_BYTES - total_bytes, 1)
+            )
+            docs = [(f"{name}/{member}", size, functools.partial(read_zip_member, path, member)) for member, size in members]
+        else:
+            docs = [(name, os.path.getsize(path), functools.partial(read_file, path))]
+        if len(items) + len(docs) > BATCH_MAX_ITEMS:
+            raise UploadRejected(status_code=413, detail=f"too many documents, limit is {BATCH_MAX_ITEMS}")
+        total_bytes += sum(size for _, size, _ in docs)
+        items += [(doc_name, load) for doc_name, _, load in docs]
+    return items
+
+
+@app.post("/api/batch/jobs")
+async def submit_batch_job(
+    files: list[UploadFile] = File(...),
+    detector: str = Query(DEFAULT_DETECTOR, description="Combined model for boxes+text, or cascade"),
+    dep: None = Depends(admitted),
+):
+    """Queue many images (or .zip archives of images) for detection. Poll GET /api/batch/jobs/{job_id}."""
+    _prune_batch_jobs()
+    spool = tempfile.TemporaryDirectory(prefix="batch-")
+    try:
+        items = await _spool_batch_items(files, spool.name)
+    except BaseException:
+        spool.cleanup()
+        raise
+
+    async def detect_one(name: str, content: bytes) -> dict:
+        _geometry_fallback.set(False)
+        try:
+            page = await _detect_page(content, detector)
+        except Exception as e:
+            _record_error("/api/batch/jobs", e, model=detector, document=name)
+            raise
+        _observe("/api/batch/jobs", detector, page["timings_ms"], len(page["boxes"]))
+        return page
+
+    job_id = secrets.token_urlsafe(12)
+    job = {
+        "id": job_id,
+        "runner": BatchRunner(detect_one, concurrency=BATCH_CONCURRENCY, rate_per_s=BATCH_RATE_PER_S),
+        "created_at": time.time(),
+        "finished_at": None,
+        "spool": spool,
+    }
+    _batch_jobs[job_id] = job
+    job["task"] = asyncio.create_task(_run_batch_job(job, items))
+    return JSONResponse({"job_id": job_id, **job["runner"].summary(), "total": len(items)}, status_code=202)
+
+
+@app.get("/api/batch/jobs/{job_id}")
+async def batch_job_status(
+    job_id: str,
+    include_results: bool = Query(False, description="Include per-document results"),
+    dep: None = Depends(frontend_only),
+):
+    job = _batch_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="job not found")
+    runner = job["runner"]
+    body = {"job_id": job_id, **runner.summary(), "errors": runner.errors}
+    if include_results:
+        body["results"] = list(runner.results.values())
+    return JSONResponse(body)
+
+
 @app.post("/api/form/draw_boxes")
 async def draw_boxes(
     file: UploadFile = File(...),
     detector: str = Query(
         "gemini-2.5-flash-lite",
-        description="Model for boxes-only: gemini-2.5-flash-lite or gemini-2.5-pro",
+        description="Model for boxes-only: gemini-2.5-flash-lite, gemini-2.5-pro, or geometry (no model call)",
     ),
-    dep: None = Depends(frontend_only),
+    dep: None = Depends(admitted),
 ):
     """Detects fields and returns only bounding box locations as JSON."""
-    content = await file.read()
-    mime_type = file.content_type or "image/png"
+    t_route_start = time.perf_counter()
+    content = (await _read_upload(file, IMAGE_MIME_TYPES)).data
     try:
-        combined, _ = _detect_and_fake(content, mime_type, detector)
-        boxes = []
-        for item in combined:
-            box = item.get("box_2d")
-            if isinstance(box, list) and len(box) == 4:
-                boxes.append({"box_2d": box})
-        return JSONResponse({"normalized_scale": 1000, "boxes": boxes})
+        fields, t_combined = await _cached_detect_and_fake(content, detector)
+        boxes = fields.postprocess().box_dicts()
+        total_ms = int((time.perf_counter() - t_route_start) * 1000)
+        timings_ms = {
+            "cache": t_combined.get("cache"),
+            "cache_lookup_ms": t_combined.get("cache_lookup_ms", 0),
+            "image_bytes_in": t_combined.get("image_bytes_in", 0),
+            "image_bytes_out": t_combined.get("image_bytes_out", 0),
+            "template": t_combined.get("template"),
+            "template_lookup_ms": t_combined.get("template_lookup_ms", 0),
+            "model_used": t_combined.get("model_used"),
+            "escalation_reason": t_combined.get("escalation_reason"),
+            "fallback_reason": t_combined.get("fallback_reason"),
+            **{key: t_combined.get(key, 0) for key in TOKEN_KEYS},
+            "total_ms": total_ms,
+        }
+        _observe("/api/form/draw_boxes", detector, timings_ms, len(boxes))
+        return JSONResponse({
+            "normalized_scale": 1000,
+            "boxes": boxes,
+            "timings_ms": timings_ms,
+        })
     except Exception as e:
+        _record_error("/api/form/draw_boxes", e, model=detector)
         # Be lenient for boxes-only route: return empty boxes on model/parse errors
         return JSONResponse({"normalized_scale": 1000, "boxes": [], "error": str(e)})
 
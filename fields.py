@@ -0,0 +1,132 @@
+"""Typed, column-oriented representation of the fields detected on one page.
+
+`Fields` keeps every box of a page in one (n, 4) NumPy array of
+[y_min, x_min, y_max, x_max] in 0-1000 space, plus a parallel list of texts.
+All routes share it: validation, clamping, degenerate-box removal, small-box
+(checkbox) classification and scaling to pixels run as one vectorized pass over
+the array instead of per-field Python arithmetic.
+"""
+from typing import Iterable, Iterator, Optional
+
+import numpy as np
+
+NORMALIZED_SCALE = 1000
+
+
+def normalize_entry(entry) -> Optional[dict]:
+    """Normalize one model array element to {"box_2d", "text"}; None when unusable."""
+    if isinstance(entry, dict) and ("input_box_2d" in entry or "box_2d" in entry):
+        # Prefer input_box_2d when present; fall back to single box_2d
+        box = entry.get("input_box_2d") or entry.get("box_2d")
+        txt = entry.get("text", "")
+    elif isinstance(entry, list) and len(entry) >= 4:
+        # Some models might emit just arrays
+        box, txt = entry[:4], ""
+    else:
+        return None
+    # Coerce None/'None' to empty string
+    if isinstance(txt, str):
+        if txt.strip().lower() == "none":
+            txt = ""
+    elif txt is None:
+        txt = ""
+    return {"box_2d": box, "text": txt}
+
+
+def _valid_box(box) -> bool:
+    return (
+        isinstance(box, (list, tuple))
+        and len(box) == 4
+        and all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in box)
+    )
+
+
+class Fields:
+    __slots__ = ("boxes", "texts")
+
+    def __init__(self, boxes: np.ndarray, texts: list):
+        self.boxes = boxes
+        self.texts = texts
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    @classmethod
+    def empty(cls) -> "Fields":
+        return cls(np.zeros((0, 4), dtype=np.int32), [])
+
+    @classmethod
+    def from_entries(cls, entries: Iterable[dict]) -> "Fields":
+        """Build from normalized {"box_2d", "text"} entries; malformed boxes are dropped."""
+        entries = list(entries)
+        texts = [e.get("text") or "" for e in entries]
+        try:
+            # Fast path: every box is a list of four numbers
+            boxes = np.asarray([e.get("box_2d") for e in entries], dtype=np.float64)
+            if boxes.ndim != 2 or boxes.shape[1] != 4:
+                raise ValueError("ragged boxes")
+        except (ValueError, TypeError):
+            keep = [i for i, e in enumerate(entries) if _valid_box(e.get("box_2d"))]
+            boxes = np.asarray([entries[i]["box_2d"] for i in keep], dtype=np.float64)
+            texts = [texts[i] for i in keep]
+        return cls(boxes.reshape(-1, 4), texts)
+
+    @classmethod
+    def from_model_output(cls, data) -> "Fields":
+        """Build from the parsed model JSON array."""
+        if not isinstance(data, list):
+            return cls.empty()
+        entries = [e for e in map(normalize_entry, data) if e is not None]
+        return cls.from_entries(entries)
+
+    @classmethod
+    def from_json(cls, obj) -> "Fields":
+        """Inverse of to_json; also accepts a list of entries (older cache records)."""
+        if isinstance(obj, list):
+            return cls.from_entries(obj)
+        boxes = np.asarray(obj.get("boxes") or [], dtype=np.float64).reshape(-1, 4)
+        return cls(boxes, list(obj.get("texts") or []))
+
+    def to_json(self) -> dict:
+        return {"boxes": self.boxes.tolist(), "texts": list(self.texts)}
+
+    def postprocess(self, width: Optional[int] = None, small_box_px: int = 0) -> "Fields":
+        """Validate, clamp and classify in one vectorized pass.
+
+        Non-finite boxes are dropped, coordinates are clamped to 0-1000, rounded and put in
+        min/max order, and zero-area boxes are removed. When `width` is given, boxes at most
+        `small_box_px` pixels wide are treated as checkboxes and their text becomes "x".
+        """
+        b = self.boxes
+        if len(b) == 0:
+            return Fields.empty()
+        finite = np.isfinite(b).all(axis=1)
+        b = np.rint(np.clip(np.nan_to_num(b), 0, NORMALIZED_SCALE))
+        y0 = np.minimum(b[:, 0], b[:, 2])
+        y1 = np.maximum(b[:, 0], b[:, 2])
+        x0 = np.minimum(b[:, 1], b[:, 3])
+        x1 = np.maximum(b[:, 1], b[:, 3])
+        keep = finite & (y1 > y0) & (x1 > x0)
+        boxes = np.stack([y0, x0, y1, x1], axis=1)[keep].astype(np.int32)
+        idx = np.flatnonzero(keep)
+        texts = self.texts
+        if width is not None:
+            width_px = np.floor((boxes[:, 3] - boxes[:, 1]) / NORMALIZED_SCALE * width)
+            small = (width_px <= small_box_px).tolist()
+            new_texts = ["x" if s else texts[i] for i, s in zip(idx.tolist(), small)]
+        else:
+            new_texts = [texts[i] for i in idx.tolist()]
+        return Fields(boxes, new_texts)
+
+    def to_pixels(self, width: int, height: int) -> np.ndarray:
+        """(n, 4) int array of [x0, y0, x1, y1] pixel corners for an image of the given size."""
+        scale = np.array([width, height, width, height], dtype=np.float64) / NORMALIZED_SCALE
+        return (self.boxes[:, [1, 0, 3, 2]] * scale).astype(np.int64)
+
+    def box_dicts(self) -> list:
+        """Boxes in the API response shape: [{"box_2d": [y_min, x_min, y_max, x_max]}, ...]."""
+        return [{"box_2d": box} for box in self.boxes.tolist()]
+
+    def entries(self) -> Iterator[dict]:
+        for box, text in zip(self.boxes.tolist(), self.texts):
+            yield {"box_2d": box, "text": text}
@@ -0,0 +1,204 @@
+"""Geometric field detector: writable areas found from the lines printed on the page.
+
+Many writable fields are drawn with rules: underlines to write on, boxes and table
+cells to write in, and checkboxes. `detect_fields` finds them with NumPy on a
+binarized, downscaled copy of the page, in milliseconds and without a model call:
+- a closed rectangle is a pair of horizontal strokes with the same extent, joined by
+  vertical strokes, with a mostly blank interior; strokes between the same pair of
+  lines split it into cells. Rectangles that contain other rectangles are frames and
+  are dropped;
+- an underline is a long horizontal rule that is not the edge of a rectangle; its
+  field is the band above it, `_FIELD_HEIGHT` of the page high or up to the next rule.
+
+Boxes come back as Fields in 0-1000 coordinates with empty texts, so the routes'
+post-processing (checkbox classification by SMALL_BOX_PX_THRESHOLD) applies
+unchanged. Dotted leaders, curved shapes and fields without any printed line are not
+found: this is a fast path and a fallback, not a replacement for the model.
+"""
+from bisect import bisect_right
+import io
+
+import numpy as np
+from PIL import Image, ImageOps
+
+from fields import NORMALIZED_SCALE, Fields
+from image_prep import flatten_alpha
+
+# Pages are binarized at this long edge: enough for checkboxes, small enough for ~20 ms a page
+WORK_LONG_EDGE = 1600
+# A pixel is ink when darker than this fraction of the paper brightness
+_INK_RATIO = 0.7
+# Runs of ink in a row interrupted by at most this many pixels are one stroke (scan noise)
+_MAX_GAP_PX = 1
+# Lengths and heights as fractions of the page's long edge
+_MIN_BOX_SIDE = 0.005  # smallest checkbox side
+_MAX_STROKE = 0.005  # thickest rule
+_MAX_BOX_HEIGHT = 0.12  # tallest box
+_MIN_RULE = 0.04  # shortest underline
+_FIELD_HEIGHT = 0.022  # height of the writing band above an underline
+# Vertical strokes cover at least this much of a box side; interiors hold at most this much ink
+_MIN_SIDE_COVERAGE = 0.85
+_MAX_INTERIOR_INK = 0.25
+
+
+def _binarize(img: Image.Image) -> np.ndarray:
+    gray = np.asarray(img.convert("L"), dtype=np.uint8)
+    paper = np.percentile(gray[::4, ::4], 90)
+    return gray < _INK_RATIO * paper
+
+
+def _horizontal_strokes(ink: np.ndarray, min_len: int, max_thickness: int) -> np.ndarray:
+    """Thin horizontal strokes as an (n, 4) array of [top, bottom, x0, x1] (bottom/x1 exclusive).
+
+    Runs of ink per row are found at once with a diff over the whole mask; runs in
+    consecutive rows that overlap are then stacked into one stroke.
+    """
+    padded = np.zeros((ink.shape[0], ink.shape[1] + 2), dtype=np.int8)
+    padded[:, 1:-1] = ink
+    edges = np.diff(padded, axis=1)
+    rows, cols = np.nonzero(edges)
+    if len(rows) == 0:
+        return np.zeros((0, 4), dtype=np.int64)
+    # Every run opens (+1) and closes (-1) in the same row, so they alternate
+    rows, starts, ends = rows[::2], cols[::2], cols[1::2]
+    # Close small gaps within a row
+    new_group = np.ones(len(rows), dtype=bool)
+    new_group[1:] = (rows[1:] != rows[:-1]) | (starts[1:] - ends[:-1] > _MAX_GAP_PX)
+    first = np.flatnonzero(new_group)
+    rows, starts, ends = rows[first], starts[first], np.maximum.reduceat(ends, first)
+    keep = ends - starts >= min_len
+    rows, starts, ends = rows[keep].tolist(), starts[keep].tolist(), ends[keep].tolist()
+
+    strokes = []  # [top, bottom, x0, x1]
+    open_strokes: list = []  # indices of strokes that reached the previous row
+    current: list = []
+    row_now = -1
+    for row, x0, x1 in zip(rows, starts, ends):
+        if row != row_now:
+            open_strokes = current if row == row_now + 1 else []
+            current = []
+            row_now = row
+        for i in open_strokes:
+            s = strokes[i]
+            if min(x1, s[3]) - max(x0, s[2]) > 0.5 * min(x1 - x0, s[3] - s[2]):
+                s[1], s[2], s[3] = row + 1, min(s[2], x0), max(s[3], x1)
+                if i not in current:
+                    current.append(i)
+                break
+        else:
+            strokes.append([row, row + 1, x0, x1])
+            current.append(len(strokes) - 1)
+    out = np.array(strokes, dtype=np.int64).reshape(-1, 4)
+    return out[out[:, 1] - out[:, 0] <= max_thickness]
+
+
+def _column_runs(mask: np.ndarray) -> list:
+    """[(start, end)] of consecutive True values."""
+    padded = np.concatenate([[False], mask, [False]])
+    edges = np.flatnonzero(padded[1:] != padded[:-1])
+    return list(zip(edges[::2].tolist(), edges[1::2].tolist()))
+
+
+def _ends_touch(ink: np.ndarray, strokes: np.ndarray, rows: np.ndarray, tol: int) -> np.ndarray:
+    """Per stroke: whether there is ink in `rows` (one per stroke) near both of its ends."""
+    height, width = ink.shape
+    offsets = np.arange(-tol, tol + 1)
+    rows = np.clip(rows, 0, height - 1)[:, None]
+    left = np.clip(strokes[:, 2:3] + offsets, 0, width - 1)
+    right = np.clip(strokes[:, 3:4] - 1 + offsets, 0, width - 1)
+    return ink[rows, left].any(axis=1) & ink[rows, right].any(axis=1)
+
+
+def _rectangles(ink: np.ndarray, strokes: np.ndarray, min_side: int, max_height: int, tol: int) -> tuple:
+    """Cells bounded by pairs of same-extent strokes and vertical strokes; returns (cells, used stroke indices).
+
+    Only strokes with ink just below (tops) or above (bottoms) both of their ends can
+    be rectangle edges, which leaves out most strokes of printed text.
+    """
+    cells, used = [], set()
+    is_top = np.flatnonzero(_ends_touch(ink, strokes, strokes[:, 1] + min_side // 2, tol))
+    is_bottom = np.flatnonzero(_ends_touch(ink, strokes, strokes[:, 0] - 1 - min_side // 2, tol))
+    if not len(is_top) or not len(is_bottom):
+        return np.zeros((0, 4), dtype=np.int64), used
+    is_bottom = is_bottom[np.argsort(strokes[is_bottom, 0], kind="stable")]
+    bottoms = strokes[is_bottom]
+    bottom_tops = bottoms[:, 0].tolist()
+    for i in is_top.tolist():
+        top, bottom, x0, x1 = strokes[i].tolist()
+        lo = bisect_right(bottom_tops, bottom + min_side - 1)
+        hi = bisect_right(bottom_tops, top + max_height)
+        if lo >= hi:
+            continue
+        below = bottoms[lo:hi]
+        same = np.flatnonzero((np.abs(below[:, 2] - x0) <= tol) & (np.abs(below[:, 3] - x1) <= tol))
+        for j in same.tolist():
+            b_top, b_bottom, b_x0, b_x1 = below[j].tolist()
+            left, right = max(min(x0, b_x0) - tol, 0), min(max(x1, b_x1) + tol, ink.shape[1])
+            coverage = ink[bottom:b_top, left:right].mean(axis=0)
+            sides = _column_runs(coverage >= _MIN_SIDE_COVERAGE)
+            found = False
+            for (l_start, l_end), (r_start, r_end) in zip(sides, sides[1:]):
+                if r_start - l_end < min_side:
+                    continue
+                interior = ink[bottom:b_top, l_end:r_start]
+                if interior.mean() > _MAX_INTERIOR_INK:
+                    continue
+                cells.append([top, left + l_start, b_bottom, left + r_end])
+                found = True
+            if found:
+                used.update((i, int(is_bottom[lo + j])))
+                break
+    return _drop_frames(np.array(cells, dtype=np.int64).reshape(-1, 4)), used
+
+
+def _drop_frames(cells: np.ndarray) -> np.ndarray:
+    """Drop rectangles that contain another one (a frame around cells or checkboxes)."""
+    if len(cells) < 2:
+        return cells
+    inside = (
+        (cells[None, :, 0] >= cells[:, None, 0]) & (cells[None, :, 1] >= cells[:, None, 1])
+        & (cells[None, :, 2] <= cells[:, None, 2]) & (cells[None, :, 3] <= cells[:, None, 3])
+    )
+    np.fill_diagonal(inside, False)
+    return cells[~inside.any(axis=1)]
+
+
+def _underlines(strokes: np.ndarray, used: set, min_len: int, field_height: int) -> np.ndarray:
+    """Writing bands above the long strokes that are not rectangle edges."""
+    rules = [s for i, s in enumerate(strokes.tolist()) if i not in used and s[3] - s[2] >= min_len]
+    bands = []
+    for top, _, x0, x1 in rules:
+        ceiling = top - field_height
+        for other_top, other_bottom, o_x0, o_x1 in rules:
+            if other_bottom <= top and other_bottom > ceiling and min(x1, o_x1) - max(x0, o_x0) > 0.5 * (x1 - x0):
+                ceiling = other_bottom
+        bands.append([max(ceiling, 0), x0, top, x1])
+    return np.array(bands, dtype=np.int64).reshape(-1, 4)
+
+
+def find_fields(ink: np.ndarray) -> Fields:
+    """Fields on a binarized page (True = ink); boxes in 0-1000, texts empty."""
+    height, width = ink.shape
+    long_edge = max(height, width)
+    min_side = max(3, round(_MIN_BOX_SIDE * long_edge))
+    strokes = _horizontal_strokes(ink, min_side, max(2, round(_MAX_STROKE * long_edge)))
+    cells, used = _rectangles(ink, strokes, min_side, round(_MAX_BOX_HEIGHT * long_edge), max(2, min_side // 2))
+    bands = _underlines(strokes, used, round(_MIN_RULE * long_edge), round(_FIELD_HEIGHT * long_edge))
+    # Rectangles as [top, left, bottom, right]; bands as [top, x0, bottom, x1]: both y0, x0, y1, x1
+    boxes = np.concatenate([cells, bands]).astype(np.float64)
+    boxes *= NORMALIZED_SCALE / np.array([height, width, height, width], dtype=np.float64)
+    return Fields(boxes, [""] * len(boxes))
+
+
+def detect_fields(content: bytes, max_long_edge: int = WORK_LONG_EDGE) -> Fields:
+    """Decode an image (EXIF-rotated, downscaled to `max_long_edge`) and find its fields."""
+    with Image.open(io.BytesIO(content)) as img:
+        scale = min(1.0, max_long_edge / max(img.size))
+        if scale < 1.0 and img.format == "JPEG":
+            img.draft("L", (round(img.width * scale), round(img.height * scale)))
+        img = flatten_alpha(ImageOps.exif_transpose(img))
+        scale = max_long_edge / max(img.size)
+        if scale < 1.0:
+            size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+            img = img.resize(size, Image.Resampling.BILINEAR, reducing_gap=2.0)
+        return find_fields(_binarize(img))
@@ -0,0 +1,148 @@
+"""Normalize uploaded page images before they are sent to the model.
+
+Phone photos and 2x-rendered PDF pages are often several megabytes. The model only
+needs a readable page, so we fix EXIF orientation, drop colour when the page is
+effectively grayscale, cap the long edge and re-encode compactly.
+
+Box coordinates come back normalized to 0-1000. Preprocessing only rotates and
+scales the page uniformly, so those coordinates map back to the original (oriented)
+page unchanged. Pixel math has to use `width`/`height` here, not the re-encoded size.
+"""
+from dataclasses import dataclass
+import io
+import math
+
+from PIL import Image, ImageOps, ImageStat
+
+# EXIF orientations that swap width and height (90/270 degree rotations)
+_TRANSPOSED_ORIENTATIONS = {5, 6, 7, 8}
+_EXIF_ORIENTATION_TAG = 0x0112
+# Chroma std-dev (0-255) below which a page is treated as grayscale
+_GRAYSCALE_CHROMA_STDDEV = 4.0
+
+_FORMATS = {
+    "jpeg": ("JPEG", "image/jpeg"),
+    "webp": ("WEBP", "image/webp"),
+}
+
+
+@dataclass
+class PreparedImage:
+    data: bytes
+    mime_type: str
+    # Original page size after EXIF orientation; what the 0-1000 coordinates refer to
+    width: int
+    height: int
+    bytes_in: int
+    bytes_out: int
+
+
+def oriented_size(img: Image.Image) -> tuple[int, int]:
+    """Page size as displayed, read from the header without decoding pixels."""
+    width, height = img.size
+    if img.getexif().get(_EXIF_ORIENTATION_TAG) in _TRANSPOSED_ORIENTATIONS:
+        return height, width
+    return width, height
+
+
+def _is_grayscale(img: Image.Image) -> bool:
+    if img.mode in ("1", "L", "LA", "I", "I;16", "F"):
+        return True
+    sample = img if img.mode == "RGB" else img.convert("RGB")
+    sample = sample.reduce(max(1, max(sample.size) // 128))
+    _, cb_std, cr_std = ImageStat.Stat(sample.convert("YCbCr")).stddev
+    return cb_std < _GRAYSCALE_CHROMA_STDDEV and cr_std < _GRAYSCALE_CHROMA_STDDEV
+
+
+def encode_image(img: Image.Image, fmt: str = "jpeg", quality: int = 85) -> tuple[bytes, str]:
+    """Encode a page (or part of one) the way it is sent to the model; returns (bytes, MIME type)."""
+    if fmt not in _FORMATS:
+        raise ValueError(f"unsupported image format: {fmt}")
+    pil_format, mime_type = _FORMATS[fmt]
+    target_mode = "L" if _is_grayscale(img) else "RGB"
+    if img.mode != target_mode:
+        img = img.convert(target_mode)
+    out = io.BytesIO()
+    img.save(out, format=pil_format, quality=quality, optimize=True)
+    return out.getvalue(), mime_type
+
+
+def flatten_alpha(img: Image.Image) -> Image.Image:
+    """Flatten transparency onto white paper; other modes are returned unchanged."""
+    if img.mode not in ("RGBA", "LA", "P", "PA"):
+        return img
+    rgba = img.convert("RGBA")
+    flat = Image.new("RGB", rgba.size, (255, 255, 255))
+    flat.paste(rgba, mask=rgba.getchannel("A"))
+    return flat
+
+
+def prepare_image(content: bytes, max_long_edge: int = 2048, fmt: str = "jpeg", quality: int = 85) -> PreparedImage:
+    """Return model-ready bytes for an uploaded image.
+
+    The original bytes are kept when re-encoding would not make them smaller and the
+    page needed no rotation or downscaling.
+    """
+    if fmt not in _FORMATS:
+        raise ValueError(f"unsupported image format: {fmt}")
+    with Image.open(io.BytesIO(content)) as img:
+        source_mime = Image.MIME.get(img.format or "", "image/png")
+        needs_rotation = img.getexif().get(_EXIF_ORIENTATION_TAG, 1) != 1
+        width, height = oriented_size(img)
+        scale = max_long_edge / max(width, height) if max_long_edge > 0 else 1.0
+        if scale < 1.0 and img.format == "JPEG":
+            # Let the JPEG decoder downscale by 2/4/8 where that still leaves the target size:
+            # a fraction of the pixels (and memory) of a full decode
+            img.draft(img.mode, (math.ceil(img.width * scale), math.ceil(img.height * scale)))
+        if needs_rotation:
+            img = ImageOps.exif_transpose(img)
+
+        img = flatten_alpha(img)
+        if scale < 1.0:
+            target = (max(1, round(width * scale)), max(1, round(height * scale)))
+            if img.size != target:
+                img = img.resize(target, Image.Resampling.LANCZOS)
+        # Mode changes after downscaling, and only when needed: each one copies the page
+        data, mime_type = encode_image(img, fmt, quality)
+
+    if len(data) >= len(content) and scale >= 1.0 and not needs_rotation:
+        data, mime_type = content, source_mime
+    return PreparedImage(
+        data=data,
+        mime_type=mime_type,
+        width=width,
+        height=height,
+        bytes_in=len(content),
+        bytes_out=len(data),
+    )
+
+
+def check_pdf_pages(doc, scale: float, max_pages: int = 0, max_pixels: int = 0) -> None:
+    """Raise ValueError when an open PDF has more than max_pages pages, or a page that would
+    rasterize to more than max_pixels at `scale` (0 disables either). Reads page sizes only."""
+    if max_pages and doc.page_count > max_pages:
+        raise ValueError(f"document has {doc.page_count} pages, limit is {max_pages}")
+    if max_pixels:
+        for number, page in enumerate(doc, start=1):
+            width, height = page.rect.width * scale, page.rect.height * scale
+            if width * height > max_pixels:
+                raise ValueError(f"page {number} renders to {width:.0f}x{height:.0f} px, limit is {max_pixels} pixels")
+
+
+def render_pdf_pages(content: bytes, scale: float = 2.0, max_pages: int = 0, max_pixels: int = 0) -> list[bytes]:
+    """Rasterize PDF pages to PNG bytes, matching the browser's pdf.js render scale.
+
+    Raises ValueError, before rendering anything, when the document has more than max_pages
+    pages or a page over max_pixels (0 means no limit; see check_pdf_pages).
+    """
+    try:
+        import pymupdf
+    except Exception as exc:  # pragma: no cover
+        raise RuntimeError("PyMuPDF is not installed. pip install PyMuPDF") from exc
+    doc = pymupdf.open(stream=content, filetype="pdf")
+    try:
+        check_pdf_pages(doc, scale, max_pages, max_pixels)
+        matrix = pymupdf.Matrix(scale, scale)
+        return [page.get_pixmap(matrix=matrix).tobytes("png") for page in doc]
+    finally:
+        doc.close()
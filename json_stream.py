@@ -0,0 +1,58 @@
+"""Incremental parser for a JSON array that arrives in chunks.
+
+The model streams its answer as text fragments of one JSON array. `JsonArrayStream`
+returns each array element as soon as its closing bracket has arrived, so the
+caller can act on the first fields long before the array is complete.
+"""
+from typing import Any
+import json
+
+_SKIP = " \t\r\n,"
+
+
+class JsonArrayStream:
+    def __init__(self):
+        self._decoder = json.JSONDecoder()
+        self._buf = ""
+        self._pos = 0
+        self._started = False
+        self.done = False
+
+    def feed(self, text: str) -> list[Any]:
+        """Add a chunk and return the elements completed by it."""
+        if self.done or not text:
+            return []
+        self._buf += text
+        items = []
+        buf = self._buf
+        pos = self._pos
+        while True:
+            if not self._started:
+                start = buf.find("[", pos)
+                if start < 0:
+                    pos = len(buf)
+                    break
+                self._started = True
+                pos = start + 1
+            while pos < len(buf) and buf[pos] in _SKIP:
+                pos += 1
+            if pos >= len(buf):
+                break
+            if buf[pos] == "]":
+                self.done = True
+                pos += 1
+                break
+            try:
+                item, end = self._decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                # Element not complete yet; wait for more text
+                break
+            if end >= len(buf) and not isinstance(item, (dict, list, str)):
+                # A bare number/literal at the very end may still be growing
+                break
+            items.append(item)
+            pos = end
+        # Drop consumed text so the buffer stays one element long
+        self._buf = buf[pos:]
+        self._pos = 0
+        return items
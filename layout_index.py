@@ -0,0 +1,246 @@
+"""Layout fingerprints and a nearest-neighbour index of known form templates.
+
+A rescanned or re-photographed copy of a blank form has different bytes, so the
+result cache misses, but its field geometry is the same. `layout_fingerprint`
+reduces a page to the bits that survive rescanning: the page is cropped to its
+printed content (so margins and scan offsets drop out), downsampled to a small
+grid, and the edge map of that grid is thresholded into a 1024-bit hash. A finer
+128x128 ink map is kept alongside it to verify a candidate match.
+
+`TemplateIndex` keeps the fingerprints of pages we have already detected along with
+their fields. The nearest stored page by hash is accepted when it is within
+`max_distance` (fraction of differing bits), has the same aspect ratio, and at most
+`max_ink_delta` of either page's ink falls outside the other's (with one cell of
+slack). The stored fields are then mapped from the template's content box onto the
+query's, which undoes translation and scale between scans but not rotation; skewed
+scans fail the thresholds and go to the model. Differences of a few small marks
+(one extra checkbox on a dense page) are below what the fingerprint resolves.
+Like ResultCache, it lives in memory with an optional SQLite file behind it.
+"""
+from dataclasses import dataclass
+from typing import Optional
+import io
+import json
+import sqlite3
+import threading
+import time
+
+import numpy as np
+from PIL import Image, ImageFilter, ImageOps
+
+from fields import NORMALIZED_SCALE, Fields
+
+FINGERPRINT_GRID = 32
+INK_GRID = 128
+# Long edge the page is reduced to before cropping; enough to keep ruled lines visible
+_WORK_LONG_EDGE = 1024
+# Pixels darker than this (0-255) count as printed content
+_INK_THRESHOLD = 160
+# Pages with fewer ink cells than this (blank or nearly blank) have no layout to match on
+_MIN_INK_CELLS = 64
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint16)
+
+
+@dataclass
+class Fingerprint:
+    bits: np.ndarray  # packed uint8, FINGERPRINT_GRID**2 / 8 bytes
+    ink: np.ndarray  # packed uint8, INK_GRID**2 / 8 bytes
+    aspect: float  # page width / height
+    # Printed content box in 0-1000 page coordinates: [y_min, x_min, y_max, x_max]
+    content_box: tuple
+
+
+@dataclass
+class TemplateMatch:
+    fields: Fields
+    distance: float
+    template_id: int
+
+
+def layout_fingerprint(content: bytes) -> Fingerprint:
+    """Fingerprint the layout of an (upright) page image."""
+    with Image.open(io.BytesIO(content)) as img:
+        # JPEG can decode straight to a reduced size
+        img.draft("L", (_WORK_LONG_EDGE, _WORK_LONG_EDGE))
+        img = ImageOps.exif_transpose(img).convert("L")
+    width, height = img.size
+    img.thumbnail((_WORK_LONG_EDGE, _WORK_LONG_EDGE))
+    w, h = img.size
+    ink = img.point(lambda v: 255 if v < _INK_THRESHOLD else 0)
+    bbox = ink.getbbox() or (0, 0, w, h)
+    left, top, right, bottom = bbox
+    content_box = (
+        top * NORMALIZED_SCALE / h,
+        left * NORMALIZED_SCALE / w,
+        bottom * NORMALIZED_SCALE / h,
+        right * NORMALIZED_SCALE / w,
+    )
+    grid = FINGERPRINT_GRID + 2
+    small = ImageOps.autocontrast(img.crop(bbox)).resize((grid, grid), Image.Resampling.BOX)
+    # FIND_EDGES leaves the outer ring at zero; keep the interior
+    edges = np.asarray(small.filter(ImageFilter.FIND_EDGES), dtype=np.float32)[1:-1, 1:-1]
+    bits = np.packbits((edges > edges.mean()).ravel())
+    ink_map = np.asarray(ink.crop(bbox).resize((INK_GRID, INK_GRID), Image.Resampling.BOX)) > 24
+    return Fingerprint(bits=bits, ink=np.packbits(ink_map.ravel()), aspect=width / height, content_box=content_box)
+
+
+def _dilate(mask: np.ndarray) -> np.ndarray:
+    padded = np.pad(mask, 1)
+    out = np.zeros_like(mask)
+    for dy in range(3):
+        for dx in range(3):
+            out |= padded[dy:dy + mask.shape[0], dx:dx + mask.shape[1]]
+    return out
+
+
+def ink_delta(a: np.ndarray, b: np.ndarray) -> float:
+    """Largest fraction of either page's ink cells not near ink on the other page."""
+    a = np.unpackbits(a).reshape(INK_GRID, INK_GRID).astype(bool)
+    b = np.unpackbits(b).reshape(INK_GRID, INK_GRID).astype(bool)
+    a_only = (a & ~_dilate(b)).sum() / max(int(a.sum()), 1)
+    b_only = (b & ~_dilate(a)).sum() / max(int(b.sum()), 1)
+    return float(max(a_only, b_only))
+
+
+def align_fields(fields: Fields, src_box, dst_box) -> Fields:
+    """Map fields detected on a template onto a page whose content box is `dst_box`."""
+    src = np.asarray(src_box, dtype=np.float64)
+    dst = np.asarray(dst_box, dtype=np.float64)
+    src_size = np.maximum(src[2:] - src[:2], 1.0)
+    scale = (dst[2:] - dst[:2]) / src_size  # (y, x)
+    scale4 = np.tile(scale, 2)
+    boxes = (fields.boxes - np.tile(src[:2], 2)) * scale4 + np.tile(dst[:2], 2)
+    return Fields(boxes, list(fields.texts))
+
+
+class TemplateIndex:
+    """Nearest-neighbour lookup of detected pages by layout fingerprint.
+
+    Entries are scoped (model and prompt/preprocessing version), so a template is only
+    reused for the detector that produced it. The least recently matched entry is
+    evicted once `max_entries` is reached; 0 disables the index.
+    """
+
+    def __init__(self, max_entries: int, max_distance: float, max_ink_delta: float,
+                 max_aspect_delta: float = 0.03, db_path: Optional[str] = None):
+        self.max_entries = max_entries
+        self.max_distance = max_distance
+        self.max_ink_delta = max_ink_delta
+        self.max_aspect_delta = max_aspect_delta
+        nbytes = FINGERPRINT_GRID * FINGERPRINT_GRID // 8
+        self._bits = np.zeros((0, nbytes), dtype=np.uint8)
+        self._inks: list = []
+        self._aspects = np.zeros(0, dtype=np.float64)
+        self._used = np.zeros(0, dtype=np.float64)
+        self._scopes: list = []
+        self._meta: list = []  # (template_id, content_box, fields JSON text)
+        self._next_id = 1
+        self._lock = threading.Lock()
+        self._db = None
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS templates (id INTEGER PRIMARY KEY, scope TEXT, fingerprint BLOB,"
+                " ink BLOB, aspect REAL, content_box TEXT, fields TEXT, created_at REAL)"
+            )
+            self._db.commit()
+            self._load()
+
+    def __len__(self) -> int:
+        return len(self._meta)
+
+    @property
+    def persistent(self) -> bool:
+        """True with an SQLite file: add may then block on disk I/O, and lookup on add's lock."""
+        return self._db is not None
+
+    def _load(self) -> None:
+        rows = self._db.execute(
+            "SELECT id, scope, fingerprint, ink, aspect, content_box, fields, created_at FROM templates"
+            " ORDER BY created_at DESC LIMIT ?",
+            (max(self.max_entries, 0),),
+        ).fetchall()
+        for template_id, scope, bits, ink, aspect, content_box, raw, created_at in reversed(rows):
+            fp = Fingerprint(
+                np.frombuffer(bits, dtype=np.uint8), np.frombuffer(ink, dtype=np.uint8), aspect, tuple(json.loads(content_box))
+            )
+            self._append(template_id, scope, fp, raw, created_at)
+            self._next_id = max(self._next_id, template_id + 1)
+
+    def _append(self, template_id: int, scope: str, fp: Fingerprint, raw: str, used: float) -> None:
+        self._bits = np.vstack([self._bits, fp.bits[None, :]])
+        self._inks.append(fp.ink)
+        self._aspects = np.append(self._aspects, fp.aspect)
+        self._used = np.append(self._used, used)
+        self._scopes.append(scope)
+        self._meta.append((template_id, fp.content_box, raw))
+
+    def _match(self, fp: Fingerprint, scope: str):
+        """Index and hash distance of the stored template this page matches, or (None, distance)."""
+        if int(_POPCOUNT[fp.ink].sum()) < _MIN_INK_CELLS:
+            return None, 1.0
+        i, distance = self._nearest(fp, scope)
+        if i is None or distance > self.max_distance:
+            return None, distance
+        if ink_delta(self._inks[i], fp.ink) > self.max_ink_delta:
+            return None, distance
+        return i, distance
+
+    def _nearest(self, fp: Fingerprint, scope: str):
+        if not self._meta:
+            return None, 1.0
+        distances = _POPCOUNT[np.bitwise_xor(self._bits, fp.bits)].sum(axis=1) / (self._bits.shape[1] * 8)
+        eligible = np.abs(self._aspects / fp.aspect - 1.0) <= self.max_aspect_delta
+        eligible &= np.array([s == scope for s in self._scopes])
+        if not eligible.any():
+            return None, 1.0
+        distances = np.where(eligible, distances, np.inf)
+        i = int(np.argmin(distances))
+        return i, float(distances[i])
+
+    def lookup(self, fp: Fingerprint, scope: str) -> Optional[TemplateMatch]:
+        """Fields of the closest stored template, aligned to this page; None when nothing is close enough."""
+        if self.max_entries <= 0:
+            return None
+        with self._lock:
+            i, distance = self._match(fp, scope)
+            if i is None:
+                return None
+            self._used[i] = time.time()
+            template_id, content_box, raw = self._meta[i]
+        fields = align_fields(Fields.from_json(json.loads(raw)), content_box, fp.content_box)
+        return TemplateMatch(fields=fields, distance=round(distance, 4), template_id=template_id)
+
+    def add(self, fp: Fingerprint, scope: str, fields: Fields) -> None:
+        """Store a detected page; skipped when an equivalent template is already indexed."""
+        if self.max_entries <= 0 or not len(fields) or int(_POPCOUNT[fp.ink].sum()) < _MIN_INK_CELLS:
+            return
+        raw = json.dumps(fields.to_json(), separators=(",", ":"))
+        now = time.time()
+        with self._lock:
+            if self._match(fp, scope)[0] is not None:
+                return
+            if len(self._meta) >= self.max_entries:
+                self._evict(int(np.argmin(self._used)))
+            template_id = self._next_id
+            self._next_id += 1
+            self._append(template_id, scope, fp, raw, now)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT INTO templates (id, scope, fingerprint, ink, aspect, content_box, fields, created_at)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (template_id, scope, fp.bits.tobytes(), fp.ink.tobytes(), fp.aspect, json.dumps(list(fp.content_box)), raw, now),
+                )
+                self._db.commit()
+
+    def _evict(self, i: int) -> None:
+        template_id = self._meta[i][0]
+        self._bits = np.delete(self._bits, i, axis=0)
+        self._aspects = np.delete(self._aspects, i)
+        del self._inks[i]
+        self._used = np.delete(self._used, i)
+        del self._scopes[i]
+        del self._meta[i]
+        if self._db is not None:
+            self._db.execute("DELETE FROM templates WHERE id = ?", (template_id,))
+            self._db.commit()
@@ -0,0 +1,308 @@
+"""Prometheus-style metrics, request IDs and structured JSON logs.
+
+Metrics are kept in-process and rendered in the Prometheus text format by
+`render_metrics()` (served at /metrics). `RequestContextMiddleware` assigns each
+request an ID (reusing X-Request-ID when the caller sends one), tracks in-flight
+requests per route, request counts/durations and peak RSS growth per request.
+`log_event` writes one JSON object per line to stdout, the format Cloud Logging
+parses, tagged with the current request ID.
+"""
+from typing import Iterable, Optional
+import contextvars
+import json
+import math
+import os
+import secrets
+import sys
+import threading
+import time
+import traceback
+
+REQUEST_ID_HEADER = "x-request-id"
+request_id_var: contextvars.ContextVar = contextvars.ContextVar("request_id", default=None)
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 160, 360)
+BYTES_BUCKETS = tuple(16 * 1024 * 4 ** i for i in range(8))  # 16 KiB .. 256 MiB
+COUNT_BUCKETS = (0, 1, 5, 10, 25, 50, 100, 200, 500, 1000)
+# Stages that still run on a result cache hit; the others report 0 and would skew their histograms
+_CACHE_HIT_STAGES = {"cache_lookup_ms", "image_open_ms", "first_field_ms", "total_ms"}
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _fmt(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._values: dict = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_one(key, value))
+        return lines
+
+    def _render_one(self, key: tuple, value) -> list:
+        return [f"{self.name}{_labels(self.labelnames, key)} {_fmt(value)}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames: Iterable[str] = (), buckets: Iterable[float] = SECONDS_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def _render_one(self, key: tuple, value) -> list:
+        counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bound, n in zip(self.buckets, counts):
+            cumulative += n
+            le = 'le="' + _fmt(bound) + '"'
+            lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, le)} {cumulative}")
+        lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_fmt(total)}")
+        lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+_registry: list = []
+
+
+def _register(metric):
+    _registry.append(metric)
+    return metric
+
+
+def render_metrics() -> str:
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+REQUESTS = _register(Counter("fmp_http_requests_total", "HTTP requests by route and status code.", ("route", "status")))
+REQUEST_SECONDS = _register(Histogram("fmp_http_request_duration_seconds", "HTTP request duration.", ("route",)))
+REQUESTS_IN_FLIGHT = _register(Gauge("fmp_http_requests_in_flight", "HTTP requests currently being served.", ("route",)))
+INFERENCES_IN_FLIGHT = _register(Gauge("fmp_model_calls_in_flight", "Model calls currently running.", ("model",)))
+STAGE_SECONDS = _register(Histogram("fmp_stage_duration_seconds", "Pipeline stage duration (from timings_ms).", ("route", "model", "stage")))
+UPLOAD_BYTES = _register(Histogram("fmp_upload_bytes", "Uploaded image size.", ("route",), BYTES_BUCKETS))
+MODEL_INPUT_BYTES = _register(Histogram("fmp_model_input_bytes", "Image size sent to the model after preprocessing.", ("route",), BYTES_BUCKETS))
+BOXES_PER_PAGE = _register(Histogram("fmp_boxes_per_page", "Fields returned per page.", ("route", "model"), COUNT_BUCKETS))
+CACHE_LOOKUPS = _register(Counter("fmp_cache_lookups_total", "Result cache lookups by outcome.", ("route", "result")))
+TEMPLATE_LOOKUPS = _register(Counter("fmp_template_lookups_total", "Layout template index lookups by outcome.", ("route", "result")))
+CASCADE_ESCALATIONS = _register(Counter("fmp_cascade_escalations_total", "Cascade pages re-detected with the strong model, by reason.", ("route", "reason")))
+MODEL_FALLBACKS = _register(Counter("fmp_model_fallbacks_total", "Pages answered by the geometric detector after a model failure, by reason.", ("route", "reason")))
+MODEL_TOKENS = _register(Counter("fmp_model_tokens_total", "Model tokens used, by kind (prompt, output).", ("route", "model", "kind")))
+REQUEST_PEAK_RSS_BYTES = _register(Histogram(
+    "fmp_request_peak_rss_growth_bytes",
+    "Peak process RSS during a request minus RSS at its start (shared by overlapping requests).",
+    ("route",),
+    BYTES_BUCKETS,
+))
+PROCESS_RSS_BYTES = _register(Gauge("fmp_process_resident_memory_bytes", "Process RSS at the last request completion."))
+ADMISSION_REJECTIONS = _register(Counter("fmp_admission_rejections_total", "Requests refused with 429, by reason.", ("route", "reason")))
+MODEL_CALLS_QUEUED = _register(Gauge("fmp_model_calls_queued", "Model calls waiting for a slot in the fair queue."))
+ERRORS = _register(Counter("fmp_errors_total", "Errors by route and kind.", ("route", "kind")))
+
+
+def process_rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource
+        # ru_maxrss is KiB on Linux, bytes on macOS; only a fallback
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class RssTracker:
+    """Peak RSS growth per request, from a sampler thread that runs while requests are in flight.
+
+    Under concurrency a peak is attributed to every request in flight at the time, so
+    values are an upper bound per request; at concurrency 1 they are exact.
+    """
+
+    def __init__(self, interval_s: float = 0.01):
+        self.interval_s = interval_s
+        self._active: dict = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> object:
+        rss = process_rss_bytes()
+        token = object()
+        with self._lock:
+            self._active[token] = [rss, rss]
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="rss-sampler", daemon=True)
+                self._thread.start()
+        self._wake.set()
+        return token
+
+    def stop(self, token: object) -> int:
+        rss = process_rss_bytes()
+        with self._lock:
+            start, peak = self._active.pop(token)
+        PROCESS_RSS_BYTES.set(rss)
+        return max(0, max(peak, rss) - start)
+
+    def _run(self) -> None:
+        while True:
+            self._wake.wait()
+            rss = process_rss_bytes()
+            with self._lock:
+                if not self._active:
+                    self._wake.clear()
+                    continue
+                for entry in self._active.values():
+                    entry[1] = max(entry[1], rss)
+            time.sleep(self.interval_s)
+
+
+rss_tracker = RssTracker()
+
+
+def observe_timings(route: str, model: str, timings: dict, boxes: Optional[int] = None) -> None:
+    """Feed one response's timings_ms (and box count) into the metrics."""
+    cache_hit = timings.get("cache") == "hit"
+    for key, value in timings.items():
+        if cache_hit and key not in _CACHE_HIT_STAGES:
+            continue
+        if key.endswith("_ms") and isinstance(value, (int, float)):
+            STAGE_SECONDS.observe(value / 1000, route=route, model=model, stage=key[:-3])
+    if timings.get("image_bytes_in"):
+        UPLOAD_BYTES.observe(timings["image_bytes_in"], route=route)
+    if timings.get("image_bytes_out"):
+        MODEL_INPUT_BYTES.observe(timings["image_bytes_out"], route=route)
+    if timings.get("cache") in ("hit", "miss"):
+        CACHE_LOOKUPS.inc(route=route, result=timings["cache"])
+    if timings.get("template") in ("hit", "miss"):
+        TEMPLATE_LOOKUPS.inc(route=route, result=timings["template"])
+    if timings.get("escalation_reason"):
+        CASCADE_ESCALATIONS.inc(route=route, reason=timings["escalation_reason"])
+    if timings.get("fallback_reason"):
+        MODEL_FALLBACKS.inc(route=route, reason=timings["fallback_reason"])
+    for kind in ("prompt", "output"):
+        if timings.get(f"{kind}_tokens"):
+            MODEL_TOKENS.inc(timings[f"{kind}_tokens"], route=route, model=model, kind=kind)
+    if boxes is not None:
+        BOXES_PER_PAGE.observe(boxes, route=route, model=model)
+
+
+def log_event(message: str, severity: str = "INFO", exc: Optional[BaseException] = None, **fields) -> None:
+    """Write one structured log line; `exc` adds its traceback."""
+    record = {"severity": severity, "message": message, "request_id": request_id_var.get(), "time": time.time()}
+    record.update(fields)
+    if exc is not None:
+        record["error"] = str(exc)
+        record["traceback"] = "".join(traceback.format_exception(type(exc), exc, exc.__traceback__))
+    sys.stdout.write(json.dumps(record, default=str) + "\n")
+    sys.stdout.flush()
+
+
+class RequestContextMiddleware:
+    """ASGI middleware: request ID, in-flight gauge and request metrics per route.
+
+    Only paths in `routes` get their own label, to keep metric cardinality bounded.
+    Completion is measured when the response body has been fully sent, so streaming
+    responses stay in flight until their last chunk.
+    """
+
+    def __init__(self, app, routes: Iterable[str]):
+        self.app = app
+        self.routes = set(routes)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        route = scope["path"] if scope["path"] in self.routes else "other"
+        incoming = dict(scope.get("headers") or []).get(REQUEST_ID_HEADER.encode("latin-1"), b"").decode("latin-1")
+        request_id = incoming[:64] or secrets.token_hex(8)
+        token = request_id_var.set(request_id)
+        status = {"code": 500}
+        t0 = time.perf_counter()
+        rss_token = rss_tracker.start()
+        REQUESTS_IN_FLIGHT.inc(route=route)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                headers = list(message.get("headers") or [])
+                headers.append((REQUEST_ID_HEADER.encode("latin-1"), request_id.encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            REQUESTS_IN_FLIGHT.dec(route=route)
+            REQUESTS.inc(route=route, status=str(status["code"]))
+            REQUEST_SECONDS.observe(time.perf_counter() - t0, route=route)
+            REQUEST_PEAK_RSS_BYTES.observe(rss_tracker.stop(rss_token), route=route)
+            request_id_var.reset(token)
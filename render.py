@@ -0,0 +1,191 @@
+"""Server-side rendering of filled forms (what the browser does with Fabric.js and jsPDF).
+
+Texts are drawn into their boxes on the page image: each is fitted to its box (the
+requested size, shrunk to the box height and width) and vertically centred, like the
+UI places them. Fonts are loaded once per (family, size) and cached.
+
+`render_document` is a generator of output bytes. PDF output is written one page at a
+time by `PdfStreamWriter`, so a long document never holds more than one rendered page
+in memory.
+"""
+from typing import Iterable, Iterator, Optional
+import functools
+import io
+import os
+
+from PIL import Image, ImageDraw, ImageFont, ImageOps
+
+from image_prep import check_pdf_pages
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+FONTS_DIR = os.path.join(BASE_DIR, "fonts")
+# UI font choices -> font files, first found wins (PIL's built-in font otherwise)
+FONT_FILES = {
+    "Satisfy": [os.path.join(FONTS_DIR, "Satisfy.ttf")],
+    "Arial": [os.path.join(FONTS_DIR, "Arial.ttf"), "Arial.ttf", "DejaVuSans.ttf", "LiberationSans-Regular.ttf"],
+}
+MIN_FONT_SIZE = 6
+TEXT_PADDING_PX = 6
+PDF_JPEG_QUALITY = 90
+
+
+@functools.lru_cache(maxsize=256)
+def get_font(family: str, size: int) -> ImageFont.ImageFont:
+    """Font for a UI family name at a pixel size; loaded once and cached."""
+    for path in FONT_FILES.get(family, FONT_FILES["Arial"]):
+        try:
+            return ImageFont.truetype(path, size)
+        except OSError:
+            continue
+    return ImageFont.load_default(size)
+
+
+def _padding(box_width: float) -> float:
+    # Checkbox-sized boxes would have no room left with the full padding
+    return min(TEXT_PADDING_PX, box_width / 8)
+
+
+def fit_font_size(text: str, family: str, max_size: int, box_width: float, box_height: float) -> int:
+    """Largest size up to max_size at which `text` fits in the box (never below MIN_FONT_SIZE)."""
+    size = min(max_size, int(box_height * 0.9))
+    if size <= MIN_FONT_SIZE:
+        return MIN_FONT_SIZE
+    available = box_width - 2 * _padding(box_width)
+    length = get_font(family, size).getlength(text)
+    if length > available > 0:
+        # Text length scales linearly with size
+        size = int(size * available / length)
+    return max(MIN_FONT_SIZE, size)
+
+
+def draw_texts(img: Image.Image, boxes: Iterable, texts: list, family: str = "Satisfy",
+               font_size: int = 20, color: str = "#000000") -> Image.Image:
+    """Draw texts into their 0-1000 boxes on `img` (in place) and return it."""
+    draw = ImageDraw.Draw(img)
+    width, height = img.size
+    for i, box in enumerate(boxes):
+        text = str(texts[i]) if i < len(texts) and texts[i] is not None else ""
+        if not text or not (isinstance(box, (list, tuple)) and len(box) == 4):
+            continue
+        y0, x0, y1, x1 = (float(v) for v in box)
+        left, top = x0 / 1000 * width, y0 / 1000 * height
+        box_w, box_h = (x1 - x0) / 1000 * width, (y1 - y0) / 1000 * height
+        size = fit_font_size(text, family, font_size, box_w, box_h)
+        draw.text((left + _padding(box_w), top + box_h / 2), text, fill=color, font=get_font(family, size), anchor="lm")
+    return img
+
+
+class PdfStreamWriter:
+    """Minimal PDF writer for one JPEG image per page, emitted page by page.
+
+    Each `add_page` returns the bytes for that page's objects; `close` returns the page
+    tree, catalog, xref and trailer. Concatenated, the chunks form the document.
+    """
+
+    def __init__(self):
+        self._offset = 0
+        self._xref: dict = {}
+        self._pages: list = []
+        self._next_obj = 3  # 1: catalog, 2: page tree, written last
+
+    def _obj(self, num: int, body: bytes) -> bytes:
+        chunk = b"%d 0 obj\n" % num + body + b"\nendobj\n"
+        self._xref[num] = self._offset
+        self._offset += len(chunk)
+        return chunk
+
+    def _alloc(self) -> int:
+        num = self._next_obj
+        self._next_obj += 1
+        return num
+
+    def start(self) -> bytes:
+        header = b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n"
+        self._offset = len(header)
+        return header
+
+    def add_page(self, img: Image.Image, page_size: Optional[tuple] = None) -> bytes:
+        """Add a page showing `img`; page_size is (width, height) in points (image pixels by default)."""
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        buf = io.BytesIO()
+        img.save(buf, format="JPEG", quality=PDF_JPEG_QUALITY)
+        jpeg = buf.getvalue()
+        pw, ph = page_size or img.size
+        image_num, content_num, page_num = self._alloc(), self._alloc(), self._alloc()
+        colorspace = b"/DeviceGray" if img.mode == "L" else b"/DeviceRGB"
+        content = b"q %.2f 0 0 %.2f 0 0 cm /Im0 Do Q" % (pw, ph)
+        out = [
+            self._obj(image_num, b"<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace %s"
+                      b" /BitsPerComponent 8 /Filter /DCTDecode /Length %d >>\nstream\n" % (img.width, img.height, colorspace, len(jpeg))
+                      + jpeg + b"\nendstream"),
+            self._obj(content_num, b"<< /Length %d >>\nstream\n" % len(content) + content + b"\nendstream"),
+            self._obj(page_num, b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %.2f %.2f] /Contents %d 0 R"
+                      b" /Resources << /XObject << /Im0 %d 0 R >> >> >>" % (pw, ph, content_num, image_num)),
+        ]
+        self._pages.append(page_num)
+        return b"".join(out)
+
+    def close(self) -> bytes:
+        kids = b" ".join(b"%d 0 R" % n for n in self._pages)
+        out = [
+            self._obj(2, b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(self._pages))),
+            self._obj(1, b"<< /Type /Catalog /Pages 2 0 R >>"),
+        ]
+        xref_offset = self._offset
+        size = self._next_obj
+        lines = [b"xref\n0 %d\n" % size, b"0000000000 65535 f \n"]
+        for num in range(1, size):
+            lines.append(b"%010d 00000 n \n" % self._xref[num])
+        lines.append(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (size, xref_offset))
+        return b"".join(out + lines)
+
+
+def _page_images(content: bytes, is_pdf: bool, pdf_scale: float, max_pixels: int = 0) -> Iterator[tuple]:
+    """(page image, page size in points or None), one page decoded at a time.
+
+    PDF pages over max_pixels at pdf_scale raise ValueError before any is rendered.
+    """
+    if not is_pdf:
+        with Image.open(io.BytesIO(content)) as img:
+            img = ImageOps.exif_transpose(img)
+            # RGB even for grayscale scans, so coloured ink stays coloured
+            yield (img if img.mode == "RGB" else img.convert("RGB")), None
+        return
+    import pymupdf
+
+    doc = pymupdf.open(stream=content, filetype="pdf")
+    try:
+        check_pdf_pages(doc, pdf_scale, max_pixels=max_pixels)
+        matrix = pymupdf.Matrix(pdf_scale, pdf_scale)
+        for page in doc:
+            pix = page.get_pixmap(matrix=matrix, alpha=False)
+            img = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+            yield img, (page.rect.width, page.rect.height)
+    finally:
+        doc.close()
+
+
+def render_document(content: bytes, is_pdf: bool, pages: list, fmt: str, family: str = "Satisfy",
+                    font_size: int = 20, color: str = "#000000", pdf_scale: float = 2.0,
+                    max_pixels: int = 0) -> Iterator[bytes]:
+    """Yield the filled document as PNG (single page) or PDF, rendering one page at a time.
+
+    `pages[i]` is {"boxes": [...], "texts": [...]} for page i (boxes as in the detect
+    responses); pages without an entry are passed through unchanged.
+    """
+    writer = PdfStreamWriter() if fmt == "pdf" else None
+    if writer is not None:
+        yield writer.start()
+    for i, (img, page_size) in enumerate(_page_images(content, is_pdf, pdf_scale, max_pixels)):
+        page = pages[i] if i < len(pages) else {}
+        boxes = [b.get("box_2d") if isinstance(b, dict) else b for b in page.get("boxes") or []]
+        draw_texts(img, boxes, page.get("texts") or [], family, font_size, color)
+        if writer is None:
+            buf = io.BytesIO()
+            img.save(buf, format="PNG", optimize=False)
+            yield buf.getvalue()
+            return
+        yield writer.add_page(img, page_size)
+    if writer is not None:
+        yield writer.close()
@@ -0,0 +1,98 @@
+"""Content-addressed cache for model detection results.
+
+Entries are keyed by image hash, model name and prompt version, so a re-uploaded
+form returns without a model round trip. Two tiers:
+- an in-memory LRU bounded by total payload bytes and entry age
+- an optional SQLite file that survives instance restarts
+Values are stored as JSON text, so callers always get a fresh copy.
+"""
+from collections import OrderedDict
+from typing import Any, Optional
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+
+def cache_key(image_bytes: bytes, model: str, prompt_version: str) -> str:
+    digest = hashlib.sha256(image_bytes).hexdigest()
+    return f"{digest}:{model}:{prompt_version}"
+
+
+class ResultCache:
+    def __init__(self, max_bytes: int, ttl_s: float, db_path: Optional[str] = None):
+        self.max_bytes = max_bytes
+        self.ttl_s = ttl_s
+        self._entries: "OrderedDict[str, tuple[float, str]]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._db = None
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, created_at REAL, value TEXT)"
+            )
+            self._db.commit()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def persistent(self) -> bool:
+        """True with an SQLite tier: get/put may then block on disk I/O (and on each other's lock)."""
+        return self._db is not None
+
+    def get(self, key: str) -> Optional[Any]:
+        now = time.time()
+        with self._lock:
+            hit = self._entries.get(key)
+            if hit is not None:
+                created_at, raw = hit
+                if now - created_at <= self.ttl_s:
+                    self._entries.move_to_end(key)
+                    return json.loads(raw)
+                self._evict(key)
+            if self._db is None:
+                return None
+            row = self._db.execute(
+                "SELECT created_at, value FROM results WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            created_at, raw = row
+            if now - created_at > self.ttl_s:
+                self._db.execute("DELETE FROM results WHERE key = ?", (key,))
+                self._db.commit()
+                return None
+            # Promote disk hits into memory
+            self._insert(key, created_at, raw)
+            return json.loads(raw)
+
+    def put(self, key: str, value: Any) -> None:
+        raw = json.dumps(value, separators=(",", ":"))
+        now = time.time()
+        with self._lock:
+            self._insert(key, now, raw)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO results (key, created_at, value) VALUES (?, ?, ?)",
+                    (key, now, raw),
+                )
+                self._db.execute("DELETE FROM results WHERE created_at < ?", (now - self.ttl_s,))
+                self._db.commit()
+
+    def _insert(self, key: str, created_at: float, raw: str) -> None:
+        if len(raw) > self.max_bytes:
+            return
+        if key in self._entries:
+            self._evict(key)
+        self._entries[key] = (created_at, raw)
+        self._size += len(raw)
+        while self._size > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._evict(oldest)
+
+    def _evict(self, key: str) -> None:
+        _, raw = self._entries.pop(key)
+        self._size -= len(raw)
@@ -0,0 +1,166 @@
+"""Static files (the UI page, logo, fonts, preload image) served from memory with validators.
+
+Every asset is read once and gets a content-hash ETag and a Last-Modified date, so
+repeat visits revalidate with a 304 and transfer no body. Compressible types also get
+gzip and (when the `brotli` package is installed) brotli variants, built once rather
+than per response; clients are served the smallest encoding they accept.
+
+index.html references the other assets by content-hashed URL (`logo.png?v=<hash>`);
+those URLs are cached as immutable for a year, while the page itself is `no-cache`
+so a deploy is picked up on the next visit. Unversioned URLs keep working, with
+revalidation instead of the long max-age.
+"""
+from dataclasses import dataclass, field
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Optional
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+import threading
+
+try:
+    import brotli
+except Exception:  # pragma: no cover
+    brotli = None
+
+ENTRY_PAGE = "index.html"
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# The page sets per-visit session cookies, so shared caches must not keep it
+ENTRY_CACHE_CONTROL = "private, no-cache"
+REVALIDATE_CACHE_CONTROL = "public, no-cache"
+_COMPRESSIBLE = ("text/", "application/javascript", "application/json", "image/svg+xml", "font/ttf", "font/otf")
+# Variants must save at least this fraction of the identity size to be worth serving
+_MIN_SAVING = 0.1
+
+mimetypes.add_type("font/woff2", ".woff2")
+mimetypes.add_type("font/ttf", ".ttf")
+
+
+@dataclass
+class StaticAsset:
+    path: str  # URL path without the leading slash, e.g. "fonts/Satisfy.ttf"
+    media_type: str
+    version: str  # content hash; the ETag and the ?v= of versioned URLs
+    last_modified: str
+    mtime: float
+    # encoding ("identity", "br", "gzip") -> body
+    bodies: dict = field(default_factory=dict)
+
+    @property
+    def etag(self) -> str:
+        # Weak: the gzip and brotli bodies are the same representation
+        return f'W/"{self.version}"'
+
+
+def _compress(data: bytes, media_type: str) -> dict:
+    bodies = {"identity": data}
+    if not media_type.startswith(_COMPRESSIBLE):
+        return bodies
+    variants = {"gzip": gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants["br"] = brotli.compress(data, quality=11)
+    for encoding, body in variants.items():
+        if len(body) <= len(data) * (1 - _MIN_SAVING):
+            bodies[encoding] = body
+    return bodies
+
+
+def _accepted_encodings(header: str) -> set:
+    accepted = set()
+    for part in header.split(","):
+        name, _, params = part.strip().partition(";")
+        q = re.search(r"q=(\d+(?:\.\d*)?)", params)
+        if name and not (q and float(q.group(1)) == 0):
+            accepted.add(name.strip().lower())
+    return accepted
+
+
+class AssetStore:
+    """Immutable in-memory copies of a fixed set of files under `base_dir`, loaded on first use.
+
+    `load` reads and compresses everything (the server's background warm-up calls it);
+    until then the first `get` does it.
+    """
+
+    def __init__(self, base_dir: str, paths: list):
+        self.base_dir = base_dir
+        self.paths = paths
+        self._assets: Optional[dict] = None
+        self._lock = threading.Lock()
+
+    def load(self) -> dict:
+        with self._lock:
+            if self._assets is None:
+                assets = {}
+                for path in self.paths:
+                    # The entry page is compressed once its links are rewritten
+                    asset = self._read(path, compress=path != ENTRY_PAGE)
+                    if asset is not None:
+                        assets[path] = asset
+                entry = assets.get(ENTRY_PAGE)
+                if entry is not None:
+                    assets[ENTRY_PAGE] = self._with_versioned_links(entry, assets)
+                self._assets = assets
+            return self._assets
+
+    def get(self, path: str) -> Optional[StaticAsset]:
+        return self.load().get(path)
+
+    def _read(self, path: str, compress: bool = True) -> Optional[StaticAsset]:
+        full = os.path.join(self.base_dir, path)
+        try:
+            with open(full, "rb") as f:
+                data = f.read()
+            mtime = os.path.getmtime(full)
+        except OSError:
+            return None
+        media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        if media_type.startswith("text/"):
+            media_type += "; charset=utf-8"
+        return StaticAsset(
+            path=path,
+            media_type=media_type,
+            version=hashlib.sha256(data).hexdigest()[:16],
+            last_modified=formatdate(mtime, usegmt=True),
+            mtime=mtime,
+            bodies=_compress(data, media_type) if compress else {"identity": data},
+        )
+
+    def _with_versioned_links(self, entry: StaticAsset, assets: dict) -> StaticAsset:
+        """Point the page's quoted references to other assets at their content-hashed URLs."""
+        html = entry.bodies["identity"].decode("utf-8")
+        for path, asset in assets.items():
+            if path != ENTRY_PAGE:
+                html = re.sub(r"(?<=[\"'(])" + re.escape(path) + r"(?=[\"')])", f"{path}?v={asset.version}", html)
+        data = html.encode("utf-8")
+        return StaticAsset(
+            path=entry.path,
+            media_type=entry.media_type,
+            version=hashlib.sha256(data).hexdigest()[:16],
+            # The page changes when any asset it links to does
+            last_modified=formatdate(max(a.mtime for a in assets.values()), usegmt=True),
+            mtime=max(a.mtime for a in assets.values()),
+            bodies=_compress(data, entry.media_type),
+        )
+
+
+def not_modified(asset: StaticAsset, if_none_match: Optional[str], if_modified_since: Optional[str]) -> bool:
+    """Whether the client's cached copy is current. If-None-Match wins over If-Modified-Since."""
+    if if_none_match is not None:
+        tags = {t.strip().removeprefix("W/") for t in if_none_match.split(",")}
+        return "*" in tags or f'"{asset.version}"' in tags
+    if if_modified_since:
+        try:
+            return int(asset.mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def negotiate(asset: StaticAsset, accept_encoding: Optional[str]) -> str:
+    """The smallest stored encoding the client accepts."""
+    accepted = _accepted_encodings(accept_encoding or "")
+    candidates = [e for e in ("br", "gzip") if e in asset.bodies and e in accepted]
+    return min(candidates, key=lambda e: len(asset.bodies[e])) if candidates else "identity"
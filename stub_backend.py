@@ -0,0 +1,149 @@
+"""Local stand-in for the Gemini client, for offline benchmarks and tests.
+
+Select with DETECTOR_BACKEND:
+- "stub": `StubClient` answers from canned model output with a configurable latency.
+  Canned output is looked up in STUB_FIXTURES_DIR by the SHA-256 of the image the
+  model would receive; when none is recorded, deterministic synthetic fields are
+  generated from that hash, so the same image always gets the same answer.
+- "record": `RecordingClient` wraps the real client and saves every response to
+  STUB_FIXTURES_DIR, e.g. once over test_documents/, for the stub to replay.
+
+Both expose the `client.models.generate_content(_stream)` surface the server uses.
+"""
+from typing import Optional
+import hashlib
+import json
+import os
+import random
+import time
+
+_TEXTS = ["John Doe", "42 Main Street", "Springfield", "01/02/1990", "555-0100", "john@example.com", ""]
+
+
+def _image_digest(contents) -> str:
+    for part in contents:
+        inline = getattr(part, "inline_data", None)
+        if inline is not None and inline.data:
+            return hashlib.sha256(inline.data).hexdigest()
+    return hashlib.sha256(b"").hexdigest()
+
+
+def synthetic_fields(seed: str, count: int, compact: bool = False) -> list:
+    """Deterministic form-like fields: text lines plus some small checkboxes, in 0-1000 coordinates.
+
+    `compact` gives the schema-constrained format ({"box_2d", "text"}), else the verbose one.
+    """
+    rng = random.Random(seed)
+    fields = []
+    for i in range(count):
+        y = 40 + (i * 920) // max(count, 1)
+        if rng.random() < 0.25:
+            x = rng.randint(50, 900)
+            box = [y, x, y + 15, x + 15]
+            text = "x"
+        else:
+            x = rng.randint(50, 500)
+            box = [y, x, y + 20, min(980, x + rng.randint(100, 450))]
+            text = rng.choice(_TEXTS)
+        if compact:
+            fields.append({"box_2d": box, "text": text})
+        else:
+            fields.append({"label_box_2d": [y, max(0, x - 40), y + 20, x], "input_box_2d": box, "text": text})
+    return fields
+
+
+# Rough Gemini accounting: a fixed cost per image, about four characters per text token
+_IMAGE_TOKENS = 258
+_CHARS_PER_TOKEN = 4
+
+
+class _Usage:
+    def __init__(self, prompt_tokens: int, output_tokens: int):
+        self.prompt_token_count = prompt_tokens
+        self.candidates_token_count = output_tokens
+        self.total_token_count = prompt_tokens + output_tokens
+
+
+def _usage(contents, config, text: str) -> _Usage:
+    prompt_chars = len(getattr(config, "system_instruction", None) or "")
+    prompt_chars += sum(len(part) for part in contents if isinstance(part, str))
+    return _Usage(_IMAGE_TOKENS + prompt_chars // _CHARS_PER_TOKEN, -(-len(text) // _CHARS_PER_TOKEN))
+
+
+class _Response:
+    def __init__(self, text: str, usage_metadata: Optional[_Usage] = None):
+        self.text = text
+        self.usage_metadata = usage_metadata
+
+
+class _StubModels:
+    def __init__(self, fixtures_dir: Optional[str], latency_ms: float, fields: int):
+        self.fixtures_dir = fixtures_dir
+        self.latency_ms = latency_ms
+        self.fields = fields
+
+    def _answer(self, contents, config=None) -> str:
+        digest = _image_digest(contents)
+        if self.fixtures_dir:
+            path = os.path.join(self.fixtures_dir, f"{digest}.json")
+            if os.path.exists(path):
+                with open(path, "r", encoding="utf-8") as f:
+                    return f.read()
+        compact = getattr(config, "response_schema", None) is not None
+        return json.dumps(synthetic_fields(digest, self.fields, compact))
+
+    def generate_content(self, model: str, contents, config=None):
+        text = self._answer(contents, config)
+        time.sleep(self.latency_ms / 1000)
+        return _Response(text, _usage(contents, config, text))
+
+    def generate_content_stream(self, model: str, contents, config=None, chunks: int = 8):
+        text = self._answer(contents, config)
+        step = max(1, -(-len(text) // chunks))
+        for i in range(0, len(text), step):
+            time.sleep(self.latency_ms / 1000 / chunks)
+            last = i + step >= len(text)
+            yield _Response(text[i:i + step], _usage(contents, config, text) if last else None)
+
+
+class StubClient:
+    def __init__(self, fixtures_dir: Optional[str] = None, latency_ms: float = 0.0, fields: int = 40):
+        self.models = _StubModels(fixtures_dir, latency_ms, fields)
+
+
+def stub_client_from_env() -> StubClient:
+    return StubClient(
+        fixtures_dir=os.environ.get("STUB_FIXTURES_DIR") or None,
+        latency_ms=float(os.environ.get("STUB_LATENCY_MS", "0")),
+        fields=int(os.environ.get("STUB_FIELDS", "40")),
+    )
+
+
+class _RecordingModels:
+    def __init__(self, models, fixtures_dir: str):
+        self._models = models
+        self.fixtures_dir = fixtures_dir
+
+    def _save(self, contents, text: str) -> None:
+        os.makedirs(self.fixtures_dir, exist_ok=True)
+        path = os.path.join(self.fixtures_dir, f"{_image_digest(contents)}.json")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text)
+
+    def generate_content(self, model: str, contents, config=None):
+        resp = self._models.generate_content(model=model, contents=contents, config=config)
+        self._save(contents, resp.text or "")
+        return resp
+
+    def generate_content_stream(self, model: str, contents, config=None):
+        parts = []
+        for chunk in self._models.generate_content_stream(model=model, contents=contents, config=config):
+            parts.append(chunk.text or "")
+            yield chunk
+        self._save(contents, "".join(parts))
+
+
+class RecordingClient:
+    def __init__(self, client, fixtures_dir: str):
+        self._client = client
+        self.models = _RecordingModels(client.models, fixtures_dir)
@@ -0,0 +1,76 @@
+import asyncio
+import os
+import sys
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+if BASE_DIR not in sys.path:
+    sys.path.append(BASE_DIR)
+
+import pytest
+
+from admission import AdmissionController, AdmissionRejected, FairScheduler
+
+
+def test_waiting_calls_are_served_round_robin_across_sessions():
+    """A session with many queued calls does not starve one that arrives later."""
+    async def main():
+        scheduler = FairScheduler(1)
+        order = []
+        gate = asyncio.Event()
+
+        async def call(session, i):
+            async with scheduler.slot(session):
+                if i == 0:
+                    await gate.wait()
+                order.append(f"{session}{i}")
+
+        tasks = [asyncio.create_task(call("a", i)) for i in range(4)]
+        await asyncio.sleep(0)
+        tasks += [asyncio.create_task(call("b", i)) for i in range(1, 3)]
+        await asyncio.sleep(0)
+        assert scheduler.in_flight == 1 and scheduler.queued == 5
+        gate.set()
+        await asyncio.gather(*tasks)
+        assert scheduler.in_flight == 0 and scheduler.queued == 0
+        return order
+
+    assert asyncio.run(main()) == ["a0", "a1", "b1", "a2", "b2", "a3"]
+
+
+def test_cancelled_waiter_gives_up_its_place():
+    async def main():
+        scheduler = FairScheduler(1)
+        await scheduler.acquire("a")
+        waiter = asyncio.create_task(scheduler.acquire("b"))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        assert scheduler.queued == 0
+        scheduler.release()
+        assert scheduler.in_flight == 0
+
+    asyncio.run(main())
+
+
+def test_admission_refuses_with_retry_after():
+    controller = AdmissionController(capacity=1, max_queue=0, rate_per_s=1.0, burst=2)
+    controller.admit("a")
+    controller.admit("a")
+    with pytest.raises(AdmissionRejected) as e:
+        controller.admit("a")
+    assert e.value.status_code == 429 and e.value.reason == "rate_limited"
+    assert e.value.headers["Retry-After"] == "1"
+    controller.admit("b")  # buckets are per session
+
+    async def overloaded():
+        controller = AdmissionController(capacity=1, max_queue=1, rate_per_s=0, burst=1)
+        await controller.scheduler.acquire("a")
+        waiter = asyncio.create_task(controller.scheduler.acquire("a"))
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected) as e:
+            controller.admit("b")
+        assert e.value.reason == "overloaded"
+        controller.scheduler.release()
+        await waiter
+
+    asyncio.run(overloaded())
@@ -0,0 +1,90 @@
+import asyncio
+import json
+import os
+import sys
+import zipfile
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+if BASE_DIR not in sys.path:
+    sys.path.append(BASE_DIR)
+
+import pytest
+
+from batch import BatchRunner, read_zip_member, zip_image_members
+from uploads import UploadRejected
+
+PNG_MAGIC = b"\x89PNG\r\n\x1a\n"
+
+
+class _Transient(Exception):
+    code = 429
+
+
+def _items(n):
+    return [(f"doc{i}.png", (lambda i=i: f"bytes{i}".encode())) for i in range(n)]
+
+
+def test_transient_errors_are_retried_and_permanent_ones_recorded():
+    """429s are retried with backoff; a non-transient error fails the document without retrying."""
+    attempts = {}
+
+    async def detect(name, content):
+        attempts[name] = attempts.get(name, 0) + 1
+        if name == 'doc0.png' and attempts[name] < 3:
+            raise _Transient('rate limited')
+        if name == 'doc1.png':
+            raise ValueError('not an image')
+        return {'boxes': []}
+
+    runner = BatchRunner(detect, concurrency=2, backoff_base_s=0.001)
+    asyncio.run(runner.run(_items(3)))
+    assert runner.status == 'completed'
+    assert runner.results['doc0.png']['attempts'] == 3
+    assert attempts['doc1.png'] == 1
+    assert runner.failed == 1 and runner.done == 2
+
+
+def test_checkpoint_resume_skips_finished_documents(tmp_path):
+    """A second run over the same checkpoint only processes documents that did not finish."""
+    checkpoint = str(tmp_path / 'results.jsonl')
+    with open(checkpoint, 'w') as f:
+        f.write(json.dumps({'name': 'doc0.png', 'status': 'ok', 'boxes': []}) + '\n')
+        f.write('{"name": "doc1.png", "stat')  # truncated by an interrupted run
+    seen = []
+
+    async def detect(name, content):
+        seen.append(name)
+        return {'boxes': []}
+
+    runner = BatchRunner(detect, checkpoint_path=checkpoint)
+    asyncio.run(runner.run(_items(3)))
+    assert sorted(seen) == ['doc1.png', 'doc2.png']
+    assert runner.skipped == 1 and runner.done == 3
+
+
+def _zip(path, members):
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zf:
+        for name, data in members:
+            zf.writestr(name, data)
+    return str(path)
+
+
+def test_zip_members_are_typed_from_their_bytes_and_read_lazily(tmp_path):
+    path = _zip(tmp_path / "docs.zip", [
+        ("b.png", PNG_MAGIC + b"b"),
+        ("a.jpg", b"\xff\xd8\xff" + b"a"),
+        ("notes.png", b"not an image"),
+        ("scan", PNG_MAGIC + b"c"),
+        ("dir/", b""),
+    ])
+    assert zip_image_members(path) == [("a.jpg", 4), ("b.png", 9), ("scan", 9)]
+    assert read_zip_member(path, "scan") == PNG_MAGIC + b"c"
+
+
+def test_zip_bomb_is_refused_before_anything_is_extracted(tmp_path):
+    path = _zip(tmp_path / "bomb.zip", [("page.png", PNG_MAGIC + b"\0" * (64 * 1024 * 1024))])
+    assert os.path.getsize(path) < 1024 * 1024
+    for limits in ({"max_member_bytes": 16 * 1024 * 1024}, {"max_total_bytes": 16 * 1024 * 1024}):
+        with pytest.raises(UploadRejected) as e:
+            zip_image_members(path, **limits)
+        assert e.value.status_code == 413
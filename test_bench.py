@@ -0,0 +1,74 @@
+import asyncio
+import json
+import os
+import sys
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+if BASE_DIR not in sys.path:
+    sys.path.append(BASE_DIR)
+
+from bench import compare, percentile, run_benchmark, run_geometry
+from stub_backend import synthetic_fields
+
+
+def test_stub_answers_are_deterministic():
+    """The stub returns the same fields for the same image hash and different ones otherwise."""
+    assert synthetic_fields('abc', 10) == synthetic_fields('abc', 10)
+    assert synthetic_fields('abc', 10) != synthetic_fields('abd', 10)
+
+
+def test_compact_output_is_smaller_and_reports_tokens():
+    """Schema-constrained answers carry only box_2d and text; usage comes back with the response."""
+    from types import SimpleNamespace
+
+    from fields import Fields
+    from stub_backend import StubClient
+
+    verbose = json.dumps(synthetic_fields('abc', 50))
+    compact = json.dumps(synthetic_fields('abc', 50, compact=True))
+    assert len(compact) < 0.7 * len(verbose)
+    assert Fields.from_model_output(json.loads(compact)).boxes.tolist() == Fields.from_model_output(json.loads(verbose)).boxes.tolist()
+
+    models = StubClient(fields=50).models
+    config = SimpleNamespace(system_instruction='prompt', response_schema={'type': 'ARRAY'})
+    resp = models.generate_content('m', ['detect'], config)
+    assert set(json.loads(resp.text)[0]) == {'box_2d', 'text'}
+    usage = resp.usage_metadata
+    assert usage.candidates_token_count > 0
+    assert usage.total_token_count == usage.prompt_token_count + usage.candidates_token_count
+    chunks = list(models.generate_content_stream('m', ['detect'], config))
+    assert [c.usage_metadata is not None for c in chunks][-2:] == [False, True]
+
+
+def test_offline_benchmark_reports_latency_and_throughput(tmp_path):
+    """A tiny run over both routes with the stub backend yields the JSON report shape CI consumes."""
+    report = asyncio.run(run_benchmark(['detect', 'draw_boxes'], [1, 2], 2, 0.0, 5, None, str(tmp_path)))
+    for route in ('detect', 'draw_boxes'):
+        levels = report['routes'][route]
+        assert [lvl['concurrency'] for lvl in levels] == [1, 2]
+        for lvl in levels:
+            assert lvl['throughput_rps'] > 0
+            assert lvl['latency_ms']['p50'] <= lvl['latency_ms']['p99']
+    assert compare(report, report, 0.0) == []
+
+
+def test_percentile_nearest_rank():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99) == 99
+    assert percentile([], 95) == 0.0
+
+
+def test_startup_regressions_are_reported():
+    baseline = {'startup': {'import_ms': 500.0, 'first_root_ms': 800.0, 'first_detect_ms': 1200.0}}
+    current = {'startup': {'import_ms': 520.0, 'first_root_ms': 1100.0, 'first_detect_ms': 1200.0}}
+    assert compare(current, baseline, 0.25) == ['startup first_root_ms: 1100.0ms vs 800.0ms']
+    assert compare(current, {}, 0.25) == []
+
+
+def test_geometry_benchmark_scores_against_synthetic_fields(tmp_path):
+    report = run_geometry(str(tmp_path), None, runs=1)
+    assert report['config']['reference'] == 'synthetic'
+    assert report['geometry']['recall'] >= 0.9 and report['geometry']['precision'] >= 0.9
+    worse = {'geometry': {**report['geometry'], 'recall': report['geometry']['recall'] - 0.1}}
+    assert compare(worse, report, 0.25) == [f"geometry: recall {worse['geometry']['recall']} vs {report['geometry']['recall']}"]
@@ -0,0 +1,26 @@
+import os
+import sys
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+if BASE_DIR not in sys.path:
+    sys.path.append(BASE_DIR)
+
+from cascade import CascadePolicy, escalation_reasons
+from fields import Fields
+
+
+def _fields(entries):
+    return Fields.from_entries([{"box_2d": box, "text": text} for box, text in entries])
+
+
+def test_clean_result_passes_and_each_check_escalates():
+    policy = CascadePolicy()
+    clean = [([10, 10, 50, 500], "John"), ([60, 10, 100, 500], "Main St"), ([110, 10, 125, 25], "x")]
+    assert escalation_reasons(_fields(clean), policy) == []
+
+    assert escalation_reasons(Fields.empty(), policy) == ["no_boxes"]
+    assert escalation_reasons(_fields(clean + [([10, 10, 50, 1400], "a")]), policy) == ["out_of_range"]
+    # The same field reported twice
+    assert escalation_reasons(_fields(clean + [([12, 12, 50, 498], "Jon")]), policy) == ["overlap"]
+    blanks = [([200 + 50 * i, 10, 230 + 50 * i, 500], "") for i in range(4)]
+    assert escalation_reasons(_fields(clean + blanks), policy) == ["empty_text"]
@@ -0,0 +1,421 @@
+"""Route tests against the stub model backend (stub_backend.py): no GCP credentials or test_documents needed."""
+import io
+import json
+import os
+import subprocess
+import sys
+import time
+import zipfile
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+if BASE_DIR not in sys.path:
+    sys.path.append(BASE_DIR)
+
+import pytest
+import requests
+from fastapi.testclient import TestClient
+
+import fastapi_server as fs
+from admission import AdmissionController
+from bench import synthetic_page
+from layout_index import TemplateIndex
+from result_cache import ResultCache
+from stub_backend import StubClient
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    """A stub model client, plus a fresh cache, template index and admission for each test."""
+    client = StubClient()
+    monkeypatch.setattr(fs, "DETECTOR_BACKEND", "stub")
+    monkeypatch.setattr(fs, "_client", client)
+    monkeypatch.setattr(fs, "_client_credentials", None)
+    monkeypatch.setattr(fs, "_result_cache", ResultCache(1 << 20, 3600))
+    monkeypatch.setattr(fs, "_template_index", TemplateIndex(100, fs.TEMPLATE_MAX_DISTANCE, fs.TEMPLATE_MAX_INK_DELTA))
+    monkeypatch.setattr(fs, "_admission", AdmissionController(fs.MAX_INFLIGHT_INFERENCES, 0, 0, 1))
+    return client
+
+
+def _session():
+    client = TestClient(fs.app)
+    client.get("/")
+    client.headers["x-csrf-token"] = client.cookies["_csrf"]
+    return client
+
+
+def _events(response):
+    return [json.loads(line) for line in response.text.splitlines()]
+
+# Fresh interpreter: GET / then POST detect at once, while the lifespan warm-up is still running
+_FIRST_DETECT = """
+from fastapi.testclient import TestClient
+from bench import synthetic_page
+import fastapi_server
+
+page = synthetic_page(0)
+with TestClient(fastapi_server.app) as client:
+    client.get("/")
+    r = client.post(
+        "/api/form/detect",
+        files={"file": ("page.png", page, "image/png")},
+        headers={"x-csrf-token": client.cookies["_csrf"]},
+    )
+    print("RESULT", r.status_code, r.json().get("timings_ms", {}).get("model_used"), r.json().get("error"))
+"""
+
+
+def test_first_detect_right_after_startup():
+    """The first detect must not race the background SDK warm-up (fallback off, so a failure is a 500)."""
+    env = dict(os.environ, DETECTOR_BACKEND="stub", GEOMETRY_FALLBACK="0", PYTHONDONTWRITEBYTECODE="1")
+    env.pop("RESULT_CACHE_DB", None)
+    env.pop("TEMPLATE_INDEX_DB", None)
+    for _ in range(4):
+        out = subprocess.run([sys.executable, "-c", _FIRST_DETECT], cwd=BASE_DIR, env=env, capture_output=True, text=True, timeout=120)
+        assert out.returncode == 0, out.stderr[-2000:]
+        result = [line for line in out.stdout.splitlines() if line.startswith("RESULT ")]
+        assert result == ["RESULT 200 gemini-2.5-pro None"], out.stdout[-2000:]
+
+
+def test_stream_cut_off_before_the_end_of_the_array_is_an_error(stub, monkeypatch):
+    """A truncated model stream ends with an error event and leaves no cache or template entry behind."""
+    full = stub.models.generate_content_stream
+
+    def cut_off(model, contents, config=None):
+        text = "".join(chunk.text for chunk in full(model, contents, config))
+        third = text.index('{"box_2d"', text.index('{"box_2d"', text.index('{"box_2d"') + 1) + 1)
+        for i in range(0, third + 12, 10):
+            yield type("Chunk", (), {"text": text[i:min(i + 10, third + 12)], "usage_metadata": None})()
+
+    page = synthetic_page(0)
+    client = _session()
+    monkeypatch.setattr(stub.models, "generate_content_stream", cut_off)
+    events = _events(client.post("/api/form/detect_stream", files={"file": ("page.png", page, "image/png")}))
+    assert [e["type"] for e in events] == ["image", "field", "field", "error"]
+    assert "JSON array" in events[-1]["error"]
+
+    monkeypatch.setattr(stub.models, "generate_content_stream", full)
+    events = _events(client.post("/api/form/detect_stream", files={"file": ("page.png", page, "image/png")}))
+    assert events[-1]["type"] == "done"
+    timings = events[-1]["timings_ms"]
+    assert timings["cache"] == "miss" and timings["template"] == "miss"
+
+
+def _zip(pages):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
+        for i, page in enumerate(pages):
+            zf.writestr(f"page{i}.png", page)
+    return buf.getvalue()
+
+
+def test_batch_job_zip_limits(stub, monkeypatch):
+    """Zips over the document count or the uncompressed size limit get a 413 and start no job."""
+    monkeypatch.setattr(fs, "BATCH_MAX_ITEMS", 3)
+    monkeypatch.setattr(fs, "BATCH_MAX_UNCOMPRESSED_BYTES", 16 * 1024 * 1024)
+    monkeypatch.setattr(fs, "_batch_jobs", {})
+    client = _session()
+    page = synthetic_page(0)
+
+    r = client.post("/api/batch/jobs", files=[("files", ("pages.zip", _zip([page] * 4), "application/zip"))])
+    assert r.status_code == 413 and "limit is 3" in r.json()["error"]
+    bomb = _zip([b"\x89PNG\r\n\x1a\n" + b"\0" * (64 * 1024 * 1024)])
+    r = client.post("/api/batch/jobs", files=[("files", ("bomb.zip", bomb, "application/zip"))])
+    assert r.status_code == 413 and "expands to" in r.json()["error"]
+    assert fs._batch_jobs == {}
+
+
+    # Within the limits, documents are read from the spooled zip as the job reaches them
+    with TestClient(fs.app) as client:
+        client.get("/")
+        client.headers["x-csrf-token"] = client.cookies["_csrf"]
+        pages = _zip([page, synthetic_page(1), synthetic_page(2)])
+        r = client.post("/api/batch/jobs", files=[("files", ("pages.zip", pages, "application/zip"))])
+        assert r.status_code == 202 and r.json()["total"] == 3
+        job_id = r.json()["job_id"]
+        spool = fs._batch_jobs[job_id]["spool"].name
+        for _ in range(100):
+            status = client.get(f"/api/batch/jobs/{job_id}?include_results=true").json()
+            if status["status"] not in ("pending", "running"):
+                break
+            time.sleep(0.1)
+    assert status["status"] == "completed" and status["done"] == 3, status
+    assert sorted(result["name"] for result in status["results"]) == [f"pages.zip/page{i}.png" for i in range(3)]
+    assert not os.path.exists(spool)
+
+
+def test_geometry_detector_skips_preparation_templates_and_admission(stub, monkeypatch):
+    def unused(*args, **kwargs):
+        raise AssertionError("not on the geometry path")
+
+    for name in ("_prepare_upload", "_match_template", "_index_template"):
+        monkeypatch.setattr(fs, name, unused)
+    monkeypatch.setattr(fs._admission, "admit", unused)
+    client = _session()
+    page = synthetic_page(0)
+    for route in ("/api/form/detect", "/api/form/draw_boxes"):
+        r = client.post(f"{route}?detector=geometry", files={"file": ("page.png", page, "image/png")})
+        assert r.status_code == 200 and r.json()["timings_ms"]["model_used"] == "geometry", r.text
+        assert r.json()["boxes"]
+    events = _events(client.post("/api/form/detect_stream?detector=geometry", files={"file": ("page.png", page, "image/png")}))
+    assert events[-1]["type"] == "done" and events[-1]["timings_ms"]["model_used"] == "geometry"
+
+
+def _api_error(code):
+    from google.genai.errors import ClientError, ServerError
+
+    response = requests.Response()
+    response.status_code = code
+    status = {400: "INVALID_ARGUMENT", 404: "NOT_FOUND", 429: "RESOURCE_EXHAUSTED"}.get(code, "UNAVAILABLE")
+    response._content = json.dumps({"error": {"code": code, "message": status.lower(), "status": status}}).encode()
+    return (ServerError if code >= 500 else ClientError)(code, response)
+
+
+@pytest.mark.parametrize("failure, reason", [
+    (lambda: _api_error(503), "error"),
+    (lambda: _api_error(429), "error"),
+    # Our request is wrong (a schema the API refuses, an unknown model): no fallback
+    (lambda: _api_error(400), None),
+    (lambda: _api_error(404), None),
+    (lambda: ConnectionResetError("connection reset by peer"), "error"),
+    (lambda: TimeoutError("read timed out"), "timeout"),
+    (None, "timeout"),  # MODEL_TIMEOUT_S
+    ('[{"box_2d": [100, 100, 120', "parse"),
+])
+def test_model_failures_fall_back_to_geometry(stub, monkeypatch, failure, reason):
+    def generate_content(model, contents, config=None):
+        if failure is None:
+            time.sleep(0.5)
+        elif isinstance(failure, str):
+            return type("Response", (), {"text": failure, "usage_metadata": None})()
+        else:
+            raise failure()
+
+    monkeypatch.setattr(stub.models, "generate_content", generate_content)
+    monkeypatch.setattr(fs, "MODEL_TIMEOUT_S", 0.1 if failure is None else 0)
+    client = _session()
+    r = client.post("/api/form/detect", files={"file": ("page.png", synthetic_page(0), "image/png")})
+    if reason is None:
+        assert r.status_code == 500 and r.json()["error"].startswith("4"), r.text
+        return
+    assert r.status_code == 200, r.text
+    timings = r.json()["timings_ms"]
+    assert timings["fallback_reason"] == reason and timings["model_used"] == "geometry"
+    assert r.json()["boxes"]
+
+
+def test_server_bugs_are_not_masked_by_the_fallback(stub, monkeypatch):
+    def broken(data):
+        raise TypeError("unsupported operand")
+
+    monkeypatch.setattr(fs.Fields, "from_model_output", broken)
+    client = _session()
+    r = client.post("/api/form/detect", files={"file": ("page.png", synthetic_page(0), "image/png")})
+    assert r.status_code == 500 and "unsupported operand" in r.json()["error"]
+
+
+def _pdf(pages):
+    import pymupdf
+
+    doc = pymupdf.open()
+    for i in range(pages):
+        page = doc.new_page(width=612, height=792)
+        page.insert_text((72, 90), f"Application form, page {i + 1}")
+        for row in range(8):
+            page.draw_line((150, 150 + row * 40), (450, 150 + row * 40))
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+def _post_document(client, content):
+    return client.post("/api/form/detect_document", files={"file": ("form.pdf", content, "application/pdf")})
+
+
+def test_detect_document_rasterizes_and_detects_every_page(stub, monkeypatch):
+    # The pages share a layout: without the template index, each one is a model call
+    monkeypatch.setattr(fs, "_template_index", TemplateIndex(0, 0, 0))
+    r = _post_document(_session(), _pdf(3))
+    assert r.status_code == 200, r.text
+    body = r.json()
+    assert body["page_count"] == 3 and "rasterize_ms" in body["timings_ms"]
+    assert [page["page"] for page in body["pages"]] == [0, 1, 2]
+    for page in body["pages"]:
+        # pdf.js scale 2: 612x792 pt pages become 1224x1584 px
+        assert page["image"] == {"width": 1224, "height": 1584}
+        assert page["boxes"] and page["timings_ms"]["model_used"] == "gemini-2.5-pro"
+
+
+def test_detect_document_reports_a_failed_page_without_failing_the_others(stub, monkeypatch):
+    answer = stub.models.generate_content
+    calls = []
+
+    def second_call_fails(model, contents, config=None):
+        calls.append(model)
+        if len(calls) == 2:
+            raise ValueError("bad page")  # not a model failure: no geometric fallback
+        return answer(model, contents, config)
+
+    monkeypatch.setattr(stub.models, "generate_content", second_call_fails)
+    monkeypatch.setattr(fs, "_template_index", TemplateIndex(0, 0, 0))
+    r = _post_document(_session(), _pdf(3))
+    assert r.status_code == 200
+    pages = r.json()["pages"]
+    failed = [page for page in pages if "error" in page]
+    assert len(failed) == 1 and failed[0]["error"] == "bad page" and "total_ms" in failed[0]["timings_ms"]
+    assert sum(bool(page.get("boxes")) for page in pages) == 2
+
+
+def test_detect_document_refuses_documents_over_the_page_limit(stub, monkeypatch):
+    monkeypatch.setattr(fs, "PDF_MAX_PAGES", 2)
+    r = _post_document(_session(), _pdf(3))
+    assert r.status_code == 400 and "limit is 2" in r.json()["error"]
+    assert _post_document(_session(), b"%PDF-1.7\nnot really a pdf").status_code == 400
+
+
+def test_oversized_pdf_pages_are_refused_by_detect_document_and_render(stub, monkeypatch):
+    import pymupdf
+
+    monkeypatch.setattr(fs, "MAX_IMAGE_PIXELS", 2_000_000)
+    doc = pymupdf.open()
+    doc.new_page(width=612, height=792)  # 1224x1584 px at scale 2
+    doc.new_page(width=2000, height=2000)
+    content = doc.tobytes()
+    client = _session()
+    r = _post_document(client, content)
+    assert r.status_code == 400 and "page 2 renders to 4000x4000 px" in r.json()["error"]
+    r = client.post(
+        "/api/form/render",
+        files={"file": ("form.pdf", content, "application/pdf")},
+        data={"fields": json.dumps({"pages": []})},
+    )
+    assert r.status_code == 400 and "page 2 renders to" in r.json()["error"]
+
+
+def test_get_client_creates_one_shared_client(monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+
+    monkeypatch.setattr(fs, "DETECTOR_BACKEND", "stub")
+    monkeypatch.setattr(fs, "_client", None)
+    monkeypatch.setattr(fs, "_client_credentials", None)
+    with ThreadPoolExecutor(8) as pool:
+        clients = list(pool.map(lambda _: fs._get_client(), range(16)))
+    assert isinstance(clients[0], StubClient)
+    assert all(client is clients[0] for client in clients)
+    assert fs._get_client() is clients[0]
+
+
+class _FakeCredentials:
+    def __init__(self):
+        self.valid = True
+        self.refreshed_with = []
+
+    def refresh(self, request):
+        time.sleep(0.2)
+        self.refreshed_with.append(request)
+        self.valid = True
+
+
+def test_credentials_are_refreshed_only_when_invalid_and_timed_as_client_init(stub, monkeypatch):
+    credentials = _FakeCredentials()
+    monkeypatch.setattr(fs, "_client_credentials", credentials)
+    monkeypatch.setattr(fs, "_auth_request", "kept-alive session")
+    monkeypatch.setattr(fs, "_template_index", TemplateIndex(0, 0, 0))
+    fs._import_sdk()  # the first import is client_init_ms too
+    client = _session()
+
+    def detect(seed):
+        r = client.post("/api/form/detect", files={"file": ("page.png", synthetic_page(seed), "image/png")})
+        assert r.status_code == 200, r.text
+        return r.json()["timings_ms"]["client_init_ms"]
+
+    assert detect(0) < 200 and credentials.refreshed_with == []
+    credentials.valid = False
+    assert detect(1) >= 200 and credentials.refreshed_with == ["kept-alive session"]
+    assert detect(2) < 200 and len(credentials.refreshed_with) == 1
+
+
+def test_slow_model_calls_queue_without_blocking_the_server(stub, monkeypatch):
+    """More concurrent detects than in-flight slots: the extra ones queue, and /api/health stays fast."""
+    import asyncio
+
+    import httpx
+
+    monkeypatch.setenv("STUB_LATENCY_MS", "300")
+    monkeypatch.setattr(fs, "_client", None)
+    monkeypatch.setattr(fs, "MAX_INFLIGHT_INFERENCES", 2)
+    monkeypatch.setattr(fs, "_admission", AdmissionController(2, 0, 0, 1))
+    monkeypatch.setattr(fs, "_template_index", TemplateIndex(0, 0, 0))
+    pages = [synthetic_page(i) for i in range(6)]
+
+    async def main():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=fs.app), base_url="http://t", timeout=30) as client:
+            await client.get("/")
+            client.headers["x-csrf-token"] = client.cookies["_csrf"]
+            detects = [
+                asyncio.create_task(client.post("/api/form/detect", files={"file": ("page.png", page, "image/png")}))
+                for page in pages
+            ]
+            health_ms = []
+            while not all(task.done() for task in detects):
+                t0 = time.perf_counter()
+                r = await client.get("/api/health")
+                assert r.status_code == 200
+                health_ms.append((time.perf_counter() - t0) * 1000)
+                await asyncio.sleep(0.05)
+            return [task.result() for task in detects], health_ms
+
+    responses, health_ms = asyncio.run(main())
+    assert isinstance(fs._client, StubClient) and fs._client.models.latency_ms == 300
+    assert all(r.status_code == 200 for r in responses)
+    waits = sorted(r.json()["timings_ms"]["inference_queue_wait_ms"] for r in responses)
+    # 6 calls through 2 slots of 300 ms: the first two start at once, the last two wait about 600 ms
+    assert waits[0] < 150 and waits[-1] >= 500
+    assert len(health_ms) >= 5 and max(health_ms) < 150
+
+
+def test_sqlite_cache_and_template_index_run_off_the_event_loop(stub, monkeypatch, tmp_path):
+    """With RESULT_CACHE_DB / TEMPLATE_INDEX_DB set, every cache and index call runs on a worker thread."""
+    import asyncio
+
+    cache = ResultCache(1 << 20, 3600, db_path=str(tmp_path / "cache.db"))
+    index = TemplateIndex(100, fs.TEMPLATE_MAX_DISTANCE, fs.TEMPLATE_MAX_INK_DELTA, db_path=str(tmp_path / "index.db"))
+    monkeypatch.setattr(fs, "_result_cache", cache)
+    monkeypatch.setattr(fs, "_template_index", index)
+    calls = []
+    for store, name in [(cache, "get"), (cache, "put"), (index, "lookup"), (index, "add")]:
+        def record(*args, _method=getattr(store, name), _name=name):
+            calls.append((_name, asyncio._get_running_loop() is not None))
+            return _method(*args)
+        monkeypatch.setattr(store, name, record)
+
+    with _session() as client:
+        for page in [synthetic_page(0), synthetic_page(0)]:
+            r = client.post("/api/form/detect", files={"file": ("page.png", page, "image/png")})
+            assert r.status_code == 200
+    assert {name for name, _ in calls} == {"get", "put", "lookup", "add"}
+    assert not any(on_loop for _, on_loop in calls)
+
+
+def test_timed_out_model_call_keeps_its_slot_until_the_worker_finishes(stub, monkeypatch):
+    """MODEL_TIMEOUT_S answers from geometry at once, but the next call queues behind the abandoned one."""
+    monkeypatch.setattr(fs, "MODEL_TIMEOUT_S", 0.3)
+    monkeypatch.setattr(fs, "_admission", AdmissionController(1, 0, 0, 1))
+    monkeypatch.setattr(fs, "_template_index", TemplateIndex(0, 0, 0))
+    stub.models.latency_ms = 1500
+    gauge = fs.INFERENCES_IN_FLIGHT
+    label = gauge._key({"model": fs._metric_model(fs.MODEL_NAME)})
+    in_flight_before = gauge._values.get(label, 0)
+
+    with _session() as client:
+        r = client.post("/api/form/detect", files={"file": ("page.png", synthetic_page(0), "image/png")})
+        assert r.status_code == 200 and r.json()["timings_ms"]["fallback_reason"] == "timeout"
+        assert fs._admission.scheduler.in_flight == 1
+        assert gauge._values[label] == in_flight_before + 1
+
+        stub.models.latency_ms = 0
+        monkeypatch.setattr(fs, "MODEL_TIMEOUT_S", 0)
+        r = client.post("/api/form/detect", files={"file": ("page.png", synthetic_page(1), "image/png")})
+        assert r.status_code == 200 and r.json()["timings_ms"]["fallback_reason"] is None
+        assert r.json()["timings_ms"]["inference_queue_wait_ms"] >= 800
+    assert fs._admission.scheduler.in_flight == 0
+    assert gauge._values[label] == in_flight_before
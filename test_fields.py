@@ -0,0 +1,37 @@
+import os
+import sys
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+if BASE_DIR not in sys.path:
+    sys.path.append(BASE_DIR)
+
+from fields import Fields
+
+
+def test_postprocess_validates_clamps_and_classifies():
+    """Malformed and degenerate boxes are dropped, coordinates clamped and ordered, narrow boxes become 'x'."""
+    fields = Fields.from_model_output([
+        {"input_box_2d": [10, 10, 50, 500], "text": "John"},
+        {"box_2d": [60, 20, 70, 10], "text": "None"},     # swapped x, 10/1000 of 1000 px wide
+        {"box_2d": [-5, 100, 1200, 400.4], "text": "a"},  # out of range
+        {"box_2d": [80, 80, 80, 90], "text": "flat"},     # zero height
+        {"box_2d": [1, 2, 3], "text": "short"},
+        {"box_2d": [1, 2, "3", 4], "text": "str"},
+        "junk",
+    ])
+    out = fields.postprocess(width=1000, small_box_px=30)
+    assert out.box_dicts() == [
+        {"box_2d": [10, 10, 50, 500]},
+        {"box_2d": [60, 10, 70, 20]},
+        {"box_2d": [0, 100, 1000, 400]},
+    ]
+    assert out.texts == ["John", "x", "a"]
+    assert out.to_pixels(1000, 2000).tolist()[0] == [10, 20, 500, 100]
+
+
+def test_json_round_trip_and_legacy_cache_records():
+    fields = Fields.from_entries([{"box_2d": [1, 2, 3, 4], "text": "t"}])
+    assert list(Fields.from_json(fields.to_json()).entries()) == [{"box_2d": [1.0, 2.0, 3.0, 4.0], "text": "t"}]
+    legacy = Fields.from_json([{"box_2d": [1, 2, 3, 4], "text": "t"}])
+    assert legacy.postprocess().box_dicts() == [{"box_2d": [1, 2, 3, 4]}]
+    assert len(Fields.from_model_output({"not": "a list"}).postprocess()) == 0
@@ -0,0 +1,79 @@
+import io
+import os
+import sys
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+if BASE_DIR not in sys.path:
+    sys.path.append(BASE_DIR)
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from geometry import detect_fields
+
+W, H = 1224, 1584
+
+
+def _form():
+    """A page with underlines, checkboxes, a 3x3 table, a labelled box and running text; returns (PNG, truth)."""
+    img = Image.new("L", (W, H), 255)
+    draw = ImageDraw.Draw(img)
+    truth = []
+    for row in range(6):
+        y = 100 + row * 50
+        draw.text((80, y - 14), f"Label {row}", fill=0)
+        draw.line([(200, y), (700, y)], fill=0, width=2)
+        truth.append(("line", [y - 30, 200, y, 700]))
+        draw.rectangle([(800, y - 20), (818, y - 2)], outline=0, width=2)
+        truth.append(("checkbox", [y - 20, 800, y - 2, 818]))
+    xs, ys = [100, 400, 700, 1100], [500, 540, 580, 620]
+    for y in ys:
+        draw.line([(xs[0], y), (xs[-1], y)], fill=0, width=2)
+    for x in xs:
+        draw.line([(x, ys[0]), (x, ys[-1])], fill=0, width=2)
+    truth += [("cell", [ys[i], xs[j], ys[i + 1], xs[j + 1]]) for i in range(3) for j in range(3)]
+    draw.text((110, 505), "Header", fill=0)
+    draw.rectangle([(100, 700), (1100, 800)], outline=0, width=3)
+    draw.text((110, 705), "Comments", fill=0)
+    truth.append(("box", [700, 100, 800, 1100]))
+    for k in range(5):
+        draw.text((100, 900 + k * 20), "Lorem ipsum dolor sit amet EEEE HHHH 8888 BBBB ____", fill=0)
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    return buf.getvalue(), truth
+
+
+def _pixels(fields):
+    return np.rint(fields.boxes / 1000 * np.array([H, W, H, W])).astype(int)
+
+
+def test_finds_underlines_checkboxes_and_table_cells():
+    content, truth = _form()
+    found = _pixels(detect_fields(content))
+    assert len(found) == len(truth)
+    for kind, box in truth:
+        # Band heights above underlines are estimated; everything else is drawn exactly
+        tol = np.array([12, 3, 3, 3]) if kind == "line" else 3
+        assert (np.abs(found - box) <= tol).all(axis=1).any(), (kind, box)
+
+
+def test_checkboxes_get_the_small_box_classification():
+    import fastapi_server
+
+    content, truth = _form()
+    fields = detect_fields(content).postprocess(W, fastapi_server.SMALL_BOX_PX_THRESHOLD)
+    assert fields.texts.count("x") == sum(kind == "checkbox" for kind, _ in truth)
+
+
+def test_works_on_large_jpeg_scans_and_blank_pages():
+    content, truth = _form()
+    with Image.open(io.BytesIO(content)) as img:
+        big = img.convert("RGB").resize((W * 2, H * 2))
+    buf = io.BytesIO()
+    big.save(buf, format="JPEG", quality=90)
+    found = detect_fields(buf.getvalue())
+    assert len(found) == len(truth)
+
+    buf = io.BytesIO()
+    Image.new("RGBA", (600, 800), (0, 0, 0, 0)).save(buf, format="PNG")
+    assert len(detect_fields(buf.getvalue())) == 0
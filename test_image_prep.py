@@ -0,0 +1,62 @@
+import io
+import os
+import sys
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+if BASE_DIR not in sys.path:
+    sys.path.append(BASE_DIR)
+
+from PIL import Image, ImageDraw
+from image_prep import prepare_image, oriented_size, render_pdf_pages
+
+
+def _photo_bytes(size, orientation=None, color=False):
+    img = Image.new('RGB', size, 'white')
+    draw = ImageDraw.Draw(img)
+    for y in range(0, size[1], 40):
+        draw.line([(0, y), (size[0], y)], fill=(200, 30, 30) if color else (0, 0, 0), width=2)
+    exif = Image.Exif()
+    if orientation:
+        exif[0x0112] = orientation
+    buf = io.BytesIO()
+    img.save(buf, format='JPEG', quality=95, exif=exif)
+    return buf.getvalue()
+
+
+def test_prepare_downscales_and_reports_original_size():
+    """Large pages are capped to max_long_edge but keep the original dims for coordinate mapping."""
+    content = _photo_bytes((4000, 3000))
+    prepared = prepare_image(content, max_long_edge=1000)
+    assert (prepared.width, prepared.height) == (4000, 3000)
+    assert prepared.mime_type == 'image/jpeg'
+    assert prepared.bytes_in == len(content)
+    assert prepared.bytes_out < prepared.bytes_in
+    with Image.open(io.BytesIO(prepared.data)) as img:
+        assert max(img.size) == 1000
+        assert img.mode == 'L'
+
+
+def test_prepare_applies_exif_orientation_and_keeps_colour():
+    """A 90-degree EXIF rotation swaps dims; colour pages are not converted to grayscale."""
+    content = _photo_bytes((800, 600), orientation=6, color=True)
+    with Image.open(io.BytesIO(content)) as img:
+        assert oriented_size(img) == (600, 800)
+    prepared = prepare_image(content, max_long_edge=2048)
+    assert (prepared.width, prepared.height) == (600, 800)
+    with Image.open(io.BytesIO(prepared.data)) as img:
+        assert img.size == (600, 800)
+        assert img.mode == 'RGB'
+
+
+def test_oversized_pdf_pages_are_refused_before_rasterizing():
+    """A 14400 pt MediaBox would be ~28800 px square at scale 2 (GBs of RGB): refused from its size."""
+    import pytest
+    import pymupdf
+
+    doc = pymupdf.open()
+    doc.new_page(width=612, height=792)
+    doc.new_page(width=14400, height=14400)
+    content = doc.tobytes()
+    with pytest.raises(ValueError, match="page 2 renders to 28800x28800 px"):
+        render_pdf_pages(content, 2.0, max_pixels=60_000_000)
+    assert len(render_pdf_pages(content, 0.1, max_pixels=60_000_000)) == 2
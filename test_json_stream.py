@@ -0,0 +1,36 @@
+import json
+import os
+import sys
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+if BASE_DIR not in sys.path:
+    sys.path.append(BASE_DIR)
+
+from json_stream import JsonArrayStream
+
+
+def test_elements_are_emitted_as_soon_as_complete():
+    """Feeding the array a few characters at a time yields each element once, in order, when it closes."""
+    items = [
+        {"input_box_2d": [10, 20, 30, 40], "text": "John, \"Jr\" ]"},
+        {"input_box_2d": [50, 60, 70, 80], "text": ""},
+        [1, 2, 3, 4],
+    ]
+    payload = json.dumps(items)
+    parser = JsonArrayStream()
+    seen = []
+    for i in range(0, len(payload), 5):
+        seen.extend(parser.feed(payload[i:i + 5]))
+        if len(seen) == 1:
+            # The first element is out before the array has finished streaming
+            assert i + 5 < len(payload)
+    assert seen == items
+    assert parser.done
+
+
+def test_leading_text_and_empty_array():
+    """Text before the opening bracket is skipped; an empty array yields nothing."""
+    parser = JsonArrayStream()
+    assert parser.feed('```json\n[') == []
+    assert parser.feed(' ]') == []
+    assert parser.done
@@ -0,0 +1,68 @@
+import io
+import os
+import sys
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+if BASE_DIR not in sys.path:
+    sys.path.append(BASE_DIR)
+
+from PIL import Image, ImageDraw
+
+from fields import Fields
+from layout_index import TemplateIndex, layout_fingerprint
+
+
+def _form(columns=1, size=(1224, 1584)):
+    img = Image.new("RGB", size, "white")
+    draw = ImageDraw.Draw(img)
+    for row, y in enumerate(range(120, size[1] - 80, 60)):
+        for c in range(columns):
+            x0 = 80 + c * size[0] // columns
+            draw.text((x0, y - 18), f"Field {row}", fill="black")
+            draw.line([(x0 + 180, y), (x0 + size[0] // columns - 120, y)], fill="black", width=2)
+    return img
+
+
+def _rescan(img, scale=0.93, offset=(25, 40)):
+    """The same page scaled and shifted on off-white paper, as a JPEG."""
+    w, h = img.size
+    paper = Image.new("RGB", (w, h), (245, 243, 238))
+    paper.paste(img.resize((int(w * scale), int(h * scale))), offset)
+    return _encode(paper, "JPEG")
+
+
+def _encode(img, fmt="PNG"):
+    buf = io.BytesIO()
+    img.save(buf, format=fmt)
+    return buf.getvalue()
+
+
+def test_rescan_reuses_aligned_boxes_and_other_layouts_miss():
+    """A rescan matches with its boxes moved by the scan offset/scale; a different layout does not."""
+    page = _form()
+    index = TemplateIndex(max_entries=10, max_distance=0.12, max_ink_delta=0.02)
+    # The first row's underline, in 0-1000 coordinates
+    line = [round(100 / 1.584), round(260 / 1.224), round(120 / 1.584), round(1104 / 1.224)]
+    index.add(layout_fingerprint(_encode(page)), "model", Fields.from_entries([{"box_2d": line, "text": "John"}]))
+
+    match = index.lookup(layout_fingerprint(_rescan(page)), "model")
+    assert match is not None
+    expected = [(40 + 100 * 0.93) / 1.584, (25 + 260 * 0.93) / 1.224, (40 + 120 * 0.93) / 1.584, (25 + 1104 * 0.93) / 1.224]
+    assert all(abs(a - b) <= 5 for a, b in zip(match.fields.postprocess().boxes[0].tolist(), expected))
+    assert match.fields.texts == ["John"]
+
+    assert index.lookup(layout_fingerprint(_rescan(page)), "other-model") is None
+    assert index.lookup(layout_fingerprint(_encode(_form(columns=2))), "model") is None
+
+
+def test_index_persists_and_evicts(tmp_path):
+    db_path = str(tmp_path / "templates.sqlite")
+    fields = Fields.from_entries([{"box_2d": [10, 10, 20, 500], "text": "a"}])
+    first = TemplateIndex(max_entries=1, max_distance=0.12, max_ink_delta=0.02, db_path=db_path)
+    first.add(layout_fingerprint(_encode(_form())), "model", fields)
+    first.add(layout_fingerprint(_encode(_form(columns=2))), "model", fields)
+    assert len(first) == 1
+
+    reopened = TemplateIndex(max_entries=5, max_distance=0.12, max_ink_delta=0.02, db_path=db_path)
+    assert reopened.lookup(layout_fingerprint(_encode(_form(columns=2))), "model") is not None
+    assert reopened.lookup(layout_fingerprint(_encode(_form())), "model") is None
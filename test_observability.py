@@ -0,0 +1,34 @@
+import os
+import sys
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+if BASE_DIR not in sys.path:
+    sys.path.append(BASE_DIR)
+
+from fastapi.testclient import TestClient
+from fastapi_server import app
+from observability import Histogram
+
+
+def test_histogram_renders_cumulative_buckets():
+    """Buckets are cumulative and end with +Inf; _sum and _count follow."""
+    h = Histogram('t_seconds', 'test', ('route',), buckets=(0.1, 1))
+    for v in (0.05, 0.5, 5):
+        h.observe(v, route='/x')
+    lines = h.render()
+    assert 't_seconds_bucket{route="/x",le="0.1"} 1' in lines
+    assert 't_seconds_bucket{route="/x",le="1"} 2' in lines
+    assert 't_seconds_bucket{route="/x",le="+Inf"} 3' in lines
+    assert 't_seconds_count{route="/x"} 3' in lines
+
+
+def test_metrics_endpoint_and_request_id():
+    """/metrics serves the Prometheus text format; responses echo the caller's X-Request-ID."""
+    client = TestClient(app)
+    r = client.get('/api/health', headers={'x-request-id': 'abc123'})
+    assert r.headers.get('x-request-id') == 'abc123'
+    r = client.get('/metrics')
+    assert r.status_code == 200
+    assert r.headers['content-type'].startswith('text/plain')
+    assert 'fmp_http_requests_total{route="/api/health",status="403"}' in r.text
+    assert r.headers.get('x-request-id')
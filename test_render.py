@@ -0,0 +1,86 @@
+import io
+import json
+import os
+import sys
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+if BASE_DIR not in sys.path:
+    sys.path.append(BASE_DIR)
+
+from PIL import Image
+
+from render import MIN_FONT_SIZE, fit_font_size, get_font, render_document
+
+
+def _png(size=(800, 1000)):
+    buf = io.BytesIO()
+    Image.new("L", size, 255).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def test_fonts_are_cached_and_text_is_fitted_to_its_box():
+    assert get_font("Arial", 20) is get_font("Arial", 20)
+    assert fit_font_size("John", "Arial", 20, 400, 40) == 20
+    # Capped by the box height, then shrunk to the box width
+    assert fit_font_size("John", "Arial", 20, 400, 10) == 9
+    assert fit_font_size("A very long answer that cannot fit", "Arial", 20, 60, 40) < 10
+    assert fit_font_size("x", "Arial", 20, 5, 3) == MIN_FONT_SIZE
+
+
+def test_png_and_streamed_pdf_output():
+    """Texts are drawn in colour on a grayscale scan; PDF output is valid and one page per input page."""
+    page = {"boxes": [{"box_2d": [100, 100, 150, 700]}], "texts": ["John Doe"]}
+    png = b"".join(render_document(_png(), False, [page], "png", "Arial", 24, "#0057B8"))
+    with Image.open(io.BytesIO(png)) as out:
+        assert out.size == (800, 1000)
+        assert (0, 87, 184) in {c for _, c in out.convert("RGB").crop((80, 100, 560, 150)).getcolors(100000)}
+
+    import pymupdf
+
+    src = pymupdf.open()
+    for _ in range(3):
+        src.new_page(width=612, height=792)
+    chunks = list(render_document(src.tobytes(), True, [page, page], "pdf", pdf_scale=1.0))
+    assert len(chunks) == 5  # header, one chunk per page, trailer
+    doc = pymupdf.open(stream=b"".join(chunks), filetype="pdf")
+    assert doc.page_count == 3
+    assert (doc[0].rect.width, doc[0].rect.height) == (612, 792)
+
+
+def test_malformed_render_fields_are_refused_before_streaming():
+    import pytest
+    from fastapi.testclient import TestClient
+
+    import fastapi_server
+    from fastapi_server import _render_pages
+
+    malformed = [
+        {"boxes": [{"box_2d": ["a", 1, 2, 3]}], "texts": ["x"]},
+        {"boxes": [[1, 2, 3, 4]], "texts": 5},
+        {"boxes": [[1, 2, 3]], "texts": ["x"]},
+        {"boxes": [[1, 2, 3, 4]], "texts": [None]},
+        {"pages": [{"page": "1"}, {"page": 0}]},
+        {"pages": [{"page": 0}, 3]},
+        [],
+    ]
+    for fields in malformed:
+        with pytest.raises(ValueError):
+            _render_pages(json.dumps(fields))
+
+    # Valid pages come back sorted, boxes clamped and texts paired with them
+    pages = _render_pages(json.dumps({"pages": [
+        {"page": 1, "boxes": [[100, 100, 150, 1200]], "texts": ["b"]},
+        {"page": 0, "boxes": [{"box_2d": [10, 10, 50, 50]}, [5, 5, 5, 9]], "texts": ["a"]},
+    ]}))
+    assert pages == [{"boxes": [[10, 10, 50, 50]], "texts": ["a"]}, {"boxes": [[100, 100, 150, 1000]], "texts": ["b"]}]
+
+    client = TestClient(fastapi_server.app)
+    client.get("/")
+    for fields in malformed[:2] + malformed[4:5]:
+        r = client.post(
+            "/api/form/render",
+            files={"file": ("page.png", _png(), "image/png")},
+            data={"fields": json.dumps(fields)},
+            headers={"x-csrf-token": client.cookies["_csrf"]},
+        )
+        assert r.status_code == 400 and r.json()["error"].startswith("invalid fields"), r.text
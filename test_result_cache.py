@@ -0,0 +1,39 @@
+import os
+import sys
+import time
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+if BASE_DIR not in sys.path:
+    sys.path.append(BASE_DIR)
+
+from result_cache import ResultCache, cache_key
+
+
+def test_cache_key_depends_on_image_model_and_prompt():
+    """Same bytes/model/prompt give the same key; changing any part changes it."""
+    k = cache_key(b'abc', 'gemini-2.5-pro', 'v1')
+    assert k == cache_key(b'abc', 'gemini-2.5-pro', 'v1')
+    assert k != cache_key(b'abd', 'gemini-2.5-pro', 'v1')
+    assert k != cache_key(b'abc', 'gemini-2.5-flash-lite', 'v1')
+    assert k != cache_key(b'abc', 'gemini-2.5-pro', 'v2')
+
+
+def test_lru_evicts_by_size_and_ttl():
+    """Oldest entries are evicted past max_bytes; stale entries are never returned."""
+    cache = ResultCache(max_bytes=40, ttl_s=60)
+    cache.put('a', [{'box_2d': [1, 2, 3, 4]}])
+    cache.put('b', [{'box_2d': [5, 6, 7, 8]}])
+    assert cache.get('a') is None
+    assert cache.get('b') == [{'box_2d': [5, 6, 7, 8]}]
+
+    stale = ResultCache(max_bytes=1000, ttl_s=0)
+    stale.put('a', [1])
+    time.sleep(0.01)
+    assert stale.get('a') is None
+
+
+def test_sqlite_tier_survives_restart(tmp_path):
+    """Entries written with db_path set are readable from a new cache instance."""
+    db_path = str(tmp_path / 'results.sqlite')
+    ResultCache(max_bytes=1000, ttl_s=60, db_path=db_path).put('k', [{'text': 'John'}])
+    assert ResultCache(max_bytes=1000, ttl_s=60, db_path=db_path).get('k') == [{'text': 'John'}]
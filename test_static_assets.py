@@ -0,0 +1,62 @@
+import os
+import sys
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+if BASE_DIR not in sys.path:
+    sys.path.append(BASE_DIR)
+
+from fastapi.testclient import TestClient
+
+from fastapi_server import app
+from static_assets import AssetStore, negotiate, not_modified
+
+
+def _store(tmp_path):
+    (tmp_path / "fonts").mkdir()
+    (tmp_path / "fonts" / "Satisfy.ttf").write_bytes(b"\0\1" * 2000)
+    (tmp_path / "logo.png").write_bytes(b"\x89PNG\r\n\x1a\n" + bytes(range(256)))
+    page = "<link href=\"fonts/Satisfy.ttf\"><img src='logo.png'><p>logo.png stays " + "text " * 500 + "</p>"
+    (tmp_path / "index.html").write_text(page)
+    return AssetStore(str(tmp_path), ["index.html", "logo.png", "fonts/Satisfy.ttf", "missing.js"])
+
+
+def test_entry_page_links_to_content_hashed_urls(tmp_path):
+    store = _store(tmp_path)
+    page = store.get("index.html").bodies["identity"].decode()
+    assert f'href="fonts/Satisfy.ttf?v={store.get("fonts/Satisfy.ttf").version}"' in page
+    assert f"src='logo.png?v={store.get('logo.png').version}'" in page
+    assert "logo.png stays" in page
+    assert store.get("missing.js") is None
+
+
+def test_validators_and_encoding_negotiation(tmp_path):
+    store = _store(tmp_path)
+    page, logo = store.get("index.html"), store.get("logo.png")
+    assert not_modified(page, page.etag, None)
+    assert not_modified(page, f'"other", "{page.version}"', None)
+    assert not not_modified(page, '"other"', page.last_modified)
+    assert not_modified(page, None, page.last_modified)
+    assert not not_modified(page, None, "Thu, 01 Jan 1970 00:00:00 GMT")
+
+    assert set(page.bodies) >= {"identity", "gzip"}
+    assert negotiate(page, "gzip, deflate") == "gzip"
+    assert negotiate(page, "gzip;q=0") == "identity"
+    assert negotiate(page, None) == "identity"
+    # Already-compressed formats are stored as is
+    assert list(logo.bodies) == ["identity"]
+    assert negotiate(logo, "gzip, br") == "identity"
+
+
+def test_repeat_visit_gets_304_with_fresh_cookies():
+    client = TestClient(app)
+    first = client.get("/", headers={"accept-encoding": "gzip"})
+    assert first.status_code == 200
+    assert first.headers["content-encoding"] == "gzip"
+    assert first.headers["cache-control"] == "private, no-cache"
+    repeat = client.get("/", headers={"if-none-match": first.headers["etag"]})
+    assert repeat.status_code == 304 and repeat.content == b""
+    assert {"_sess", "_csrf"} <= set(repeat.cookies.keys())
+
+    versioned = client.get("/dev-preload.jpg", params={"v": "stale"})
+    assert versioned.headers["cache-control"] == "public, no-cache"
+    assert client.get("/fonts/../index.html").status_code == 404
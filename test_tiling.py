@@ -0,0 +1,95 @@
+import io
+import os
+import sys
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+if BASE_DIR not in sys.path:
+    sys.path.append(BASE_DIR)
+
+import numpy as np
+from PIL import Image
+
+from fields import Fields
+from tiling import cut_region, cut_tiles, merge_tiles, new_in_region, plan_tiles, region_box, tile_to_page
+
+
+def _tile_view(page_boxes, tile):
+    """What a perfect model returns for a tile: the visible part of each page box, in tile 0-1000."""
+    left, top, right, bottom = tile
+    boxes, texts = [], []
+    for y0, x0, y1, x1, text in page_boxes:
+        cy0, cx0, cy1, cx1 = max(y0, top), max(x0, left), min(y1, bottom), min(x1, right)
+        if cy1 > cy0 and cx1 > cx0:
+            h, w = bottom - top, right - left
+            boxes.append([(cy0 - top) / h * 1000, (cx0 - left) / w * 1000, (cy1 - top) / h * 1000, (cx1 - left) / w * 1000])
+            texts.append(text)
+    return Fields(np.array(boxes, dtype=np.float64).reshape(-1, 4), texts)
+
+
+def test_plan_tiles_cover_the_page_with_overlap():
+    assert plan_tiles(800, 1000, 1024, 0.15, 3) == [(0, 0, 800, 1000)]
+    tiles = plan_tiles(1224, 1584, 1024, 0.15, 3)
+    assert len(tiles) == 4
+    assert tiles[0][:2] == (0, 0) and tiles[-1][2:] == (1224, 1584)
+    left_tile, right_tile = tiles[0], tiles[1]
+    assert right_tile[0] < left_tile[2]  # neighbours overlap
+    # At most max_per_side per side, however large the page
+    assert len(plan_tiles(20000, 20000, 1024, 0.15, 3)) == 9
+
+
+def test_tile_coordinates_map_back_to_the_page():
+    fields = Fields(np.array([[0.0, 0.0, 1000.0, 500.0]]), ["a"])
+    page = tile_to_page(fields, (500, 200, 1000, 600), 1000, 800)
+    np.testing.assert_allclose(page.boxes, [[250.0, 500.0, 750.0, 750.0]])
+
+
+def test_merge_removes_overlap_duplicates_and_joins_fields_cut_by_a_seam():
+    width, height = 1224, 1584
+    truth = [
+        (200, 50, 230, 300, "Main St"),
+        (790, 600, 805, 615, "x"),  # in the overlap of all four tiles
+        (700, 100, 730, 1100, "John Doe"),  # wider than the overlap, cut by the vertical seam
+    ]
+    tiles = plan_tiles(width, height, 1024, 0.15, 3)
+    merged = merge_tiles([(_tile_view(truth, tile), tile) for tile in tiles], width, height)
+    assert len(merged) == 3
+    pixels = merged.boxes / 1000 * np.array([height, width, height, width])
+    got = sorted(zip(np.round(pixels).astype(int).tolist(), merged.texts))
+    want = sorted(([y0, x0, y1, x1], text) for y0, x0, y1, x1, text in truth)
+    assert got == want
+
+
+def test_cut_tiles_bounds_tile_size():
+    buf = io.BytesIO()
+    Image.new("RGB", (4000, 3000), "white").save(buf, format="PNG")
+    width, height, tiles = cut_tiles(buf.getvalue(), 1024, 0.15, 2)
+    assert len(tiles) == 4
+    assert abs(width / height - 4000 / 3000) < 0.01
+    for tile in tiles:
+        with Image.open(io.BytesIO(tile.data)) as img:
+            assert max(img.size) <= 1024
+            assert img.size == (tile.box[2] - tile.box[0], tile.box[3] - tile.box[1])
+
+
+def test_region_crop_is_widened_by_the_margin_and_clamped():
+    assert region_box([100, 200, 300, 600], 1000, 2000, 0.1) == (160, 160, 640, 640)
+    assert region_box([0, 900, 1000, 1000], 1000, 1000, 0.1) == (890, 0, 1000, 1000)
+    buf = io.BytesIO()
+    Image.new("RGB", (1000, 2000), "white").save(buf, format="PNG")
+    width, height, tile = cut_region(buf.getvalue(), [100, 200, 300, 600], 0.1, max_long_edge=240)
+    assert (width, height, tile.box) == (1000, 2000, (160, 160, 640, 640))
+    with Image.open(io.BytesIO(tile.data)) as img:
+        assert img.size == (240, 240)
+
+
+def test_region_results_skip_known_fields_and_the_margin():
+    known = Fields(np.array([[200.0, 100.0, 220.0, 400.0]]), ["known"])
+    found = Fields(np.array([
+        [201.0, 101.0, 219.0, 399.0],  # the known field again
+        [300.0, 100.0, 320.0, 400.0],  # missed before
+        [301.0, 100.0, 321.0, 401.0],  # same new field twice
+        [520.0, 100.0, 540.0, 400.0],  # in the margin only
+    ]), ["dup", "new", "new again", "margin"])
+    added = new_in_region(found, known, [150, 50, 500, 500])
+    assert added.texts == ["new"]
+    assert added.boxes.tolist() == [[300.0, 100.0, 320.0, 400.0]]
@@ -0,0 +1,96 @@
+import asyncio
+import io
+import os
+import sys
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+if BASE_DIR not in sys.path:
+    sys.path.append(BASE_DIR)
+
+import httpx
+import pytest
+from fastapi import FastAPI, File, UploadFile
+from fastapi.responses import JSONResponse
+from PIL import Image
+from starlette.datastructures import UploadFile as StarletteUploadFile
+
+from uploads import (
+    IMAGE_MIME_TYPES,
+    PDF_MIME_TYPE,
+    UploadLimitMiddleware,
+    UploadRejected,
+    read_upload,
+    sniff_mime,
+)
+
+
+def _image(fmt, size=(40, 60), exif=None):
+    buf = io.BytesIO()
+    img = Image.new("RGB", size, "white")
+    if exif is not None:
+        img.save(buf, format=fmt, exif=exif)
+    else:
+        img.save(buf, format=fmt)
+    return buf.getvalue()
+
+
+def _upload(content, filename="page"):
+    return StarletteUploadFile(io.BytesIO(content), filename=filename)
+
+
+def test_sniff_mime_uses_magic_bytes():
+    assert sniff_mime(_image("PNG")) == "image/png"
+    assert sniff_mime(_image("JPEG")) == "image/jpeg"
+    assert sniff_mime(_image("WEBP")) == "image/webp"
+    assert sniff_mime(_image("GIF")) == "image/gif"
+    assert sniff_mime(b"%PDF-1.7\n") == PDF_MIME_TYPE
+    assert sniff_mime(b"hello") is None
+
+
+def test_read_upload_checks_type_and_header_dimensions():
+    exif = Image.Exif()
+    exif[0x0112] = 6  # rotated 90 degrees
+    upload = read_upload(_upload(_image("JPEG", (40, 60), exif)), IMAGE_MIME_TYPES, max_pixels=10_000)
+    assert (upload.mime_type, upload.width, upload.height) == ("image/jpeg", 60, 40)
+    assert upload.data[:3] == b"\xff\xd8\xff"
+
+    with pytest.raises(UploadRejected) as e:
+        read_upload(_upload(_image("GIF")), IMAGE_MIME_TYPES)
+    assert e.value.status_code == 415
+    with pytest.raises(UploadRejected) as e:
+        read_upload(_upload(_image("PNG", (200, 100))), IMAGE_MIME_TYPES, max_pixels=10_000)
+    assert e.value.status_code == 413
+    with pytest.raises(UploadRejected) as e:
+        read_upload(_upload(b"\x89PNG\r\n\x1a\n" + b"\0" * 32), IMAGE_MIME_TYPES)
+    assert e.value.status_code == 400
+
+
+def test_middleware_rejects_large_bodies_with_and_without_content_length():
+    app = FastAPI()
+
+    @app.exception_handler(UploadRejected)
+    async def rejected(request, exc):
+        return JSONResponse({"error": exc.detail}, status_code=exc.status_code)
+
+    @app.post("/upload")
+    async def upload(file: UploadFile = File(...)):
+        return {"size": len(await file.read())}
+
+    app.add_middleware(UploadLimitMiddleware, max_bytes=1000, limits={"/unlimited": 0})
+
+    async def body():
+        yield b'--x\r\nContent-Disposition: form-data; name="file"; filename="a"\r\n\r\n'
+        for _ in range(10):
+            yield b"\1" * 500
+
+    async def main():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://t") as client:
+            small = await client.post("/upload", files={"file": ("a", b"x" * 100)})
+            declared = await client.post("/upload", files={"file": ("a", b"x" * 2000)})
+            streamed = await client.post("/upload", content=body(), headers={"content-type": "multipart/form-data; boundary=x"})
+            return small, declared, streamed
+
+    small, declared, streamed = asyncio.run(main())
+    assert small.status_code == 200 and small.json() == {"size": 100}
+    assert declared.status_code == 413 and "limit is 1000" in declared.json()["error"]
+    assert streamed.status_code == 413
@@ -0,0 +1,229 @@
+"""Tiled detection for large or dense pages.
+
+The page is split into a grid of overlapping tiles that are detected concurrently, so
+the model sees small fields at a higher effective resolution and the page takes as
+long as its slowest tile rather than one call over the whole image. Tiles are cut
+from the original upload (not the downscaled model input).
+
+Each tile's fields come back in tile-local 0-1000 coordinates; `tile_to_page` maps
+them to page coordinates. `merge_tiles` then removes the duplicates that the
+overlaps produce, with non-maximum suppression: boxes are visited complete-first and
+largest-first, and a box that mostly lies inside one already kept (intersection over
+the smaller box above `_DUPLICATE_RATIO`) is dropped. A field cut by a tile seam is
+seen as two partial boxes, one per tile; those are joined into their union instead.
+
+Region re-detection (`cut_region`, `new_in_region`) reuses the same mapping for a
+single crop: the part of the page a user wants re-checked is detected on its own and
+only fields not already known are returned.
+"""
+from dataclasses import dataclass
+import io
+import math
+
+import numpy as np
+from PIL import Image, ImageOps
+
+from fields import NORMALIZED_SCALE, Fields
+from image_prep import encode_image, flatten_alpha, oriented_size
+
+# Intersection over the smaller box above which two boxes are the same field
+_DUPLICATE_RATIO = 0.6
+# Two partial boxes of a field cut by a seam overlap (in the band) and line up across it
+_SEAM_ALIGNMENT = 0.7
+# A box edge this close to an interior tile edge (fraction of the tile) was cut by it
+_SEAM_TOLERANCE = 0.01
+
+
+@dataclass
+class Tile:
+    box: tuple  # (left, top, right, bottom) in page pixels
+    data: bytes
+    mime_type: str
+
+
+def _axis_spans(length: int, tile_px: int, overlap: float, max_tiles: int) -> list:
+    n = 1
+    while n < max_tiles and length / (n - (n - 1) * overlap) > tile_px:
+        n += 1
+    size = length / (n - (n - 1) * overlap)
+    step = size * (1 - overlap)
+    return [(round(i * step), round(i * step + size) if i < n - 1 else length) for i in range(n)]
+
+
+def plan_tiles(width: int, height: int, tile_px: int, overlap: float, max_per_side: int) -> list:
+    """Tile rectangles (left, top, right, bottom) covering the page, row by row.
+
+    Tiles are as few as keep each side within `tile_px` (at most `max_per_side` per
+    side), evenly sized, and neighbours share `overlap` (a fraction) of a tile.
+    """
+    cols = _axis_spans(width, tile_px, overlap, max_per_side)
+    rows = _axis_spans(height, tile_px, overlap, max_per_side)
+    return [(left, top, right, bottom) for top, bottom in rows for left, right in cols]
+
+
+def cut_tiles(content: bytes, tile_px: int, overlap: float, max_per_side: int,
+              fmt: str = "jpeg", quality: int = 85) -> tuple:
+    """Decode the page once and encode each tile for the model; returns (width, height, tiles).
+
+    Pages too large for `max_per_side` tiles of `tile_px` are downscaled first, so no
+    tile is larger than `tile_px`; width and height (and the tile boxes) are then those
+    of the downscaled page.
+    """
+    with Image.open(io.BytesIO(content)) as img:
+        width, height = oriented_size(img)
+        largest = max(max(r - l, b - t) for l, t, r, b in plan_tiles(width, height, tile_px, overlap, max_per_side))
+        scale = min(1.0, tile_px / largest)
+        if scale < 1.0 and img.format == "JPEG":
+            img.draft(img.mode, (math.ceil(img.width * scale), math.ceil(img.height * scale)))
+        img = flatten_alpha(ImageOps.exif_transpose(img))
+        if scale < 1.0:
+            img = img.resize((max(1, round(width * scale)), max(1, round(height * scale))), Image.Resampling.LANCZOS)
+        img.load()
+    width, height = img.size
+    tiles = []
+    for box in plan_tiles(width, height, tile_px, overlap, max_per_side):
+        data, mime_type = encode_image(img.crop(box), fmt, quality)
+        tiles.append(Tile(box=box, data=data, mime_type=mime_type))
+    return width, height, tiles
+
+
+def region_box(region, width: int, height: int, margin: float) -> tuple:
+    """Pixel crop (left, top, right, bottom) for a 0-1000 [y_min, x_min, y_max, x_max] region.
+
+    The region is widened by `margin` (a fraction of its size) on each side, so fields
+    on its edges are seen whole, and clamped to the page.
+    """
+    y0, x0, y1, x1 = (min(max(float(v), 0.0), NORMALIZED_SCALE) for v in region)
+    y0, y1 = sorted((y0, y1))
+    x0, x1 = sorted((x0, x1))
+    pad_y, pad_x = (y1 - y0) * margin, (x1 - x0) * margin
+    left = math.floor(max(0.0, x0 - pad_x) / NORMALIZED_SCALE * width)
+    top = math.floor(max(0.0, y0 - pad_y) / NORMALIZED_SCALE * height)
+    right = math.ceil(min(NORMALIZED_SCALE, x1 + pad_x) / NORMALIZED_SCALE * width)
+    bottom = math.ceil(min(NORMALIZED_SCALE, y1 + pad_y) / NORMALIZED_SCALE * height)
+    return left, top, right, bottom
+
+
+def cut_region(content: bytes, region, margin: float, max_long_edge: int = 0,
+               fmt: str = "jpeg", quality: int = 85) -> tuple:
+    """Crop a region of the page for the model; returns (width, height, tile).
+
+    The crop is downscaled to `max_long_edge` (0: never); tile.box is in page pixels.
+    """
+    with Image.open(io.BytesIO(content)) as img:
+        width, height = oriented_size(img)
+        box = region_box(region, width, height, margin)
+        if box[2] - box[0] < 1 or box[3] - box[1] < 1:
+            raise ValueError("region is empty")
+        crop = flatten_alpha(ImageOps.exif_transpose(img)).crop(box)
+    if max_long_edge and max(crop.size) > max_long_edge:
+        scale = max_long_edge / max(crop.size)
+        crop = crop.resize((max(1, round(crop.width * scale)), max(1, round(crop.height * scale))), Image.Resampling.LANCZOS)
+    data, mime_type = encode_image(crop, fmt, quality)
+    return width, height, Tile(box=box, data=data, mime_type=mime_type)
+
+
+def _overlap_with(boxes: np.ndarray, box: np.ndarray) -> np.ndarray:
+    """Intersection of `box` with each of `boxes`, over the smaller of the two areas."""
+    inter_h = np.clip(np.minimum(boxes[:, 2], box[2]) - np.maximum(boxes[:, 0], box[0]), 0, None)
+    inter_w = np.clip(np.minimum(boxes[:, 3], box[3]) - np.maximum(boxes[:, 1], box[1]), 0, None)
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    smaller = np.minimum(areas, (box[2] - box[0]) * (box[3] - box[1]))
+    return inter_h * inter_w / np.maximum(smaller, 1e-9)
+
+
+def new_in_region(found: Fields, known: Fields, region) -> Fields:
+    """Fields of a region detection (page 0-1000) worth adding to the `known` ones.
+
+    Kept: boxes centred inside the requested region (not just its margin) that are not
+    a duplicate of a known box or of one kept before them.
+    """
+    if not len(found):
+        return Fields.empty()
+    y0, x0, y1, x1 = region
+    y0, y1 = sorted((y0, y1))
+    x0, x1 = sorted((x0, x1))
+    cy = (found.boxes[:, 0] + found.boxes[:, 2]) / 2
+    cx = (found.boxes[:, 1] + found.boxes[:, 3]) / 2
+    inside = (cy >= y0) & (cy <= y1) & (cx >= x0) & (cx <= x1)
+    kept = np.asarray(known.boxes, dtype=np.float64).reshape(-1, 4)
+    boxes, texts = [], []
+    for i in np.flatnonzero(inside):
+        box = found.boxes[i]
+        if len(kept) and (_overlap_with(kept, box) > _DUPLICATE_RATIO).any():
+            continue
+        kept = np.vstack([kept, box[None, :]])
+        boxes.append(box)
+        texts.append(found.texts[i])
+    return Fields(np.array(boxes, dtype=np.float64).reshape(-1, 4), texts)
+
+
+def tile_to_page(fields: Fields, tile_box: tuple, width: int, height: int) -> Fields:
+    """Map fields from tile-local 0-1000 coordinates to page 0-1000 coordinates."""
+    left, top, right, bottom = tile_box
+    scale = np.array([(bottom - top) / height, (right - left) / width] * 2)
+    offset = np.array([top / height, left / width] * 2) * NORMALIZED_SCALE
+    return Fields(fields.boxes * scale + offset, list(fields.texts))
+
+
+def _seam_cut(boxes: np.ndarray, tile_box: tuple, width: int, height: int) -> np.ndarray:
+    """Per box (page 0-1000): whether it touches an edge of its tile that is not a page edge."""
+    left, top, right, bottom = tile_box
+    edges = np.array([top / height, left / width, bottom / height, right / width]) * NORMALIZED_SCALE
+    interior = np.array([top > 0, left > 0, bottom < height, right < width])
+    tol = _SEAM_TOLERANCE * NORMALIZED_SCALE * np.array([(bottom - top) / height, (right - left) / width] * 2)
+    near = np.abs(boxes - edges) <= tol
+    return (near & interior).any(axis=1)
+
+
+def merge_tiles(tile_fields: list, width: int, height: int) -> Fields:
+    """Merge per-tile results [(Fields in tile coordinates, tile_box), ...] into page fields."""
+    boxes, texts, cut = [], [], []
+    for fields, tile_box in tile_fields:
+        if not len(fields):
+            continue
+        page = tile_to_page(fields, tile_box, width, height)
+        boxes.append(page.boxes)
+        texts.extend(page.texts)
+        cut.append(_seam_cut(page.boxes, tile_box, width, height))
+    if not boxes:
+        return Fields.empty()
+    boxes = np.concatenate(boxes)
+    cut = np.concatenate(cut)
+    area = np.clip(boxes[:, 2] - boxes[:, 0], 0, None) * np.clip(boxes[:, 3] - boxes[:, 1], 0, None)
+    # Complete boxes first, then larger ones: they are the best copy of a field
+    order = np.lexsort((-area, cut))
+
+    merged = np.zeros((0, 4))
+    merged_cut: list = []
+    out_texts: list = []
+    for i in order:
+        box = boxes[i]
+        if len(merged):
+            y0 = np.maximum(merged[:, 0], box[0])
+            x0 = np.maximum(merged[:, 1], box[1])
+            y1 = np.minimum(merged[:, 2], box[2])
+            x1 = np.minimum(merged[:, 3], box[3])
+            inter_h, inter_w = np.clip(y1 - y0, 0, None), np.clip(x1 - x0, 0, None)
+            heights = np.minimum(merged[:, 2] - merged[:, 0], box[2] - box[0])
+            widths = np.minimum(merged[:, 3] - merged[:, 1], box[3] - box[1])
+            smaller = np.minimum((merged[:, 2] - merged[:, 0]) * (merged[:, 3] - merged[:, 1]), area[i])
+            duplicate = inter_h * inter_w > _DUPLICATE_RATIO * np.maximum(smaller, 1e-9)
+            # Partial boxes on either side of a seam: they overlap and line up across it
+            aligned = np.maximum(inter_h / np.maximum(heights, 1e-9), inter_w / np.maximum(widths, 1e-9)) >= _SEAM_ALIGNMENT
+            joined = (inter_h * inter_w > 0) & aligned & (cut[i] | np.array(merged_cut))
+            hits = np.flatnonzero(duplicate | joined)
+            if len(hits):
+                j = hits[0]
+                if joined[j]:
+                    merged[j] = [min(merged[j, 0], box[0]), min(merged[j, 1], box[1]),
+                                 max(merged[j, 2], box[2]), max(merged[j, 3], box[3])]
+                    merged_cut[j] = False
+                if not str(out_texts[j]).strip():
+                    out_texts[j] = texts[i]
+                continue
+        merged = np.vstack([merged, box[None, :]])
+        merged_cut.append(bool(cut[i]))
+        out_texts.append(texts[i])
+    return Fields(merged, out_texts)
+
@@ -0,0 +1,138 @@
+"""Bounded-memory upload handling.
+
+- `UploadLimitMiddleware` rejects request bodies over a size limit with 413, from the
+  Content-Length header when there is one and otherwise while the body streams in,
+  before multipart parsing has buffered it.
+- Multipart file parts above the spool threshold are kept in a temp file by Starlette
+  (`set_spool_threshold`), so parsing never holds a whole upload in memory.
+- `read_upload` checks the real type from the file's magic bytes (not the
+  client-supplied content type) and, for images, the pixel dimensions from the header
+  without decoding, and only then reads the upload into the one buffer that the rest
+  of the pipeline (hashing, preprocessing, the model call) shares.
+"""
+from dataclasses import dataclass
+from typing import Iterable, Optional
+import json
+
+from PIL import Image, UnidentifiedImageError
+from starlette.exceptions import HTTPException
+
+from image_prep import oriented_size
+
+IMAGE_MIME_TYPES = {"image/png", "image/jpeg", "image/webp"}
+PDF_MIME_TYPE = "application/pdf"
+ZIP_MIME_TYPE = "application/zip"
+
+_MAGIC = [
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"%PDF-", PDF_MIME_TYPE),
+    (b"PK\x03\x04", ZIP_MIME_TYPE),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"II*\x00", "image/tiff"),
+    (b"MM\x00*", "image/tiff"),
+]
+
+
+class UploadRejected(HTTPException):
+    """An upload refused before processing. An HTTPException so it also surfaces from
+    multipart parsing (which turns other errors into 400s); the app renders it as
+    {"error": detail} with its status code."""
+
+
+@dataclass
+class Upload:
+    data: bytes
+    mime_type: str
+    filename: str
+    # Oriented page size from the image header; 0 for PDFs and zips
+    width: int = 0
+    height: int = 0
+
+
+def sniff_mime(head: bytes) -> Optional[str]:
+    """MIME type from the first bytes of a file; None when unrecognized."""
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    for magic, mime_type in _MAGIC:
+        if head.startswith(magic):
+            return mime_type
+    return None
+
+
+def set_spool_threshold(max_bytes: int) -> None:
+    """Multipart file parts larger than this go to a temp file instead of memory."""
+    from starlette.formparsers import MultiPartParser
+
+    MultiPartParser.max_file_size = max_bytes
+
+
+def read_upload(file, allowed: Iterable[str], max_pixels: int = 0) -> Upload:
+    """Validate and read an UploadFile. Blocking (the part may be on disk); run it off the event loop.
+
+    Raises UploadRejected: 415 for a type not in `allowed`, 413 for images over
+    `max_pixels` (0 disables), 400 for images whose header cannot be read.
+    """
+    f = file.file
+    f.seek(0)
+    mime_type = sniff_mime(f.read(16))
+    f.seek(0)
+    if mime_type not in allowed:
+        raise UploadRejected(415, f"unsupported file type: {mime_type or 'unknown'} (expected {', '.join(sorted(allowed))})")
+    width = height = 0
+    if mime_type in IMAGE_MIME_TYPES:
+        try:
+            with Image.open(f) as img:
+                width, height = oriented_size(img)
+        except (UnidentifiedImageError, OSError, SyntaxError) as e:
+            raise UploadRejected(400, f"could not read image: {str(e)}")
+        if max_pixels and width * height > max_pixels:
+            raise UploadRejected(413, f"image is {width}x{height} pixels, limit is {max_pixels}")
+        f.seek(0)
+    return Upload(data=f.read(), mime_type=mime_type, filename=file.filename or "", width=width, height=height)
+
+
+class UploadLimitMiddleware:
+    """ASGI middleware: 413 for request bodies over `max_bytes` (per-path overrides in `limits`).
+
+    A body without Content-Length (or with a false one) is cut off as soon as the bytes
+    received pass the limit: UploadRejected is raised from `receive` inside the app.
+    """
+
+    def __init__(self, app, max_bytes: int, limits: Optional[dict] = None):
+        self.app = app
+        self.max_bytes = max_bytes
+        self.limits = limits or {}
+
+    async def _reject(self, send, limit: int) -> None:
+        body = json.dumps({"error": f"upload too large, limit is {limit} bytes"}).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": 413,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode("latin-1"))],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+    async def __call__(self, scope, receive, send):
+        limit = self.limits.get(scope.get("path"), self.max_bytes) if scope["type"] == "http" else 0
+        if not limit:
+            await self.app(scope, receive, send)
+            return
+        declared = dict(scope.get("headers") or []).get(b"content-length")
+        if declared is not None and declared.isdigit() and int(declared) > limit:
+            await self._reject(send, limit)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    raise UploadRejected(413, f"upload too large, limit is {limit} bytes")
+            return message
+
+        await self.app(scope, limited_receive, send)
@@ -1,6 +1,8 @@
 from typing import List, Dict, Any
 import io
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageDraw
+
+from render import get_font
 
 
 def ensure_dir(path: str) -> None:
@@ -26,11 +28,7 @@ def draw_boxes_and_text(img: Image.Image, boxes: List[Dict[str, Any]], texts: Li
     out = img.convert('RGBA')
     draw = ImageDraw.Draw(out)
     width_px, height_px = out.size
-    # Font setup
-    try:
-        font = ImageFont.truetype("Arial.ttf", 20)
-    except Exception:
-        font = ImageFont.load_default()
+    font = get_font("Arial", 20)
     for i, entry in enumerate(boxes):
         box = entry.get('box_2d') if isinstance(entry, dict) else entry
         if not isinstance(box, list) or len(box) != 4: